@@ -0,0 +1,230 @@
+import bisect
+import numpy as np
+from datetime import datetime, date
+from timestring import Date
+
+#
+# Map bin labels to codes, in order of first use, so that a label used by several bins gets one code
+#
+def __getLabelCodes__(labels):
+    uniqueLabels = []
+    labelCodes = {}
+    codes = []
+    for label in labels:
+        if label not in labelCodes:
+            labelCodes[label] = len(uniqueLabels)
+            uniqueLabels.append(label)
+        codes.append(labelCodes[label])
+    return uniqueLabels, codes
+
+#
+# A range binning compiled for lookups by binary search.
+#
+# The bin boundaries split the number line into elementary pieces: each boundary point, and the open gaps
+# between (and beyond) consecutive points. Every value in a piece falls into the same bins, so the label of
+# the first matching bin - or the fallback label - is worked out once per piece. Labelling a value is then
+# a binary search for its piece, whether the bins overlap, leave gaps or not.
+#
+class CompiledRangeBinning:
+
+    def __init__(self, binning):
+        bins = binning['bins']
+        mins = np.array([bin['min'] for bin in bins], dtype=np.float64)
+        maxs = np.array([bin['max'] for bin in bins], dtype=np.float64)
+
+        # Label codes index into self.labels. The fallback label comes last.
+        self.labels, binCodes = __getLabelCodes__([bin['label'] for bin in bins] + [binning.get('fallbackLabel')])
+        self.fallbackCode = binCodes.pop()
+
+        self.points = np.unique(np.concatenate((mins, maxs)))
+        if len(self.points) > 0:
+            gaps = np.concatenate(([self.points[0] - 1], (self.points[:-1] + self.points[1:]) / 2, [self.points[-1] + 1]))
+        else:
+            gaps = np.zeros(1)
+        self.pointCodes = self.__getFirstMatchCodes__(self.points, mins, maxs, binCodes)
+        self.gapCodes = self.__getFirstMatchCodes__(gaps, mins, maxs, binCodes)
+
+        # Plain lists are faster than arrays for one value at a time
+        self.pointList = self.points.tolist()
+        self.pointCodeList = self.pointCodes.tolist()
+        self.gapCodeList = self.gapCodes.tolist()
+
+    def __getFirstMatchCodes__(self, values, mins, maxs, binCodes):
+        codes = np.full(len(values), self.fallbackCode, dtype=np.int32)
+        unmatched = np.ones(len(values), dtype=bool)
+        for i in range(len(binCodes)):
+            match = unmatched & (mins[i] <= values) & (values <= maxs[i])
+            codes[match] = binCodes[i]
+            unmatched &= ~match
+        return codes
+
+    #
+    # Label a single value
+    #
+    def getLabel(self, value):
+        if value != value:
+            return self.labels[self.fallbackCode]
+        i = bisect.bisect_left(self.pointList, value)
+        if i < len(self.pointList) and self.pointList[i] == value:
+            return self.labels[self.pointCodeList[i]]
+        return self.labels[self.gapCodeList[i]]
+
+    #
+    # Label a whole column of values. Returns the label code of each value; codes index into self.labels.
+    #
+    def getCodes(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if len(self.points) == 0:
+            return np.full(len(values), self.fallbackCode, dtype=np.int32)
+        i = np.searchsorted(self.points, values, side='left')
+        pointIndex = np.minimum(i, len(self.points) - 1)
+        onPoint = self.points[pointIndex] == values
+        codes = np.where(onPoint, self.pointCodes[pointIndex], self.gapCodes[i])
+        codes[np.isnan(values)] = self.fallbackCode
+        return codes
+
+#
+# An enum binning compiled into a dictionary from value to label. When a value is listed in several bins the
+# first one wins, as with a linear scan of the bins.
+#
+class CompiledEnumBinning:
+
+    def __init__(self, binning):
+        bins = binning['bins']
+        self.labels, binCodes = __getLabelCodes__([bin['label'] for bin in bins] + [binning.get('fallbackLabel')])
+        self.fallbackCode = binCodes.pop()
+        self.valueCodes = {}
+        for bin, code in zip(bins, binCodes):
+            if bin['value'] not in self.valueCodes:
+                self.valueCodes[bin['value']] = code
+
+    #
+    # Label a single value
+    #
+    def getLabel(self, value):
+        return self.labels[self.valueCodes.get(value, self.fallbackCode)]
+
+    #
+    # Label a dictionary encoded column, given as the code of each row (-1 for no value) and the values the
+    # codes index into. Each distinct value is looked up once. Returns the label code of each row; codes
+    # index into self.labels and rows without a value get the fallback label.
+    #
+    def getCodes(self, codes, values):
+        lookup = np.array([self.valueCodes.get(value, self.fallbackCode) for value in values] + [self.fallbackCode], dtype=np.int32)
+        return lookup[codes]
+
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+#
+# A date binning compiled once per binning.
+#
+# Custom bins are turned into day numbers (days since 1970-01-01) and compiled like a range binning, so a date
+# falls into the first bin with min <= date <= max, compared chronologically by day. Weekly, monthly and
+# yearly periods are computed with datetime64 arithmetic over a whole column. Period labels are added to
+# self.labels as they are first seen.
+#
+class CompiledDateBinning:
+
+    def __init__(self, binning, dateParser=None):
+        self.dateParser = dateParser
+        if self.dateParser == None:
+            self.dateParser = Date
+        self.period = binning.get('period')
+        if self.period == None:
+            bins = []
+            for bin in binning['bins']:
+                bins.append({ 'label': bin['label'], 'min': self.__getDayNumber__(self.dateParser(bin['min'])),
+                              'max': self.__getDayNumber__(self.dateParser(bin['max'])) })
+            self.rangeBinning = CompiledRangeBinning({ 'bins': bins, 'fallbackLabel': binning.get('fallbackLabel') })
+            self.labels = self.rangeBinning.labels
+        else:
+            self.labels = []
+            self.labelCodes = {}
+
+    def __getDayNumber__(self, d):
+        return date(d.year, d.month, d.day).toordinal() - EPOCH_ORDINAL
+
+    def __getLabelCode__(self, label):
+        if label not in self.labelCodes:
+            self.labelCodes[label] = len(self.labels)
+            self.labels.append(label)
+        return self.labelCodes[label]
+
+    #
+    # Label for a period key: year * 100 + week for weekly, months since 1970-01 for monthly and years since
+    # 1970 for yearly
+    #
+    def __getPeriodLabel__(self, key):
+        if self.period == 'weekly':
+            year, number = key // 100, key % 100
+        elif self.period == 'monthly':
+            year, number = key // 12 + 1970, key % 12 + 1
+        elif self.period == 'yearly':
+            return str(key + 1970)
+        else:
+            return "Unknown"
+        zeroFill = ''
+        if number < 10:
+            zeroFill = '0'
+        return str(year) + zeroFill + str(number)
+
+    #
+    # Period keys of an array of day numbers
+    #
+    def __getPeriodKeys__(self, days):
+        if self.period == 'weekly':
+            # ISO weeks start on Monday and belong to the year of their Thursday. 1970-01-01 was a Thursday.
+            thursdays = days - (days + 3) % 7 + 3
+            years = thursdays.astype('datetime64[D]').astype('datetime64[Y]')
+            firstDays = years.astype('datetime64[D]').view(np.int64)
+            return (years.view(np.int64) + 1970) * 100 + (thursdays - firstDays) // 7 + 1
+        elif self.period == 'monthly':
+            return days.astype('datetime64[D]').astype('datetime64[M]').view(np.int64)
+        elif self.period == 'yearly':
+            return days.astype('datetime64[D]').astype('datetime64[Y]').view(np.int64)
+        return np.zeros(len(days), dtype=np.int64)
+
+    #
+    # Label a single date, given as a datetime or a string
+    #
+    def getLabel(self, value):
+        if not isinstance(value, datetime):
+            value = self.dateParser(value)
+        day = self.__getDayNumber__(value)
+        if self.period == None:
+            return self.rangeBinning.getLabel(day)
+        return self.__getPeriodLabel__(self.__getPeriodKeys__(np.array([day], dtype=np.int64))[0])
+
+    #
+    # Label a whole datetime64 column. Returns the label code of each row, or -1 for rows without a date;
+    # codes index into self.labels.
+    #
+    def getCodes(self, dates):
+        days = np.asarray(dates).astype('datetime64[D]')
+        valid = ~np.isnat(days)
+        days = days[valid].view(np.int64)
+        codes = np.full(len(valid), -1, dtype=np.int32)
+        if self.period == None:
+            codes[valid] = self.rangeBinning.getCodes(days)
+            return codes
+        uniqueKeys, keyIndex = np.unique(self.__getPeriodKeys__(days), return_inverse=True)
+        keyCodes = np.array([self.__getLabelCode__(self.__getPeriodLabel__(key)) for key in uniqueKeys.tolist()], dtype=np.int32)
+        codes[valid] = keyCodes[keyIndex]
+        return codes
+
+#
+# Compile a list of binnings. dateParser turns the date strings of date binnings into dates. Binnings of
+# unknown type are left as None.
+#
+def compileBinnings(binnings, dateParser=None):
+    compiledBinnings = []
+    for binning in binnings:
+        if binning['type'] == 'range':
+            compiledBinnings.append(CompiledRangeBinning(binning))
+        elif binning['type'] == 'enum':
+            compiledBinnings.append(CompiledEnumBinning(binning))
+        elif binning['type'] == 'date':
+            compiledBinnings.append(CompiledDateBinning(binning, dateParser))
+        else:
+            compiledBinnings.append(None)
+    return compiledBinnings
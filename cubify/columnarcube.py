@@ -0,0 +1,328 @@
+import numpy as np
+
+#
+# Columnar storage for in-memory cubes.
+#
+# Measures are float64 arrays, dimensions are dictionary encoded int32 code arrays (code -1 means the row
+# has no value for the dimension) and dates are datetime64 arrays. Cube rows can still be read as the usual
+# row dicts: they are built lazily, a chunk of rows at a time, when the cube is iterated or indexed.
+#
+class ColumnarCube:
+
+    def __init__(self, keyOrder=None, chunkSize=100000):
+        # keyOrder is the ordered list of dimensions making up the dimension key (agg cubes).
+        # If None, the key is made of the sorted dimensions followed by the sorted dates.
+        self.keyOrder = keyOrder
+        self.chunkSize = chunkSize
+        self.size = 0
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.measures = {}
+        self.missingMeasures = {}
+        self.dimensions = {}
+        self.dimensionValues = {}
+        self.dimensionCodes = {}
+        self.dates = {}
+        # Only kept when a row's stored dimension key cannot be rebuilt from its dimensions
+        self.dimensionKeys = None
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for start in range(0, self.size, self.chunkSize):
+            for cubeRow in self.getRows(start, min(start + self.chunkSize, self.size)):
+                yield cubeRow
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.size
+        if i < 0 or i >= self.size:
+            raise IndexError("Cube row index out of range")
+        return self.getRows(i, i + 1)[0]
+
+    #
+    # Column accessors
+    #
+    def getMeasureNames(self):
+        return self.measures.keys()
+
+    def getDimensionNames(self):
+        return self.dimensions.keys()
+
+    def getDateNames(self):
+        return self.dates.keys()
+
+    def getMeasure(self, name):
+        return self.measures[name]
+
+    def getMissingMeasure(self, name):
+        return self.missingMeasures.get(name)
+
+    def getDimension(self, name):
+        # Returns the code array and the list of values the codes index into
+        return self.dimensions[name], self.dimensionValues[name]
+
+    def getDate(self, name):
+        return self.dates[name]
+
+    #
+    # Distinct values of every dimension, with the number of rows having each value
+    #
+    def getDistincts(self):
+        distincts = {}
+        for name, codes in self.dimensions.items():
+            counts = np.bincount(codes[codes >= 0], minlength=len(self.dimensionValues[name])).tolist()
+            values = self.dimensionValues[name]
+            distincts[name] = dict((values[code], count) for code, count in enumerate(counts) if count > 0)
+        return distincts
+
+    #
+    # Copy the cube. The column arrays are shared: columns are only ever replaced, never written into,
+    # so the copies cannot affect each other.
+    #
+    def copy(self):
+        columnarCube = ColumnarCube(self.keyOrder, self.chunkSize)
+        columnarCube.size = self.size
+        columnarCube.ids = self.ids
+        columnarCube.measures = dict(self.measures)
+        columnarCube.missingMeasures = dict(self.missingMeasures)
+        columnarCube.dimensions = dict(self.dimensions)
+        columnarCube.dimensionValues = dict((name, list(values)) for name, values in self.dimensionValues.items())
+        columnarCube.dimensionCodes = dict((name, dict(codes)) for name, codes in self.dimensionCodes.items())
+        columnarCube.dates = dict(self.dates)
+        if self.dimensionKeys is not None:
+            columnarCube.dimensionKeys = list(self.dimensionKeys)
+        return columnarCube
+
+    #
+    # A new cube holding the rows at the given positions, in that order. Dimension dictionaries are copied
+    # as they are, so the codes stay valid.
+    #
+    def take(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        columnarCube = self.copy()
+        columnarCube.size = len(indices)
+        columnarCube.ids = self.ids[indices]
+        columnarCube.measures = dict((name, values[indices]) for name, values in self.measures.items())
+        columnarCube.missingMeasures = dict((name, missing[indices]) for name, missing in self.missingMeasures.items())
+        columnarCube.dimensions = dict((name, codes[indices]) for name, codes in self.dimensions.items())
+        columnarCube.dates = dict((name, values[indices]) for name, values in self.dates.items())
+        if self.dimensionKeys is not None:
+            columnarCube.dimensionKeys = [self.dimensionKeys[i] for i in indices.tolist()]
+        return columnarCube
+
+    #
+    # Replace or add a measure column
+    #
+    def setMeasure(self, name, values):
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) != self.size:
+            raise ValueError("Measure " + name + " must have one value per cube row")
+        self.measures[name] = values
+        if name in self.missingMeasures:
+            del(self.missingMeasures[name])
+
+    #
+    # Replace or add a dimension column, from a list of values or from codes and the values they index into
+    #
+    def setDimension(self, name, values, codes=None):
+        if codes is None:
+            dimensionCodes = {}
+            dimensionValues = []
+            codes = np.empty(len(values), dtype=np.int32)
+            for i, value in enumerate(values):
+                code = dimensionCodes.get(value)
+                if code is None:
+                    code = len(dimensionValues)
+                    dimensionCodes[value] = code
+                    dimensionValues.append(value)
+                codes[i] = code
+            values = dimensionValues
+        else:
+            codes = np.asarray(codes, dtype=np.int32)
+            dimensionCodes = dict((value, code) for code, value in enumerate(values))
+        if len(codes) != self.size:
+            raise ValueError("Dimension " + name + " must have one value per cube row")
+        self.dimensions[name] = codes
+        self.dimensionValues[name] = list(values)
+        self.dimensionCodes[name] = dimensionCodes
+        # Dimension keys are rebuilt from the dimensions from now on
+        self.dimensionKeys = None
+
+    #
+    # Append cube rows (dicts) to the cube
+    #
+    def appendRows(self, cubeRows):
+        chunks = []
+        chunk = []
+        for cubeRow in cubeRows:
+            chunk.append(cubeRow)
+            if len(chunk) == self.chunkSize:
+                chunks.append(self.__encodeChunk__(chunk))
+                chunk = []
+        if len(chunk) > 0:
+            chunks.append(self.__encodeChunk__(chunk))
+        if len(chunks) == 0:
+            return
+
+        start = self.size
+        sizes = [encoded['size'] for encoded in chunks]
+        self.size = start + sum(sizes)
+        self.ids = np.concatenate([self.ids] + [encoded['ids'] for encoded in chunks])
+
+        # Measures, with a missing mask for columns that some rows do not have
+        names = set(self.measures)
+        for encoded in chunks:
+            names.update(encoded['measures'])
+        for name in names:
+            pieces = [self.measures.get(name, np.full(start, np.nan))]
+            missingPieces = [self.missingMeasures.get(name, np.full(start, name not in self.measures, dtype=bool))]
+            for encoded, size in zip(chunks, sizes):
+                if name in encoded['measures']:
+                    values, missing = encoded['measures'][name]
+                    pieces.append(values)
+                    missingPieces.append(missing)
+                else:
+                    pieces.append(np.full(size, np.nan))
+                    missingPieces.append(np.ones(size, dtype=bool))
+            self.measures[name] = np.concatenate(pieces)
+            missing = np.concatenate(missingPieces)
+            if missing.any():
+                self.missingMeasures[name] = missing
+            elif name in self.missingMeasures:
+                del(self.missingMeasures[name])
+
+        # Dimensions. Codes are already relative to the cube's dictionaries
+        names = set(self.dimensions)
+        for encoded in chunks:
+            names.update(encoded['dimensions'])
+        for name in names:
+            pieces = [self.dimensions.get(name, np.full(start, -1, dtype=np.int32))]
+            for encoded, size in zip(chunks, sizes):
+                pieces.append(encoded['dimensions'].get(name, np.full(size, -1, dtype=np.int32)))
+            self.dimensions[name] = np.concatenate(pieces)
+
+        # Dates
+        names = set(self.dates)
+        for encoded in chunks:
+            names.update(encoded['dates'])
+        for name in names:
+            pieces = [self.dates.get(name, np.full(start, np.datetime64('NaT'), dtype='datetime64[s]'))]
+            for encoded, size in zip(chunks, sizes):
+                pieces.append(encoded['dates'].get(name, np.full(size, np.datetime64('NaT'), dtype='datetime64[s]')))
+            self.dates[name] = np.concatenate(pieces)
+
+        # Only keep the stored dimension keys if some of them cannot be rebuilt from the dimensions
+        keysMatch = all(encoded['keysMatch'] for encoded in chunks)
+        if self.dimensionKeys is None and not keysMatch:
+            self.dimensionKeys = [cubeRow['dimensionKey'] for cubeRow in self.getRows(0, start)]
+        if self.dimensionKeys is not None:
+            for encoded in chunks:
+                self.dimensionKeys.extend(encoded['dimensionKeys'])
+
+    #
+    # Build the row dicts for rows start to stop
+    #
+    def getRows(self, start, stop):
+        ids = self.ids[start:stop].tolist()
+        measures = []
+        for name, values in self.measures.items():
+            missing = self.missingMeasures.get(name)
+            if missing is not None:
+                missing = missing[start:stop].tolist()
+            measures.append((name, values[start:stop].tolist(), missing))
+        dimensions = []
+        for name, codes in self.dimensions.items():
+            dimensions.append((name, codes[start:stop].tolist(), self.dimensionValues[name]))
+        dates = []
+        for name, values in self.dates.items():
+            dates.append((name, values[start:stop].tolist()))
+
+        cubeRows = []
+        for j in range(stop - start):
+            cubeRow = {'id': ids[j], 'dimensionKey': '', 'dimensions': {}, 'measures': {}, 'dates': {}}
+            for name, values, missing in measures:
+                if missing is None or not missing[j]:
+                    cubeRow['measures'][name] = values[j]
+            for name, codes, values in dimensions:
+                if codes[j] >= 0:
+                    cubeRow['dimensions'][name] = values[codes[j]]
+            for name, values in dates:
+                if values[j] is not None:
+                    cubeRow['dates'][name] = values[j]
+            if self.dimensionKeys is not None:
+                cubeRow['dimensionKey'] = self.dimensionKeys[start + j]
+            else:
+                cubeRow['dimensionKey'] = self.__getDimensionKey__(cubeRow['dimensions'], cubeRow['dates'])
+            cubeRows.append(cubeRow)
+        return cubeRows
+
+    def __getDimensionKey__(self, dimensions, dates):
+        dimensionKey = ''
+        if self.keyOrder is not None:
+            for dimension in self.keyOrder:
+                if dimension in dimensions:
+                    dimensionKey += '#' + dimension + ':' + dimensions[dimension]
+            return dimensionKey
+
+        for dimension in sorted(dimensions):
+            dimensionKey += '#' + dimension + ":" + dimensions[dimension]
+        for dateName in sorted(dates):
+            dimensionKey += '#' + dateName + ":" + str(dates[dateName])[:10]
+        return dimensionKey
+
+    #
+    # Encode a chunk of row dicts into column arrays
+    #
+    def __encodeChunk__(self, chunk):
+        size = len(chunk)
+        measureNames = set()
+        dimensionNames = set()
+        dateNames = set()
+        for cubeRow in chunk:
+            measureNames.update(cubeRow['measures'])
+            dimensionNames.update(cubeRow['dimensions'])
+            dateNames.update(cubeRow['dates'])
+
+        encoded = {'size': size, 'measures': {}, 'dimensions': {}, 'dates': {}}
+        encoded['ids'] = np.array([cubeRow['id'] for cubeRow in chunk], dtype=np.int64)
+        encoded['dimensionKeys'] = [cubeRow['dimensionKey'] for cubeRow in chunk]
+        encoded['keysMatch'] = all(cubeRow['dimensionKey'] == self.__getDimensionKey__(cubeRow['dimensions'], cubeRow['dates'])
+                                   for cubeRow in chunk)
+
+        for name in measureNames:
+            values = np.empty(size, dtype=np.float64)
+            missing = np.zeros(size, dtype=bool)
+            for i, cubeRow in enumerate(chunk):
+                value = cubeRow['measures'].get(name)
+                if value is None:
+                    values[i] = np.nan
+                    missing[i] = True
+                else:
+                    values[i] = value
+            encoded['measures'][name] = (values, missing)
+
+        for name in dimensionNames:
+            if name not in self.dimensionCodes:
+                self.dimensionCodes[name] = {}
+                self.dimensionValues[name] = []
+            dimensionCodes = self.dimensionCodes[name]
+            dimensionValues = self.dimensionValues[name]
+            codes = np.empty(size, dtype=np.int32)
+            for i, cubeRow in enumerate(chunk):
+                value = cubeRow['dimensions'].get(name)
+                if value is None:
+                    codes[i] = -1
+                    continue
+                code = dimensionCodes.get(value)
+                if code is None:
+                    code = len(dimensionValues)
+                    dimensionCodes[value] = code
+                    dimensionValues.append(value)
+                codes[i] = code
+            encoded['dimensions'][name] = codes
+
+        for name in dateNames:
+            encoded['dates'][name] = np.array([cubeRow['dates'].get(name) for cubeRow in chunk], dtype='datetime64[s]')
+
+        return encoded
@@ -5,20 +5,183 @@ import sys
 import math
 import numpy as np
 import pymongo
-from copy import deepcopy
+from itertools import chain, islice
+from multiprocessing import Pool
 from pymongo import MongoClient
+from bson.objectid import ObjectId
+from bson.son import SON
 from datetime import datetime
 from time import strptime
 from timestring import Date
-from simpleeval import simple_eval
+from columnarcube import ColumnarCube
+from expressions import compileExpression, ColumnExpression
+from binning import compileBinnings, CompiledDateBinning
+from stats import StatsAccumulator
+
+#
+# Create a MongoClient. host is a host name or MongoDB URI (localhost by default), maxPoolSize caps the number
+# of pooled connections, timeout (in milliseconds) applies to server selection, connecting and socket operations,
+# and w is the write concern.
+#
+def createMongoClient(maxPoolSize=None, timeout=None, w=None, host=None):
+    options = {}
+    if maxPoolSize != None:
+        options['maxPoolSize'] = maxPoolSize
+    if timeout != None:
+        options['serverSelectionTimeoutMS'] = timeout
+        options['connectTimeoutMS'] = timeout
+        options['socketTimeoutMS'] = timeout
+    if w != None:
+        options['w'] = w
+    return MongoClient(host, **options)
+
+#
+# Worker process entry points for parallel csv ingestion. They live at module level so that they can be pickled.
+#
+def __readCsvRange__(csvfile, start, end):
+    csvfile.seek(start)
+    while csvfile.tell() < end:
+        line = csvfile.readline()
+        if not line:
+            break
+        yield line
+
+def __countCsvRangeRows__(args):
+    csvFilePath, start, end = args
+    rowCount = 0
+    with open(csvFilePath, 'rb') as csvfile:
+        for line in __readCsvRange__(csvfile, start, end):
+            if line.rstrip('\r\n') != '':
+                rowCount += 1
+    return rowCount
+
+#
+# A CubeService for a worker process, connected to the same server as the service that started the worker
+#
+def __createWorkerCubeService__(dbName, clientOptions):
+    host, maxPoolSize, timeout, w = clientOptions
+    # Each worker works sequentially, so a single pooled connection is enough
+    return CubeService(dbName, None, 1, timeout, w, host=host)
+
+def __ingestCsvRange__(args):
+    dbName, clientOptions, csvFilePath, cubeName, start, end, firstId, fields, batchSize = args
+    cs = __createWorkerCubeService__(dbName, clientOptions)
+    distincts = {}
+    with open(csvFilePath, 'rb') as csvfile:
+        reader = csv.reader(__readCsvRange__(csvfile, start, end))
+        rows = (row for row in reader if row != [])
+        cubeRows = cs.__convertCsvRows__(rows, fields, distincts, firstId)
+        statsAccumulator = cs.__insertCubeRowsInBatches__(cubeName, cubeRows, batchSize)
+    return distincts, statsAccumulator
+
+#
+# Worker process entry point for parallel binning. Bins the source cube rows with ids in [start, end) and
+# inserts them into the binned cube row collection.
+#
+def __binCubeRange__(args):
+    dbName, clientOptions, sourceCubeName, binnedCubeName, binnings, start, end, batchSize = args
+    cs = __createWorkerCubeService__(dbName, clientOptions)
+    compiledBinnings = compileBinnings(binnings, cs.dateParser)
+    distincts = {}
+    cubeRows = cs.queryCubeRows(cs.getCube(sourceCubeName), { "id": { "$gte": start, "$lt": end }})
+    binnedCubeRows = (cs.__performBinning__(binnings, cubeRow, distincts, compiledBinnings) for cubeRow in cubeRows)
+    statsAccumulator = cs.__insertCubeRowsInBatches__(binnedCubeName, binnedCubeRows, batchSize)
+    return distincts, statsAccumulator
+
+#
+# A cursor over persisted cube rows that computes the cube's virtual columns, a batch of rows at a time, as the
+# rows are read. Everything else - count, sort, limit and so on - goes to the underlying pymongo cursor, and
+# cursors it returns, such as clones, are wrapped in turn.
+#
+# The dimensionKey of each row is rebuilt to include the virtual dimensions, as for in-memory cubes. Sorting on
+# dimensionKey still sorts on the stored key, which does not include them.
+#
+class VirtualColumnCursor:
+
+    def __init__(self, cubeService, cursor, virtualColumns, batchSize=1000):
+        self.cubeService = cubeService
+        self.cursor = cursor
+        self.virtualColumns = virtualColumns
+        self.virtualColumnExpressions = cubeService.__getColumnExpressions__(virtualColumns)
+        self.hasVirtualDimensions = any(column['type'] != 'numeric' for column in virtualColumns)
+        self.batchSize = batchSize
+        self.rows = None
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.rows == None:
+            self.rows = self.__generateRows__()
+        return next(self.rows)
+
+    __next__ = next
+
+    def __generateRows__(self):
+        while True:
+            batch = list(islice(self.cursor, self.batchSize))
+            if len(batch) == 0:
+                return
+            for cubeRow in self.__addVirtualColumns__(batch):
+                yield cubeRow
+
+    def __getitem__(self, index):
+        result = self.cursor[index]
+        if isinstance(result, dict):
+            return self.__addVirtualColumns__([result])[0]
+        return self.__wrap__(result)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.cursor, name)
+        if not callable(attribute):
+            return attribute
+        # Cursor methods such as sort and limit return the cursor itself, and clone returns a new cursor;
+        # keep the wrapper around them
+        def method(*args, **kwargs):
+            result = attribute(*args, **kwargs)
+            if result is self.cursor:
+                return self
+            if isinstance(result, type(self.cursor)):
+                return self.__wrap__(result)
+            return result
+        return method
+
+    def __wrap__(self, cursor):
+        return VirtualColumnCursor(self.cubeService, cursor, self.virtualColumns, self.batchSize)
+
+    def __addVirtualColumns__(self, cubeRows):
+        columnarCube = ColumnarCube()
+        columnarCube.appendRows(cubeRows)
+        self.cubeService.__computeColumns__(columnarCube, cubeRows, self.virtualColumns, self.virtualColumnExpressions)
+        if self.hasVirtualDimensions:
+            for cubeRow in cubeRows:
+                cubeRow['dimensionKey'] = self.cubeService.__reconstructDimensionKey__(cubeRow['dimensions'], cubeRow['dates'])
+        return cubeRows
 
 class CubeService:
-    def __init__(self, dbName="cubify"):
+    #
+    # client is an optional MongoClient to share with other services. If none is given, one is created with
+    # the host, maxPoolSize, timeout and w (write concern) options. Parallel workers cannot share a client and
+    # connect to host themselves, so with an injected client they need host to point at the same server.
+    #
+    # If serverSideSummaries is True, the stats and distincts of persisted cubes are recomputed inside MongoDB
+    # after rows are appended or deleted, instead of streaming every cube row to the client.
+    #
+    def __init__(self, dbName="cubify", client=None, maxPoolSize=None, timeout=None, w=None, serverSideSummaries=False,
+                 host=None):
         self.dbName = dbName
-        client = MongoClient()
+        self.serverSideSummaries = serverSideSummaries
+        self.clientOptions = None
+        if client == None or host != None:
+            self.clientOptions = (host, maxPoolSize, timeout, w)
+        if client == None:
+            client = createMongoClient(maxPoolSize, timeout, w, host)
+        self.client = client
         self.db = client[dbName]
         self.inMemoryCubes = {}
         self.inMemoryCubeRows = {}
+        self.inMemoryStatsStates = {}
+        self.dateParser = self.__getDateParser__(None)
 
     def __is_number__(self, s):
         try:
@@ -74,48 +237,122 @@ class CubeService:
             else:
                 field[value] += 1
 
-    def __getFields__(self, csvFilePath):
+    #
+    #  Get field names and types from the header of a csv file and a window of sample rows
+    #
+    def __getFields__(self, csvFilePath, sampleSize=100):
+        with open(csvFilePath, 'rU') as csvfile:
+            reader = csv.reader(csvfile)
+            rawFieldNames = next(reader)
+            sampleRows = list(islice((row for row in reader if row != []), sampleSize))
+        return self.__inferFields__(rawFieldNames, sampleRows)
+
+    #
+    #  Infer field types from a window of sample rows. Un-prefixed fields are typed number or date only
+    #  if every non-empty sampled value agrees, otherwise they are strings.
+    #
+    def __inferFields__(self, rawFieldNames, sampleRows):
         result = {}
         result['rawFieldNames'] = []
         result['fieldNames'] = []
         fieldTypes = {}
         dateFormats = {}
 
-        with open(csvFilePath, 'rU') as csvfile:
-            reader = csv.DictReader(csvfile)
-            rawFieldNames = reader.fieldnames
-            for rawFieldName in rawFieldNames:
-               result['rawFieldNames'].append(rawFieldName)
-               cleanedFieldName = self.__cleanFieldName(rawFieldName)
-               result['fieldNames'].append(cleanedFieldName)
-               if rawFieldName.startswith('S:'):
-                  fieldTypes[cleanedFieldName] = 'string'
-               elif rawFieldName.startswith('N:'):
-                  fieldTypes[cleanedFieldName] = 'number'
-               elif rawFieldName.startswith('D:'):
-                  fieldTypes[cleanedFieldName] = 'date'
-               else:
-                  fieldTypes[cleanedFieldName] = 'unknown'
-
-            for row in reader:
-                for rawFieldName in rawFieldNames:
-                    cleanedFieldName = self.__cleanFieldName(rawFieldName)
-                    value = row[rawFieldName]
-                    if fieldTypes[cleanedFieldName] == 'unknown':
-                        if self.__is_number__(value):
-                            fieldTypes[cleanedFieldName] = 'number'
-                        elif self.__is_date__(value):
-                            value = self.__removeMicroSeconds__(value)
-                            fieldTypes[cleanedFieldName] = 'date'
-                            dateFormats[cleanedFieldName] = self.__getDateFormat__(value)
-                        else: 
-                            fieldTypes[cleanedFieldName] = 'string'
-                break
+        for i, rawFieldName in enumerate(rawFieldNames):
+            result['rawFieldNames'].append(rawFieldName)
+            cleanedFieldName = self.__cleanFieldName(rawFieldName)
+            result['fieldNames'].append(cleanedFieldName)
+
+            values = [row[i] for row in sampleRows if i < len(row) and row[i] != '']
+            if rawFieldName.startswith('S:'):
+                fieldTypes[cleanedFieldName] = 'string'
+            elif rawFieldName.startswith('N:'):
+                fieldTypes[cleanedFieldName] = 'number'
+            elif rawFieldName.startswith('D:'):
+                fieldTypes[cleanedFieldName] = 'date'
+            elif len(values) > 0 and all(self.__is_number__(value) for value in values):
+                fieldTypes[cleanedFieldName] = 'number'
+            elif len(values) > 0 and all(self.__is_date__(value) for value in values):
+                fieldTypes[cleanedFieldName] = 'date'
+            else:
+                fieldTypes[cleanedFieldName] = 'string'
+
+            if fieldTypes[cleanedFieldName] == 'date' and len(values) > 0:
+                dateFormats[cleanedFieldName] = self.__getDateFormat__(self.__removeMicroSeconds__(values[0]))
 
         result['fieldTypes'] = fieldTypes
         result['dateFormats'] = dateFormats
         return result
 
+    #
+    #  Build the converter for a field once, so each cell is converted with a single call
+    #
+    def __getFieldConverter__(self, fieldType, dateFormat):
+        if fieldType == 'number':
+            def convertNumber(value):
+                if value:
+                    try:
+                        return float(value)
+                    except ValueError:
+                        pass
+                return 0.0
+            return convertNumber
+
+        elif fieldType == 'date':
+            parseDate = self.__getDateParser__(dateFormat)
+
+            # Returns the date and the (cleaned) value used for distincts
+            def convertDate(value):
+                value = self.__removeMicroSeconds__(value or '1970-01-01')
+                try:
+                    date = parseDate(value)
+                except ValueError:
+                    print "Invalid date: " + value + ". Replaced with 1990-01-01"
+                    date = datetime(1990, 1, 1)
+                return date, value
+            return convertDate
+
+        else:
+            def convertString(value):
+                if value:
+                    return self.__cleanStringValue__(value)
+                return 'null'
+            return convertString
+
+    #
+    #  Build a memoized date parser for values in the given format (None if unknown). Dates with a four
+    #  digit year, e.g. 2014-10-10, 2014/10/10 or 2014-10-10 10:10:10, are parsed by slicing; anything else
+    #  is handed to timestring. Returns datetimes truncated to the day, as timestring's Date is used today.
+    #
+    def __getDateParser__(self, dateFormat, maxCacheSize=100000):
+        fastParse = dateFormat == None or dateFormat.startswith('%Y')
+        cache = {}
+
+        def parseDate(value):
+            date = cache.get(value)
+            if date != None:
+                return date
+
+            if fastParse and len(value) >= 10 and (value[4] == '-' or value[4] == '/') and value[7] == value[4]:
+                year = value[0:4]
+                month = value[5:7]
+                day = value[8:10]
+                if year.isdigit() and month.isdigit() and day.isdigit():
+                    try:
+                        date = datetime(int(year), int(month), int(day))
+                    except ValueError:
+                        pass
+            if date == None:
+                d = Date(value)
+                date = datetime(d.year, d.month, d.day)
+
+            if len(cache) >= maxCacheSize:
+                cache.clear()
+            cache[value] = date
+            return date
+
+        return parseDate
+
     def __removeMicroSeconds__(self,value):
         # Remove millseconds from value if any
         if ":" in value and "." in value:
@@ -128,105 +365,229 @@ class CubeService:
     #  Get number of rows in cube
     #
     def __getCubeRowCount__(self, cubeName):
-        cubeRows = self.getCubeRowsForCube(cubeName)
+        cubeRows = self.__getStoredCubeRows__(cubeName)
 
-        if isinstance(cubeRows, list):
+        if isinstance(cubeRows, list) or isinstance(cubeRows, ColumnarCube):
             return len(cubeRows)
         else:
             return cubeRows.count()
 
     #
-    #  Create cube rows from csv
+    #  Generate cube rows from csv, one at a time. Distincts are accumulated into the supplied dict.
+    #  The file is opened and tokenized once: field types are inferred from the first sampleSize rows,
+    #  which are then converted along with the rest of the file.
     #
-    def createCubeRowsFromCsv(self, csvFilePath):
+    def __generateCubeRowsFromCsv__(self, csvFilePath, distincts, sampleSize=100):
 
-        cubeRows = []
-        distincts = {}
+        with open(csvFilePath, 'rU') as csvfile:
+            reader = csv.reader(csvfile)
+            try:
+                rawFieldNames = next(reader)
+            except StopIteration:
+                return
+            rows = (row for row in reader if row != [])
+            sampleRows = list(islice(rows, sampleSize))
+            fields = self.__inferFields__(rawFieldNames, sampleRows)
+
+            for cubeRow in self.__convertCsvRows__(chain(sampleRows, rows), fields, distincts):
+                yield cubeRow
 
-        fields = self.__getFields__(csvFilePath)
+    #
+    #  Convert tokenized csv rows into cube rows, numbering them from firstId
+    #
+    def __convertCsvRows__(self, rows, fields, distincts, firstId=1):
         fieldTypes = fields['fieldTypes']
         fieldNames = fields['fieldNames']
-        rawFieldNames = fields['rawFieldNames']
-
+        dateFormats = fields['dateFormats']
         numFields = len(fieldNames)
 
-        with open(csvFilePath, 'rU') as csvfile:
-            reader = csv.DictReader(csvfile)
-            num = 1
-            for row in reader:
-                if len(row) != numFields:
-                    print "Number of fields in row are incorrect. Skipping: ", row
-                    continue
-
-                cubeRow = {"id": num, "dimensionKey": "", "dimensions": {}, "measures": {}, "dates": {}}
-                num += 1
+        columns = []
+        for i, fieldName in enumerate(fieldNames):
+            fieldType = fieldTypes[fieldName]
+            columns.append((i, fieldName, fieldType, self.__getFieldConverter__(fieldType, dateFormats.get(fieldName))))
+        dimensionNames = sorted(fieldName for fieldName in fieldNames if fieldTypes[fieldName] == 'string')
+        dateNames = sorted(fieldName for fieldName in fieldNames if fieldTypes[fieldName] == 'date')
+
+        num = firstId
+        for values in rows:
+            if len(values) > numFields:
+                print "Number of fields in row are incorrect. Skipping: ", values
+                continue
+            if len(values) < numFields:
+                values = values + [''] * (numFields - len(values))
+
+            measures = {}
+            dimensions = {}
+            dates = {}
+            cubeRow = {"id": num, "dimensionKey": "", "dimensions": dimensions, "measures": measures, "dates": dates}
+            num += 1
+
+            for i, fieldName, fieldType, convert in columns:
+                if fieldType == 'number':
+                    measures[fieldName] = convert(values[i])
+
+                elif fieldType == 'date':
+                    # Treat date value as dimension
+                    dates[fieldName], value = convert(values[i])
+                    self.__addToDistincts__(distincts, fieldName, value)
+
+                else:  # This is a string value
+                    value = convert(values[i])
+                    dimensions[fieldName] = value
+                    self.__addToDistincts__(distincts, fieldName, value)
+
+            dimensionKey = ''
+            for dimension in dimensionNames:
+                dimensionKey += '#' + dimension + ":" + dimensions[dimension]
+            for dateName in dateNames:
+                dimensionKey += '#' + dateName + ":" + str(dates[dateName])[:10]
+            cubeRow['dimensionKey'] = dimensionKey
+
+            yield cubeRow
 
-                for rawFieldName, fieldName in map(None, rawFieldNames, fieldNames):
-                    value = row[rawFieldName]
-                    fieldType = fieldTypes[fieldName]
-
-                    # Check for null or empty value and handle appropriately
-                    if value == None or value == '':
-                        if fieldType == 'string':
-                            value = 'null'
-                        elif fieldType == 'number':
-                            value = 0
-                        elif fieldType == 'date':
-                            value = '1970-01-01'
-                        else:
-                            value = 'null'
-
-                    if fieldType == 'number':
-                        if self.__is_number__(value):
-                            cubeRow['measures'][fieldName] = float(value)
-                        else: 
-                            cubeRow['measures'][fieldName] = 0.0
-
-                    elif fieldType == 'date':
-                        # Treat date value as dimension
-                        try:
-                           value = self.__removeMicroSeconds__(value)
-                           d = Date(value)
-                        except ValueError:
-                           print "Invalid date: " + value + " in row " + num + ". Replaced with 1990-01-01"
-                           d = Date('1990-01-01')
-                        date = datetime(d.year, d.month, d.day)
-                        cubeRow['dates'][fieldName] = date
-
-                        # Process distincts
-                        self.__addToDistincts__(distincts, fieldName, value)
-
-                    else:  # This is a string value
-                        # Treat value as dimension
-                        # Clean the value
-                        value = self.__cleanStringValue__(value)
-                        cubeRow['dimensions'][fieldName] = value
-
-                        # Process distincts
-                        self.__addToDistincts__(distincts, fieldName, value)
-
-                dimensionKey = ''
-                for dimension in sorted(cubeRow['dimensions']):
-                    dimensionKey += '#' + dimension + ":" + cubeRow['dimensions'][dimension]
-                for dateName in sorted(cubeRow['dates']):
-                    dimensionKey += '#' + dateName + ":" + str(cubeRow['dates'][dateName])[:10]
-                cubeRow['dimensionKey'] = dimensionKey
-
-                # Add this row to the list
-                cubeRows.append(cubeRow)
+    #
+    #  Create cube rows from csv
+    #
+    def createCubeRowsFromCsv(self, csvFilePath, sampleSize=100):
 
-            stats = self.getStats(cubeRows)
+        distincts = {}
+        cubeRows = list(self.__generateCubeRowsFromCsv__(csvFilePath, distincts, sampleSize))
+        statsAccumulator = self.__getStatsAccumulator__(cubeRows)
            
-        return {'cubeRows': cubeRows, 'distincts': distincts, 'stats': stats}
+        return {'cubeRows': cubeRows, 'distincts': distincts, 'stats': statsAccumulator.getStats(), 'statsAccumulator': statsAccumulator}
+
+    #
+    # Parallel workers connect with the client options, which are unknown for an injected client without host
+    #
+    def __checkWorkerClientOptions__(self):
+        if self.clientOptions == None:
+            raise ValueError("Parallel workers (workers) need host when the CubeService is given a client")
 
     #
     # Create a cube from csv file. Returns the new cube
     #
-    def createCubeFromCsv(self, csvFilePath, cubeName, inMemory=False):
-        result = self.createCubeRowsFromCsv(csvFilePath)
-        self.createCube('source', cubeName, result['cubeRows'], result['distincts'], result['stats'], None, None, inMemory)
+    # If batchSize is given, the csv is streamed into mongo batchSize rows at a time so that memory use
+    # does not grow with the size of the file. If workers is greater than 1, the file is split into byte
+    # ranges that are ingested in parallel by that many processes. Both are only available for persisted cubes.
+    # Field types are inferred from the first sampleSize rows of the file. indexes is an optional list of
+    # dimensions, dates or measures to index the cube rows on, in addition to the dimension key.
+    #
+    def createCubeFromCsv(self, csvFilePath, cubeName, inMemory=False, batchSize=None, sampleSize=100, workers=None, indexes=None):
+        if workers != None and workers > 1:
+            if inMemory:
+                raise ValueError("Parallel ingestion (workers) is not supported for in-memory cubes")
+            self.__checkWorkerClientOptions__()
+            if batchSize == None:
+                batchSize = 1000
+            return self.__createCubeFromCsvParallel__(csvFilePath, cubeName, workers, batchSize, sampleSize, indexes)
+
+        if batchSize != None:
+            if inMemory:
+                raise ValueError("Streaming ingestion (batchSize) is not supported for in-memory cubes")
+            return self.__createCubeFromCsvStreaming__(csvFilePath, cubeName, batchSize, sampleSize, indexes)
+
+        result = self.createCubeRowsFromCsv(csvFilePath, sampleSize)
+        self.createCube('source', cubeName, result['cubeRows'], result['distincts'], result['stats'], None, None, inMemory, indexes,
+                        result['statsAccumulator'])
+        return self.getCube(cubeName)
+
+    #
+    # Stream a csv file into a new persisted cube, batchSize rows at a time
+    #
+    def __createCubeFromCsvStreaming__(self, csvFilePath, cubeName, batchSize, sampleSize, indexes=None):
+        if batchSize < 1:
+            raise ValueError("batchSize must be at least 1")
+
+        distincts = {}
+        cubeRows = self.__generateCubeRowsFromCsv__(csvFilePath, distincts, sampleSize)
+        statsAccumulator = self.__insertCubeRowsInBatches__(cubeName, cubeRows, batchSize)
+
+        # The cube document is only written once all rows are in, so readers never see a partial cube
+        self.createCube('source', cubeName, [], distincts, statsAccumulator.getStats(), None, None, False, indexes, statsAccumulator)
         return self.getCube(cubeName)
 
+    #
+    # Insert cube rows batchSize at a time. Returns the stats accumulators for the inserted rows
+    #
+    def __insertCubeRowsInBatches__(self, cubeName, cubeRows, batchSize):
+        statsAccumulator = StatsAccumulator()
+        batch = []
+        for cubeRow in cubeRows:
+            batch.append(cubeRow)
+            if len(batch) == batchSize:
+                self.db[cubeName].insert_many(batch)
+                statsAccumulator.addCubeRows(batch)
+                batch = []
+        if len(batch) > 0:
+            self.db[cubeName].insert_many(batch)
+            statsAccumulator.addCubeRows(batch)
+        return statsAccumulator
+
+    #
+    # Ingest a csv file into a new persisted cube using a pool of worker processes.
+    #
+    # The data section of the file is split into newline aligned byte ranges. Each worker parses,
+    # converts and inserts one range and returns its distincts and stats accumulators, which are merged
+    # here. Row ids follow line order in the file, so they are unique and increase in file order.
+    # Quoted values spanning several lines are not supported in this mode.
+    #
+    def __createCubeFromCsvParallel__(self, csvFilePath, cubeName, workers, batchSize, sampleSize, indexes=None):
+        fields = self.__getFields__(csvFilePath, sampleSize)
+
+        with open(csvFilePath, 'rb') as csvfile:
+            csvfile.readline()  # Skip the header
+            dataStart = csvfile.tell()
+            csvfile.seek(0, 2)
+            fileSize = csvfile.tell()
+
+            offsets = [dataStart]
+            for i in range(1, workers):
+                offset = dataStart + (fileSize - dataStart) * i / workers
+                if offset <= offsets[-1]:
+                    continue
+                # Move the offset to the start of the next line
+                csvfile.seek(offset - 1)
+                csvfile.readline()
+                offset = csvfile.tell()
+                if offset > offsets[-1] and offset < fileSize:
+                    offsets.append(offset)
+        ranges = zip(offsets, offsets[1:] + [fileSize])
+
+        pool = Pool(min(workers, len(ranges)))
+        try:
+            # Count the rows in each range first so every worker knows the id of its first row
+            rowCounts = pool.map(__countCsvRangeRows__, [(csvFilePath, start, end) for start, end in ranges])
+            tasks = []
+            firstId = 1
+            for (start, end), rowCount in zip(ranges, rowCounts):
+                tasks.append((self.dbName, self.clientOptions, csvFilePath, cubeName, start, end, firstId, fields, batchSize))
+                firstId += rowCount
+            results = pool.map(__ingestCsvRange__, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        distincts = {}
+        statsAccumulator = StatsAccumulator()
+        for rangeDistincts, rangeStatsAccumulator in results:
+            self.__mergeDistincts__(distincts, rangeDistincts)
+            statsAccumulator.merge(rangeStatsAccumulator)
+        stats = statsAccumulator.getStats()
+
+        self.createCube('source', cubeName, [], distincts, stats, None, None, False, indexes, statsAccumulator)
+        return self.getCube(cubeName)
+
+    #
+    # Merge distinct value counts into existing distincts
+    #
+    def __mergeDistincts__(self, distincts, otherDistincts):
+        for fieldName, values in otherDistincts.items():
+            if fieldName not in distincts:
+                distincts[fieldName] = {}
+            field = distincts[fieldName]
+            for value, count in values.items():
+                field[value] = field.get(value, 0) + count
+
     #
     # Create a cube by applying a filter on another cube
     #
@@ -269,79 +630,373 @@ class CubeService:
     #
     # Returns cube
     #
-    def appendToCubeFromCsv(self, csvFilePath, cube):
+    def appendToCubeFromCsv(self, csvFilePath, cube, sampleSize=100):
         if cube == None:
             return
         cubeName = cube['name']
 
         inMemory = cubeName in self.inMemoryCubes
 
-        result = self.createCubeRowsFromCsv(csvFilePath)
-
-        # Adjust ids # TODO use max(id) from cube instead of numCurrentCubeRows
-        numCurrentCubeRows = self.__getCubeRowCount__(cubeName)
+        result = self.createCubeRowsFromCsv(csvFilePath, sampleSize)
 
+        # Allocate ids from the cube's max id counter
         cubeRows = result['cubeRows']
-        id = numCurrentCubeRows + 1
+        id = self.__allocateCubeRowIds__(cube, len(cubeRows))
         for cubeRow in cubeRows:
             cubeRow['id'] = id
             id += 1
 
         # Save the cube rows
-        if not inMemory:
+        if inMemory:
+            self.inMemoryCubeRows[cubeName].appendRows(cubeRows)
+        else:
             self.db[cubeName].insert_many(cubeRows)
 
         # Merge the distincts
         existingDistincts = cube['distincts']
-        dcs = result['distincts']
-        for dc in dcs:
-            if dc not in existingDistincts:
-                existingDistincts.append(dc)
+        self.__mergeDistincts__(existingDistincts, result['distincts'])
         cube['distincts'] = existingDistincts
-        if not inMemory:
-            self.__updateCubeProperty__(cubeName, { "$set": {"distincts" : existingDistincts}})
-
-        # Redo the stats
-        allCubeRows = self.getCubeRowsForCube(cubeName)
-        stats = self.getStats(allCubeRows)
-        cube['stats'] = stats
 
-        if not inMemory:
-            self.__updateCubeProperty__(cubeName, { "$set": {"stats" : stats}})
+        # Merge the stats of the new rows into the cube's stats state. Cubes without one get it built from
+        # all their rows, once.
+        statsAccumulator = self.__getCubeStatsAccumulator__(cube)
+        if statsAccumulator != None:
+            statsAccumulator.merge(result['statsAccumulator'])
+            # In-memory cubes hold all their values, so their medians stay exact
+            if inMemory:
+                self.__setExactMedians__(statsAccumulator, self.inMemoryCubeRows[cubeName])
+        elif self.serverSideSummaries and not inMemory:
+            cube['stats'] = self.getStatsFromDb(cube)
+        else:
+            statsAccumulator = self.__getStatsAccumulator__(self.__getStoredCubeRows__(cubeName))
+        if statsAccumulator != None:
+            cube['stats'] = statsAccumulator.getStats()
+            self.__saveCubeStatsAccumulator__(cubeName, statsAccumulator)
+        self.__updateCubeProperty__(cubeName, { "$set": {"distincts" : existingDistincts, "stats" : cube['stats']}})
 
         return cube
 
     #
-    # Delete cube rows from a cube
+    # Allocate count new cube row ids from the cube's max id counter. Returns the first id. The counter of a
+    # persisted cube is incremented atomically in MongoDB, so concurrent appends get distinct ids.
+    #
+    def __allocateCubeRowIds__(self, cube, count):
+        cubeName = cube['name']
+        if cube.get('maxId') == None:
+            cube['maxId'] = self.getMaxCubeRowId(cube)
+            self.__updateCubeProperty__(cubeName, { "$max": {"maxId" : cube['maxId']}})
+        if cubeName in self.inMemoryCubes:
+            cube['maxId'] += count
+        else:
+            updatedCube = self.db['cube'].find_one_and_update({ "name": cubeName }, { "$inc": {"maxId" : count}},
+                                                              projection={ "maxId": 1 }, return_document=pymongo.ReturnDocument.AFTER)
+            cube['maxId'] = updatedCube['maxId']
+        return cube['maxId'] - count + 1
+
+    #
+    # Largest cube row id in use. Taken from the cube's counter, or from the cube rows for cubes without one.
     #
-    def deleteCubeRows(self, cubeName, filter):
+    def getMaxCubeRowId(self, cube):
+        if cube.get('maxId') != None:
+            return cube['maxId']
+        cubeName = cube['name']
+        if cubeName in self.inMemoryCubeRows:
+            ids = self.inMemoryCubeRows[cubeName].ids
+            return int(ids.max()) if len(ids) > 0 else 0
+        for cubeRow in self.db[cubeName].find({}, { "id": 1 }).sort("id", pymongo.DESCENDING).limit(1):
+            return cubeRow['id']
+        return 0
+
+    #
+    # The stats accumulator kept in a cube's stats state, or None if the cube has none.
+    #
+    # The state holds a quantile sketch per measure, so it is kept apart from the cube document, in the
+    # cubeStatsState collection: getCube does not load it, and it does not count towards the size limit of the
+    # cube document. Only appending, deleting and getCubeStats read it.
+    #
+    def __getCubeStatsAccumulator__(self, cube):
+        cubeName = cube['name']
+        if cubeName in self.inMemoryCubes:
+            state = self.inMemoryStatsStates.get(cubeName)
+        else:
+            stateDoc = self.db['cubeStatsState'].find_one({ "name": cubeName })
+            state = stateDoc['state'] if stateDoc != None else None
+        if state == None:
+            return None
+        statsAccumulator = StatsAccumulator()
+        statsAccumulator.setState(state)
+        return statsAccumulator
+
+    def __saveCubeStatsAccumulator__(self, cubeName, statsAccumulator):
+        state = statsAccumulator.getState()
+        if cubeName in self.inMemoryCubes:
+            self.inMemoryStatsStates[cubeName] = state
+        else:
+            self.db['cubeStatsState'].replace_one({ "name": cubeName }, { "name": cubeName, "state": state }, upsert=True)
+
+    def __deleteCubeStatsState__(self, cubeName, inMemory=False):
+        if inMemory:
+            self.inMemoryStatsStates.pop(cubeName, None)
+        else:
+            self.db['cubeStatsState'].delete_many({ "name": cubeName })
+
+    #
+    # Delete cube rows from a cube. Only the rows matched by the filter are read: their values are taken out of
+    # the distinct counts and the stats state before they are deleted. Where a deleted value was the min or max,
+    # the bound is found again inside MongoDB, and the medians of the measures affected are rebuilt from the rows
+    # that are left before the stats are saved. Cubes without a stats state are summarized again from the rows
+    # that are left, once.
+    #
+    def deleteCubeRows(self, cubeName, filter, batchSize=1000):
         cube = self.getCube(cubeName)
         if (cube == None):
             raise ValueError("Cube does not exist:" + cubeName)
 
+        statsAccumulator = self.__getCubeStatsAccumulator__(cube)
+        if statsAccumulator == None:
+            self.db[cubeName].remove(filter)
+            self.__resummarizeCube__(cube)
+            return
+
+        distincts = cube['distincts']
+        dateKeys = {}
+        cubeRows = self.db[cubeName].find(filter, { "dimensions": 1, "dates": 1, "measures": 1 })
+        while True:
+            batch = list(islice(cubeRows, batchSize))
+            if len(batch) == 0:
+                break
+            for row in batch:
+                for k, v in row['dates'].items():
+                    self.__removeFromDistincts__(distincts, k, self.__getDateDistinctKey__(distincts, dateKeys, k, v))
+                for k, v in row['dimensions'].items():
+                    self.__removeFromDistincts__(distincts, k, v)
+            statsAccumulator.removeCubeRows(batch)
+
         self.db[cubeName].remove(filter)
 
-        allCubeRows = self.getCubeRowsForCube(cubeName)
+        staleBoundsMeasureNames = statsAccumulator.getStaleBoundsMeasureNames()
+        if len(staleBoundsMeasureNames) > 0:
+            bounds = self.__getBoundsFromDb__(cubeName, staleBoundsMeasureNames)
+            for measureName in staleBoundsMeasureNames:
+                statsAccumulator.setBounds(measureName, *bounds[measureName])
+        self.__rebuildStaleMedians__(cube, statsAccumulator)
 
-        # Redo distincts
+        cube['stats'] = statsAccumulator.getStats()
+        self.__saveCubeStatsAccumulator__(cubeName, statsAccumulator)
+        self.__updateCubeProperty__(cubeName, { "$set": {"distincts" : distincts, "stats" : cube['stats']}})
+
+    #
+    # Rebuild the distincts and stats of a persisted cube from all of its rows
+    #
+    def __resummarizeCube__(self, cube):
+        cubeName = cube['name']
+        if self.serverSideSummaries:
+            cube['distincts'] = self.getDistinctsFromDb(cube)
+            cube['stats'] = self.getStatsFromDb(cube)
+            self.__updateCubeProperty__(cubeName, { "$set": {"distincts" : cube['distincts'], "stats" : cube['stats']}})
+            return
+
+        # Distincts and stats in a single pass over the rows
         distincts =  {}
-        for row in allCubeRows:
-            for k, v in row['dates'].items():
-                self.__addToDistincts__(distincts, k, str(v))
-            for k, v in row['dimensions'].items():
-                self.__addToDistincts__(distincts, k, v)
+        existingDistincts = cube.get('distincts') or {}
+        dateKeys = {}
+        statsAccumulator = StatsAccumulator()
+        cubeRows = self.__getStoredCubeRows__(cubeName)
+        while True:
+            batch = list(islice(cubeRows, 10000))
+            if len(batch) == 0:
+                break
+            for row in batch:
+                for k, v in row['dates'].items():
+                    self.__addToDistincts__(distincts, k, self.__getDateDistinctKey__(existingDistincts, dateKeys, k, v))
+                for k, v in row['dimensions'].items():
+                    self.__addToDistincts__(distincts, k, v)
+            statsAccumulator.addCubeRows(batch)
 
         cube['distincts'] = distincts
-        self.db['cube'].update_one({ "name" : cubeName}, { '$set' : { "distincts" : distincts}})
+        cube['stats'] = statsAccumulator.getStats()
+        self.__saveCubeStatsAccumulator__(cubeName, statsAccumulator)
+        self.__updateCubeProperty__(cubeName, { "$set": {"distincts" : distincts, "stats" : cube['stats']}})
+
+    #
+    # Decrement the count of a distinct value, dropping values (and fields) that have no rows left
+    #
+    def __removeFromDistincts__(self, distincts, fieldName, value):
+        field = distincts.get(fieldName)
+        if field == None or value not in field:
+            return
+        field[value] -= 1
+        if field[value] <= 0:
+            del(field[value])
+            if len(field) == 0:
+                del(distincts[fieldName])
+
+    #
+    # The distincts of a date are keyed by the date as it was read from the CSV file. Find the key of a stored
+    # date among the cube's distincts by parsing the keys of its field, once per field. Dates the distincts do not
+    # have yet are keyed as YYYY-MM-DD.
+    #
+    def __getDateDistinctKey__(self, distincts, dateKeys, fieldName, value):
+        key = str(value)
+        field = distincts.get(fieldName, {})
+        if key in field:
+            return key
+        if isinstance(value, datetime):
+            key = key[:10]
+        if fieldName not in dateKeys:
+            parseDate = self.__getDateParser__(None)
+            dateKeys[fieldName] = {}
+            for fieldKey in field:
+                try:
+                    dateKeys[fieldName][parseDate(fieldKey)] = fieldKey
+                except Exception:
+                    pass
+        return dateKeys[fieldName].get(value, key)
+
+    #
+    # Min and max of some measures of a persisted cube, computed with a single $group
+    #
+    def __getBoundsFromDb__(self, cubeName, measureNames):
+        group = { "_id": None }
+        for i, measureName in enumerate(measureNames):
+            group['min' + str(i)] = { "$min": "$measures." + measureName }
+            group['max' + str(i)] = { "$max": "$measures." + measureName }
+        results = list(self.db[cubeName].aggregate([{ "$group": group }], allowDiskUse=True))
+        bounds = {}
+        for i, measureName in enumerate(measureNames):
+            if len(results) > 0:
+                bounds[measureName] = (results[0]['min' + str(i)], results[0]['max' + str(i)])
+            else:
+                bounds[measureName] = (float('inf'), float('-inf'))
+        return bounds
+
+    #
+    # Stats of a cube, with the medians of measures that had values removed rebuilt first
+    #
+    def getCubeStats(self, cube):
+        statsAccumulator = self.__getCubeStatsAccumulator__(cube)
+        if statsAccumulator == None or len(statsAccumulator.getStaleMeasureNames()) == 0:
+            return cube['stats']
+
+        cubeName = cube['name']
+        self.__rebuildStaleMedians__(cube, statsAccumulator)
+        cube['stats'] = statsAccumulator.getStats()
+        self.__saveCubeStatsAccumulator__(cubeName, statsAccumulator)
+        self.__updateCubeProperty__(cubeName, { "$set": {"stats" : cube['stats']}})
+        return cube['stats']
+
+    #
+    # Rebuild the medians of measures that had values removed. Only those measures are read, or with
+    # serverSideSummaries their medians are found inside MongoDB.
+    #
+    def __rebuildStaleMedians__(self, cube, statsAccumulator):
+        staleMeasureNames = statsAccumulator.getStaleMeasureNames()
+        if len(staleMeasureNames) == 0:
+            return
+
+        cubeName = cube['name']
+        if cubeName in self.inMemoryCubeRows:
+            statsAccumulator.replaceMeasures(staleMeasureNames, self.__getStatsAccumulator__(self.inMemoryCubeRows[cubeName]))
+        elif self.serverSideSummaries:
+            stats = self.getStatsFromDb(cube, staleMeasureNames)
+            for measureName in staleMeasureNames:
+                if measureName in stats:
+                    statsAccumulator.setMedian(measureName, stats[measureName]['median'])
+        else:
+            projection = dict(("measures." + name, 1) for name in staleMeasureNames)
+            statsAccumulator.replaceMeasures(staleMeasureNames, self.__getStatsAccumulator__(self.db[cubeName].find({}, projection)))
 
-        # Redo stats
-        stats = self.getStats(allCubeRows)
-        self.__updateCubeProperty__(cubeName, { "$set": {"stats" : stats}})
+    #
+    # Compute the stats of a persisted cube inside MongoDB. A single $facet groups each measure into its count,
+    # total, min, max and sums of powers, and the median is found with a sorted $skip/$limit per measure, so
+    # only the summaries cross the network. The sums of squares are taken around the mean of the cube's stored
+    # stats, which keeps the variance numerically stable.
+    #
+    def getStatsFromDb(self, cube, measureNames=None):
+        cubeName = cube['name']
+        storedStats = cube.get('stats') or {}
+        if measureNames == None:
+            measureNames = sorted(self.__getFieldNamesFromDb__(cubeName, 'measures') | set(storedStats))
+        if len(measureNames) == 0:
+            return {}
+
+        facets = {}
+        for i, measureName in enumerate(measureNames):
+            field = '$measures.' + measureName
+            shift = storedStats.get(measureName, {}).get('mean', 0.0)
+            deviation = { "$subtract": [field, shift] }
+            facets['m' + str(i)] = [{ "$match": { "measures." + measureName: { "$exists": True }}},
+                                    { "$group": { "_id": None, "count": { "$sum": 1 }, "total": { "$sum": field },
+                                                  "min": { "$min": field }, "max": { "$max": field },
+                                                  "sum1": { "$sum": deviation },
+                                                  "sum2": { "$sum": { "$multiply": [deviation, deviation] }}}}]
+        result = list(self.db[cubeName].aggregate([{ "$facet": facets }], allowDiskUse=True))[0]
+
+        stats = {}
+        for i, measureName in enumerate(measureNames):
+            groups = result['m' + str(i)]
+            if len(groups) == 0 or groups[0]['count'] == 0:
+                continue
+            group = groups[0]
+            count = group['count']
+            variance = group['sum2'] / count - (group['sum1'] / count) ** 2
+            stats[measureName] = {"total": group['total'],
+                                  "mean": group['total'] / count,
+                                  "median": self.__getMedianFromDb__(cubeName, measureName, count),
+                                  "std": math.sqrt(max(variance, 0.0)),
+                                  "min": group['min'],
+                                  "max": group['max']}
+        return stats
+
+    def __getMedianFromDb__(self, cubeName, measureName, count):
+        field = 'measures.' + measureName
+        pipeline = [{ "$match": { field: { "$exists": True }}},
+                    { "$sort": { field: pymongo.ASCENDING }},
+                    { "$skip": (count - 1) / 2 },
+                    { "$limit": 2 - count % 2 },
+                    { "$project": { "_id": 0, "value": "$" + field }}]
+        values = [doc['value'] for doc in self.db[cubeName].aggregate(pipeline, allowDiskUse=True)]
+        return float(np.mean(values))
 
     #
-    # Create cube
+    # Compute the distincts of a persisted cube inside MongoDB, with one $group per dimension and date. Dates
+    # are keyed as in the cube's distincts, that is as read from the CSV file.
     #
-    def createCube(self, type, cubeName, cubeRows, distincts, stats, binnings, agg, inMemory=False):
+    def getDistinctsFromDb(self, cube):
+        cubeName = cube['name']
+        distincts = {}
+        existingDistincts = cube.get('distincts') or {}
+        dateKeys = {}
+        for section in ['dates', 'dimensions']:
+            for fieldName in self.__getFieldNamesFromDb__(cubeName, section):
+                values = {}
+                pipeline = [{ "$group": { "_id": "$" + section + "." + fieldName, "count": { "$sum": 1 }}}]
+                for group in self.db[cubeName].aggregate(pipeline, allowDiskUse=True):
+                    if group['_id'] is None:
+                        continue
+                    value = group['_id']
+                    if section == 'dates':
+                        value = self.__getDateDistinctKey__(existingDistincts, dateKeys, fieldName, value)
+                    values[value] = values.get(value, 0) + group['count']
+                if len(values) > 0:
+                    distincts[fieldName] = values
+        return distincts
+
+    #
+    # Names of the measures, dimensions or dates of a persisted cube, from one of its rows
+    #
+    def __getFieldNamesFromDb__(self, cubeName, section):
+        cubeRow = self.db[cubeName].find_one({}, { section: 1 })
+        if cubeRow == None:
+            return set()
+        return set(cubeRow.get(section, {}).keys())
+
+    #
+    # Create cube.
+    # statsAccumulator holds the stats of the cube rows, if known. Its state is stored on the cube so that rows can
+    # be appended later without reading the existing ones.
+    #
+    def createCube(self, type, cubeName, cubeRows, distincts, stats, binnings, agg, inMemory=False, indexes=None, statsAccumulator=None):
 
         cube = {}
         cube['type'] = type
@@ -350,6 +1005,7 @@ class CubeService:
         cube['stats'] = stats
         cube['binnings'] = binnings
         cube['agg'] = agg
+        cube['indexes'] = indexes if indexes != None else []
         cube['createdOn'] = datetime.utcnow()
 
         # TODO make sure cubeName is unique
@@ -358,12 +1014,135 @@ class CubeService:
         #    raise RuntimeError('createCube failed. Cube already exists: ' + cubeName)
 
         if inMemory:
+            # In-memory cube rows are held in columnar form
+            if not isinstance(cubeRows, ColumnarCube):
+                keyOrder = None
+                if agg != None:
+                    keyOrder = agg['dimensions']
+                columnarCube = ColumnarCube(keyOrder)
+                columnarCube.appendRows(cubeRows)
+                cubeRows = columnarCube
+            cube['maxId'] = int(cubeRows.ids.max()) if len(cubeRows) > 0 else 0
             self.inMemoryCubes[cubeName] = cube 
             self.inMemoryCubeRows[cubeName] = cubeRows
         else:   
+            if len(cubeRows) > 0:
+                cube['maxId'] = max(cubeRow['id'] for cubeRow in cubeRows)
+            else:
+                # The rows may have been inserted already, by streaming or parallel ingestion
+                cube['maxId'] = self.getMaxCubeRowId(cube)
             self.db['cube'].insert_one(cube)
-            # Save the cube rows
-            self.db[cubeName].insert_many(cubeRows)
+            # Save the cube rows, then index them
+            if len(cubeRows) > 0:
+                self.db[cubeName].insert_many(cubeRows)
+            self.__createCubeIndexes__(cubeName, cube['indexes'])
+
+        # Replace any stats state left by an earlier cube of the same name
+        if statsAccumulator != None:
+            self.__saveCubeStatsAccumulator__(cubeName, statsAccumulator)
+        else:
+            self.__deleteCubeStatsState__(cubeName, inMemory)
+
+    #
+    # Index the cube rows on the dimension key and id, and on the given dimensions, dates or measures
+    #
+    def __createCubeIndexes__(self, cubeName, indexes):
+        for field in ['dimensionKey', 'id'] + list(indexes):
+            self.db[cubeName].create_index([(self.__getIndexKey__(cubeName, field), pymongo.ASCENDING)])
+
+    #
+    # Name of a new staging collection for the rows of a cube
+    #
+    def __getStagingCollectionName__(self, cubeName):
+        return cubeName + '_staging_' + str(ObjectId())
+
+    #
+    # Replace the rows of a persisted cube. writeRows(stagingName) writes the new rows to a staging collection,
+    # which is then indexed and renamed over the cube's row collection, so readers see either the old rows or
+    # the new rows, never an empty or partly written cube. If anything fails before the rename the staging
+    # collection is dropped. Returns the result of writeRows.
+    #
+    def __replaceCubeRows__(self, cubeName, indexes, writeRows):
+        stagingName = self.__getStagingCollectionName__(cubeName)
+        try:
+            result = writeRows(stagingName)
+            # Indexing also creates the staging collection if there are no rows
+            self.__createCubeIndexes__(stagingName, indexes)
+            self.db[stagingName].rename(cubeName, dropTarget=True)
+        except Exception:
+            self.db[stagingName].drop()
+            raise
+        return result
+
+    #
+    # Replace an existing persisted agg cube's rows and definition, or create the agg cube
+    #
+    def __replaceAggCube__(self, aggCubeName, existingAggCube, aggCubeRows, distincts, stats, agg, inMemory):
+        if existingAggCube != None and not inMemory and aggCubeName not in self.inMemoryCubes:
+            def writeAggCubeRows(stagingName):
+                if len(aggCubeRows) > 0:
+                    self.db[stagingName].insert_many(aggCubeRows)
+            self.__replaceCubeRows__(aggCubeName, existingAggCube.get('indexes') or [], writeAggCubeRows)
+            self.__updateCubeProperty__(aggCubeName, { "$set": {"distincts" : distincts, "stats" : stats, "agg" : agg,
+                                                                "createdOn" : datetime.utcnow()}})
+        else:
+            if existingAggCube != None:
+                self.deleteCube(aggCubeName)
+            self.createCube('agg', aggCubeName, aggCubeRows, distincts, stats, None, agg, inMemory)
+
+    #
+    # Get the cube row key to index for a field
+    #
+    def __getIndexKey__(self, cubeName, field):
+        if field == 'dimensionKey' or field == 'id':
+            return field
+        cubeRow = self.db[cubeName].find_one()
+        if cubeRow != None:
+            for section in ['dimensions', 'dates', 'measures']:
+                if field in cubeRow[section]:
+                    return section + '.' + field
+        raise ValueError("Cube " + cubeName + " has no field " + field)
+
+    #
+    # List the fields the cube rows are indexed on
+    #
+    def listCubeIndexes(self, cube):
+        if cube == None or cube['name'] in self.inMemoryCubes:
+            return []
+        fields = []
+        for indexInfo in self.db[cube['name']].index_information().values():
+            key = indexInfo['key'][0][0]
+            if key != '_id':
+                fields.append(key.split('.', 1)[-1])
+        return sorted(fields)
+
+    #
+    # Index the cube rows on a dimension, date or measure
+    #
+    def addCubeIndex(self, cube, field):
+        if cube == None or cube['name'] in self.inMemoryCubes:
+            return
+        cubeName = cube['name']
+        self.db[cubeName].create_index([(self.__getIndexKey__(cubeName, field), pymongo.ASCENDING)])
+        indexes = cube.get('indexes') or []
+        if field not in indexes:
+            indexes.append(field)
+        cube['indexes'] = indexes
+        self.__updateCubeProperty__(cubeName, { "$set": {"indexes" : indexes}})
+
+    #
+    # Drop the index of the cube rows on a field
+    #
+    def dropCubeIndex(self, cube, field):
+        if cube == None or cube['name'] in self.inMemoryCubes:
+            return
+        cubeName = cube['name']
+        self.db[cubeName].drop_index([(self.__getIndexKey__(cubeName, field), pymongo.ASCENDING)])
+        indexes = cube.get('indexes') or []
+        if field in indexes:
+            indexes.remove(field)
+        cube['indexes'] = indexes
+        self.__updateCubeProperty__(cubeName, { "$set": {"indexes" : indexes}})
 
     #
     # Delete cube
@@ -372,9 +1151,11 @@ class CubeService:
         if cubeName in self.inMemoryCubes:
             del(self.inMemoryCubes[cubeName])
             del(self.inMemoryCubeRows[cubeName])
+            self.__deleteCubeStatsState__(cubeName, True)
         else:
             self.db[cubeName].drop()
             self.db['cube'].remove({ "name": cubeName })
+            self.__deleteCubeStatsState__(cubeName)
 
 
     #
@@ -409,18 +1190,312 @@ class CubeService:
         if cube == None:
             return []
         cubeName = cube['name']
-        return self.db[cubeName].find(filter)
+        cubeRows = self.db[cubeName].find(filter)
+        if cube.get('virtualColumns'):
+            return VirtualColumnCursor(self, cubeRows, cube['virtualColumns'])
+        return cubeRows
 
     #
-    #  Get all cube rows for a cubeName
+    #  Get all cube rows for a cubeName. Virtual columns are computed as the rows are read.
     #
     def getCubeRowsForCube(self, cubeName):
         if cubeName in self.inMemoryCubeRows:
-            return self.inMemoryCubeRows[cubeName]
+            cubeRows = self.inMemoryCubeRows[cubeName]
+            virtualColumns = self.inMemoryCubes[cubeName].get('virtualColumns')
+            if virtualColumns:
+                cubeRows = cubeRows.copy()
+                self.__computeColumns__(cubeRows, cubeRows, virtualColumns, self.__getColumnExpressions__(virtualColumns))
+            return cubeRows
         else:
             cube = self.getCube(cubeName)
             return self.queryCubeRows(cube, {}).sort("dimensionKey", pymongo.ASCENDING)
 
+    #
+    # Query a cube: slice and dice its rows, and optionally roll them up.
+    #
+    # filters maps dimensions to a value, or to a list of values to match any of. dateRanges maps dates to a
+    # { "min": ..., "max": ... } range, given as datetimes or date strings; both ends are optional and inclusive.
+    # groupBy is a list of dimensions and dates to group on, and measures a list of output measures, such as
+    # { "name": "TotalQty", "measure": "Qty", "aggOperator": "sum" }. The operators are sum, avg, min, max and
+    # count, which counts the rows of each group. orderBy is a list of fields, or of (field, pymongo.ASCENDING
+    # or pymongo.DESCENDING) pairs, and limit caps the number of results.
+    #
+    # Without groupBy or measures the matching cube rows are returned. Otherwise there is one result row per
+    # group, with the group's values (dates as YYYY-MM-DD) under 'dimensions' and the output measures under
+    # 'measures'. Groups are ordered by their values unless orderBy is given.
+    #
+    # Persisted cubes are queried inside MongoDB, so filters can use the cube's indexes. In-memory cubes are
+    # queried with vectorized scans of their columns. Queries on the virtual columns of a persisted cube read
+    # the rows matching the other filters and are finished in memory.
+    #
+    def queryCube(self, cube, filters=None, dateRanges=None, groupBy=None, measures=None, orderBy=None, limit=None):
+        if cube == None:
+            return []
+        query = self.__getQuery__(filters, dateRanges, groupBy, measures, orderBy, limit)
+        cubeName = cube['name']
+        if cubeName in self.inMemoryCubes:
+            return self.__queryColumnarCube__(self.getCubeRowsForCube(cubeName), query)
+
+        virtualColumnNames = set(column['name'] for column in cube.get('virtualColumns') or [])
+        if len(virtualColumnNames & query['fields']) == 0:
+            return self.__queryDb__(cube, query)
+
+        columnarCube = ColumnarCube()
+        columnarCube.appendRows(self.queryCubeRows(cube, self.__getQueryDbFilter__(query, virtualColumnNames)))
+        return self.__queryColumnarCube__(columnarCube, query)
+
+    #
+    # Check and normalize the arguments of queryCube
+    #
+    def __getQuery__(self, filters, dateRanges, groupBy, measures, orderBy, limit):
+        parseDate = self.__getDateParser__(None)
+        query = { 'filters': {}, 'dateRanges': {}, 'groupBy': list(groupBy or []), 'measures': list(measures or []),
+                  'orderBy': [], 'limit': limit }
+        for name, values in (filters or {}).items():
+            query['filters'][name] = list(values) if isinstance(values, (list, tuple, set)) else [values]
+        for name, dateRange in (dateRanges or {}).items():
+            bounds = []
+            for bound in ['min', 'max']:
+                value = dateRange.get(bound)
+                if value != None and not isinstance(value, datetime):
+                    value = parseDate(value)
+                bounds.append(value)
+            query['dateRanges'][name] = tuple(bounds)
+        for measure in query['measures']:
+            if measure.get('aggOperator') not in ['sum', 'avg', 'min', 'max', 'count']:
+                raise ValueError("Unknown aggOperator for query measure " + str(measure.get('name')) + ": " + str(measure.get('aggOperator')))
+            if measure['aggOperator'] != 'count' and measure.get('measure') == None:
+                raise ValueError("Query measure " + str(measure.get('name')) + " has no measure")
+        for field in orderBy or []:
+            if isinstance(field, (list, tuple)):
+                query['orderBy'].append((field[0], field[1]))
+            else:
+                query['orderBy'].append((field, pymongo.ASCENDING))
+
+        query['grouped'] = len(query['groupBy']) > 0 or len(query['measures']) > 0
+        outputNames = set(query['groupBy']) | set(measure['name'] for measure in query['measures'])
+        for field, direction in query['orderBy']:
+            if query['grouped'] and field not in outputNames:
+                raise ValueError("Cannot order query results by " + field + ": it is neither grouped on nor an output measure")
+        if limit != None and limit < 0:
+            raise ValueError("limit must not be negative")
+
+        # The cube fields the query reads
+        query['fields'] = set(query['filters']) | set(query['dateRanges']) | set(query['groupBy'])
+        query['fields'].update(measure['measure'] for measure in query['measures'] if measure.get('measure') != None)
+        if not query['grouped']:
+            query['fields'].update(field for field, direction in query['orderBy'])
+        return query
+
+    def __getQueryDbFilter__(self, query, skippedNames=set()):
+        dbFilter = {}
+        for name, values in query['filters'].items():
+            if name not in skippedNames:
+                dbFilter['dimensions.' + name] = values[0] if len(values) == 1 else { "$in": values }
+        for name, (minDate, maxDate) in query['dateRanges'].items():
+            if name in skippedNames:
+                continue
+            condition = {}
+            if minDate != None:
+                condition['$gte'] = minDate
+            if maxDate != None:
+                condition['$lte'] = maxDate
+            if len(condition) > 0:
+                dbFilter['dates.' + name] = condition
+        return dbFilter
+
+    #
+    # Run a query on a persisted cube inside MongoDB: a find for cube rows, or a $match/$group pipeline
+    #
+    def __queryDb__(self, cube, query):
+        cubeName = cube['name']
+        # Fields are looked up on a cube row, so an empty cube has none to order or group by
+        if self.db[cubeName].find_one({}, { "_id": 1 }) == None:
+            return []
+        dbFilter = self.__getQueryDbFilter__(query)
+        if not query['grouped']:
+            cubeRows = self.queryCubeRows(cube, dbFilter)
+            if len(query['orderBy']) > 0:
+                cubeRows = cubeRows.sort([(self.__getIndexKey__(cubeName, field), direction) for field, direction in query['orderBy']])
+            if query['limit'] != None:
+                if query['limit'] == 0:
+                    return []
+                cubeRows = cubeRows.limit(query['limit'])
+            return list(cubeRows)
+
+        groupKeys = {}
+        for field in query['groupBy']:
+            groupKeys[field] = '$' + self.__getIndexKey__(cubeName, field)
+        group = { "_id": groupKeys if len(groupKeys) > 0 else None }
+        operators = { 'sum': '$sum', 'avg': '$avg', 'min': '$min', 'max': '$max' }
+        for measure in query['measures']:
+            if measure['aggOperator'] == 'count':
+                group[measure['name']] = { "$sum": 1 }
+            else:
+                group[measure['name']] = { operators[measure['aggOperator']]: '$measures.' + measure['measure'] }
+
+        measureNames = set(measure['name'] for measure in query['measures'])
+        orderBy = query['orderBy'] or [(field, pymongo.ASCENDING) for field in query['groupBy']]
+        sort = SON((field if field in measureNames else '_id.' + field, direction) for field, direction in orderBy)
+        pipeline = [{ "$match": dbFilter }, { "$group": group }]
+        if len(sort) > 0:
+            pipeline.append({ "$sort": sort })
+        if query['limit'] != None:
+            if query['limit'] == 0:
+                return []
+            pipeline.append({ "$limit": query['limit'] })
+
+        results = []
+        for doc in self.db[cubeName].aggregate(pipeline, allowDiskUse=True):
+            dimensions = {}
+            for field in query['groupBy']:
+                value = doc['_id'].get(field)
+                if value == None:
+                    value = ''
+                elif isinstance(value, datetime):
+                    value = str(value)[:10]
+                dimensions[field] = value
+            measures = dict((measure['name'], doc.get(measure['name'])) for measure in query['measures'])
+            results.append(self.__getQueryResultRow__(query, dimensions, measures))
+        return results
+
+    def __getQueryResultRow__(self, query, dimensions, measures):
+        dimensionKey = ''
+        for field in query['groupBy']:
+            dimensionKey += '#' + field + ':' + dimensions[field]
+        return { 'dimensionKey': dimensionKey, 'dimensions': dimensions, 'measures': measures }
+
+    #
+    # Run a query on a columnar cube. Filters become boolean masks over the code and date arrays, and groups are
+    # rolled up with bincount and ufunc.at.
+    #
+    def __queryColumnarCube__(self, columnarCube, query):
+        mask = np.ones(len(columnarCube), dtype=bool)
+        for name, values in query['filters'].items():
+            if name not in columnarCube.dimensions:
+                mask[:] = False
+                continue
+            codes, dimensionValues = columnarCube.getDimension(name)
+            valueSet = set(values)
+            mask &= np.in1d(codes, [code for code, value in enumerate(dimensionValues) if value in valueSet])
+        for name, (minDate, maxDate) in query['dateRanges'].items():
+            if name not in columnarCube.dates:
+                mask[:] = False
+                continue
+            dates = columnarCube.getDate(name)
+            inRange = ~np.isnat(dates)
+            if minDate != None:
+                inRange[inRange] &= dates[inRange] >= np.datetime64(minDate)
+            if maxDate != None:
+                inRange[inRange] &= dates[inRange] <= np.datetime64(maxDate)
+            mask &= inRange
+        selected = columnarCube.take(np.nonzero(mask)[0])
+
+        if not query['grouped']:
+            if len(query['orderBy']) > 0 and len(selected) > 0:
+                sortKeys = []
+                for field, direction in reversed(query['orderBy']):
+                    sortKey = self.__getColumnarSortKey__(selected, field)
+                    sortKeys.append(-sortKey if direction == pymongo.DESCENDING else sortKey)
+                selected = selected.take(np.lexsort(sortKeys))
+            if query['limit'] != None:
+                selected = selected.take(np.arange(min(query['limit'], len(selected))))
+            return list(selected)
+
+        if len(selected) == 0:
+            return []
+        for field in query['groupBy']:
+            if field not in selected.dimensions and field not in selected.dates:
+                raise ValueError("Cube has no field " + field)
+        dimensionCodes = dict((field, self.__getAggDimensionCodes__(selected, field)) for field in query['groupBy'])
+        groupCodes, groupDimensionCodes, groupKeys = self.__getAggGroups__(dimensionCodes, query['groupBy'], len(selected))
+        groupCount = len(groupKeys)
+
+        measureValues = {}
+        for measure in query['measures']:
+            operator = measure['aggOperator']
+            if operator == 'count':
+                measureValues[measure['name']] = np.bincount(groupCodes, minlength=groupCount).tolist()
+                continue
+            if measure['measure'] in selected.measures:
+                values = selected.getMeasure(measure['measure'])
+                missing = selected.getMissingMeasure(measure['measure'])
+                valid = ~missing if missing is not None else np.ones(len(selected), dtype=bool)
+            else:
+                values = np.zeros(len(selected))
+                valid = np.zeros(len(selected), dtype=bool)
+            codes = groupCodes[valid]
+            values = values[valid]
+            counts = np.bincount(codes, minlength=groupCount)
+            if operator == 'sum' or operator == 'avg':
+                result = np.bincount(codes, weights=values, minlength=groupCount)
+                if operator == 'avg':
+                    result = result / np.maximum(counts, 1)
+            elif operator == 'min':
+                result = np.full(groupCount, np.inf)
+                np.minimum.at(result, codes, values)
+            else:
+                result = np.full(groupCount, -np.inf)
+                np.maximum.at(result, codes, values)
+            result = result.tolist()
+            if operator != 'sum':
+                # As in MongoDB, groups without values have no average, min or max
+                result = [value if count > 0 else None for value, count in zip(result, counts.tolist())]
+            measureValues[measure['name']] = result
+
+        results = []
+        for i in range(groupCount):
+            dimensions = {}
+            for field in query['groupBy']:
+                codes, labels = groupDimensionCodes[field]
+                dimensions[field] = labels[codes[i]]
+            measures = dict((name, values[i]) for name, values in measureValues.items())
+            results.append(self.__getQueryResultRow__(query, dimensions, measures))
+
+        # There are few groups, so they are ordered in Python. Stable sorts, least significant field first.
+        measureNames = set(measure['name'] for measure in query['measures'])
+        orderBy = query['orderBy'] or [(field, pymongo.ASCENDING) for field in query['groupBy']]
+        for field, direction in reversed(orderBy):
+            section = 'measures' if field in measureNames else 'dimensions'
+            results.sort(key=lambda result: result[section][field], reverse=direction == pymongo.DESCENDING)
+        if query['limit'] != None:
+            results = results[:query['limit']]
+        return results
+
+    #
+    # A numeric array that sorts the rows of a columnar cube by a field. Dimensions sort by value, and rows
+    # without a value sort last.
+    #
+    def __getColumnarSortKey__(self, columnarCube, field):
+        if field == 'id':
+            return columnarCube.ids.astype(np.float64)
+        if field in columnarCube.measures:
+            values = columnarCube.getMeasure(field).copy()
+            missing = columnarCube.getMissingMeasure(field)
+            if missing is not None:
+                values[missing] = np.nan
+            return values
+        if field in columnarCube.dimensions:
+            codes, values = columnarCube.getDimension(field)
+            ranks = np.empty(len(values) + 1)
+            ranks[0] = np.nan
+            ranks[1:][np.argsort(np.array(values, dtype=object), kind='mergesort')] = np.arange(len(values))
+            return ranks[codes + 1]
+        if field in columnarCube.dates:
+            dates = columnarCube.getDate(field)
+            values = dates.astype(np.int64).astype(np.float64)
+            values[np.isnat(dates)] = np.nan
+            return values
+        raise ValueError("Cube has no field " + field)
+
+    #
+    # Get the cube rows as stored, without virtual columns
+    #
+    def __getStoredCubeRows__(self, cubeName):
+        if cubeName in self.inMemoryCubeRows:
+            return self.inMemoryCubeRows[cubeName]
+        return self.db[cubeName].find({})
+
     #
     #  Get all cube rows for a cube
     #
@@ -433,32 +1508,57 @@ class CubeService:
     #
     # Compute stats on cube
     #
-    def getStats(self, cubeRows):
+    def getStats(self, cubeRows, batchSize=10000):
+        return self.__getStatsAccumulator__(cubeRows, batchSize).getStats()
 
-        stats = {}
-        measureValues = {}
-        for row in cubeRows:
-            for k, v in row['measures'].items():
-                # print k,' -> ', v
-                if k not in stats:
-                    stats[k] = {"total": 0, "mean": 0, "median": 0, "std": 0, "min": 0, "max": 0}
-                if k not in measureValues:
-                    measureValues[k] = []
-                measureValues[k].append(v)
-
-                # measure = stats[k]
-                # measure["total"] += v
-
-        for k, v in measureValues.items():
-            varray = np.array(v)
-            stats[k]['total'] = np.sum(varray)
-            stats[k]['mean'] = np.mean(varray)
-            stats[k]['median'] = np.median(varray)
-            stats[k]['std'] = np.std(varray)
-            stats[k]['min'] = np.amin(varray)
-            stats[k]['max'] = np.amax(varray)
+    def __setExactMedians__(self, statsAccumulator, columnarCube):
+        for k in columnarCube.getMeasureNames():
+            values = self.__getMeasureValues__(columnarCube, k)
+            if len(values) > 0:
+                statsAccumulator.setMedian(k, float(np.median(values)))
 
-        return stats
+    def __getMeasureValues__(self, columnarCube, k):
+        varray = columnarCube.getMeasure(k)
+        missing = columnarCube.getMissingMeasure(k)
+        if missing is not None:
+            varray = varray[~missing]
+        return varray
+
+    #
+    # Accumulate the stats of cube rows in a single pass. Cube rows already held in memory, as a columnar cube
+    # or a list, get exact medians. The median sketches are only used for streamed rows.
+    #
+    def __getStatsAccumulator__(self, cubeRows, batchSize=10000):
+        statsAccumulator = StatsAccumulator()
+
+        # Columnar cubes already hold each measure as an array
+        if isinstance(cubeRows, ColumnarCube):
+            for k in cubeRows.getMeasureNames():
+                statsAccumulator.addValues(k, self.__getMeasureValues__(cubeRows, k))
+            self.__setExactMedians__(statsAccumulator, cubeRows)
+            return statsAccumulator
+
+        if isinstance(cubeRows, list):
+            measureValues = {}
+            for cubeRow in cubeRows:
+                for k, v in cubeRow['measures'].items():
+                    if k not in measureValues:
+                        measureValues[k] = []
+                    measureValues[k].append(v)
+            for k, values in measureValues.items():
+                values = np.asarray(values, dtype=np.float64)
+                statsAccumulator.addValues(k, values)
+                statsAccumulator.setMedian(k, float(np.median(values)))
+            return statsAccumulator
+
+        # Other cube rows, such as cursors, are streamed through a batch at a time
+        cubeRows = iter(cubeRows)
+        while True:
+            batch = list(islice(cubeRows, batchSize))
+            if len(batch) == 0:
+                break
+            statsAccumulator.addCubeRows(batch)
+        return statsAccumulator
 
     def __getNumericBinLabel__(self, v, nb):
         bins = nb['bins']
@@ -474,45 +1574,23 @@ class CubeService:
                 return bin['label']
         return sb['fallbackLabel']
 
-    # TODO Room for optimization here
     def __getDateBinLabel__(self, v, db):
-        d = Date(v)
-        if 'period' in db:
-           period = db['period']
-           zeroFill = ''
-           if period == 'weekly':
-               dt = datetime(d.year, d.month, d.day)
-               isoCalendar = dt.isocalendar()
-               yearNum = isoCalendar[0]
-               weekNum = isoCalendar[1]
-               if weekNum < 10:
-                   zeroFill = '0'
-               return str(yearNum) + zeroFill + str(weekNum)
-           elif period == 'monthly':
-               if d.month < 10:
-                   zeroFill = '0'
-               return str(d.year) + zeroFill + str(d.month)
-           elif period == 'yearly':
-               return str(d.year)
-           else:
-               return "Unknown"
-        else:
-           bins = db['bins']
-           for bin in bins:
-               minD = Date(bin['min'])
-               maxD = Date(bin['max'])
-               if d.year >= minD.year and d.month >= minD.month and d.day >= minD.day and d.year <= maxD.year and d.month <= maxD.month and d.day <= maxD.day:
-                 return bin['label']
-           return db['fallbackLabel']
+        return CompiledDateBinning(db, self.dateParser).getLabel(v)
 
     #
-    # Perform binning
+    # Perform binning. compiledBinnings are the binnings as compiled by compileBinnings, if already done.
     #  
-    def __performBinning__(self, binnings, cubeRow, distincts):
+    def __performBinning__(self, binnings, cubeRow, distincts, compiledBinnings=None):
+
+        if compiledBinnings == None:
+            compiledBinnings = compileBinnings(binnings, self.dateParser)
 
-        binnedCubeRow = deepcopy(cubeRow)
+        # The binned row shares the source row's measures, dates and ids; only the dimensions, which binning
+        # adds to, get a copy of their own
+        binnedCubeRow = dict(cubeRow)
+        binnedCubeRow['dimensions'] = dict(cubeRow['dimensions'])
 
-        for binning in binnings:
+        for binning, compiledBinning in zip(binnings, compiledBinnings):
 
             sourceField = binning['sourceField']
             outputField = binning['outputField']['name']
@@ -521,21 +1599,21 @@ class CubeService:
                 if sourceField not in cubeRow['measures']:
                     continue
                 value = cubeRow['measures'][sourceField]
-                label = self.__getNumericBinLabel__(value, binning)
+                label = compiledBinning.getLabel(value)
                 binnedCubeRow['dimensions'][outputField] = label
 
             elif binning['type'] == 'enum':
                 if sourceField not in cubeRow['dimensions']:
                     continue
                 value = cubeRow['dimensions'][sourceField]
-                label = self.__getStringBinLabel__(value, binning)
+                label = compiledBinning.getLabel(value)
                 binnedCubeRow['dimensions'][outputField] = label
 
             elif binning['type'] == 'date':
                 if sourceField not in cubeRow['dates']:
                     continue
                 value = cubeRow['dates'][sourceField]
-                label = self.__getDateBinLabel__(value, binning)
+                label = compiledBinning.getLabel(value)
                 binnedCubeRow['dimensions'][outputField] = label
 
         dimensionKey = ''
@@ -548,6 +1626,69 @@ class CubeService:
 
         return binnedCubeRow
 
+    #
+    # Bin a columnar (in-memory) cube. Each binning labels its whole source column at once, and the binned
+    # cube shares all other columns with the source cube.
+    #
+    def __binColumnarCube__(self, binnings, columnarCube, compiledBinnings):
+        binnedCube = columnarCube.copy()
+        binnedCube.keyOrder = None
+        binnedCube.dimensionKeys = None
+
+        for binning, compiledBinning in zip(binnings, compiledBinnings):
+
+            sourceField = binning['sourceField']
+            outputField = binning['outputField']['name']
+
+            if binning['type'] == 'range':
+                if sourceField not in columnarCube.measures:
+                    continue
+                codes = compiledBinning.getCodes(columnarCube.getMeasure(sourceField))
+                labels = compiledBinning.labels
+                missing = columnarCube.getMissingMeasure(sourceField)
+
+            elif binning['type'] == 'enum':
+                if sourceField not in columnarCube.dimensions:
+                    continue
+                sourceCodes, sourceValues = columnarCube.getDimension(sourceField)
+                codes = compiledBinning.getCodes(sourceCodes, sourceValues)
+                labels = compiledBinning.labels
+                missing = sourceCodes < 0
+
+            elif binning['type'] == 'date':
+                if sourceField not in columnarCube.dates:
+                    continue
+                codes = compiledBinning.getCodes(columnarCube.getDate(sourceField))
+                labels = compiledBinning.labels
+                missing = codes < 0
+
+            else:
+                continue
+
+            self.__setBinnedDimension__(binnedCube, outputField, labels, codes, missing)
+
+        return binnedCube
+
+    #
+    # Set a binned dimension on a columnar cube from label codes. Rows without a value for the binning's
+    # source field (missing) keep the value they already had for the dimension, if any.
+    #
+    def __setBinnedDimension__(self, binnedCube, outputField, labels, codes, missing):
+        codes = np.array(codes, dtype=np.int32)
+        labels = list(labels)
+        if missing is not None and missing.any():
+            codes[missing] = -1
+            if outputField in binnedCube.dimensions:
+                oldCodes, oldValues = binnedCube.getDimension(outputField)
+                labelCodes = dict((label, code) for code, label in enumerate(labels))
+                for value in oldValues:
+                    if value not in labelCodes:
+                        labelCodes[value] = len(labels)
+                        labels.append(value)
+                oldValueCodes = np.array([labelCodes[value] for value in oldValues] + [-1], dtype=np.int32)
+                codes[missing] = oldValueCodes[oldCodes[missing]]
+        binnedCube.setDimension(outputField, labels, codes)
+
     #
     # Determines if measure is date
     #
@@ -567,7 +1708,7 @@ class CubeService:
     def __generateBinnings__(self, sourceCubeName, measuresToBeBinned, hints):
         binnings = []
         cube = self.getCube(sourceCubeName)
-        stats = cube['stats']
+        stats = self.getCubeStats(cube)
         for measure in measuresToBeBinned:
             if self.__isMeasureDate__(sourceCubeName, measure):
                binning = {}
@@ -643,7 +1784,7 @@ class CubeService:
     #
     # Automatically bin a cube
     #
-    def binCube(self, sourceCube, binnedCubeName, measuresToBeBinned=None, hints={}):
+    def binCube(self, sourceCube, binnedCubeName, measuresToBeBinned=None, hints={}, workers=None):
         if sourceCube == None:
             return
 
@@ -652,12 +1793,12 @@ class CubeService:
             measuresToBeBinned = self.__getAllMeasuresForBinning__(sourceCubeName)
 
         binnings = self.__generateBinnings__(sourceCubeName, measuresToBeBinned, hints)
-        return self.binCubeCustom(binnings, sourceCube, binnedCubeName)
+        return self.binCubeCustom(binnings, sourceCube, binnedCubeName, workers)
 
     #
     # Automatically re-bin a cube
     #
-    def rebinCube(self, sourceCube, binnedCubeName):
+    def rebinCube(self, sourceCube, binnedCubeName, workers=None):
 
         if sourceCube == None:
             return None
@@ -677,23 +1818,39 @@ class CubeService:
             measuresToBeBinned = self.__getAllMeasuresForBinning__(sourceCubeName)
 
         binnings = self.__generateBinnings__(sourceCubeName, measuresToBeBinned, {})
-        return self.rebinCubeCustom(binnings, cube, binnedCubeName)
+        return self.rebinCubeCustom(binnings, cube, binnedCubeName, workers)
 
     #
     # Bin cube with custom binnings  - Returns the binned cube
     #
-    def binCubeCustom(self, binnings, sourceCube, binnedCubeName):
+    # If workers is greater than 1, the source cube rows are split into id ranges which are binned and
+    # inserted by a pool of worker processes. This is only supported for persisted cubes.
+    #
+    def binCubeCustom(self, binnings, sourceCube, binnedCubeName, workers=None):
         if sourceCube == None:
             return None
 
         sourceCubeName = sourceCube['name']
+        if workers != None and workers > 1:
+            if sourceCubeName in self.inMemoryCubes:
+                raise ValueError("Parallel binning (workers) is not supported for in-memory cubes")
+            self.__checkWorkerClientOptions__()
+            distincts, stats = self.__binCubeParallel__(binnings, sourceCubeName, binnedCubeName, workers)
+            self.createCube('binned', binnedCubeName, [], distincts, stats, binnings, None)
+            self.__updateCubeProperty__(binnedCubeName, { "$set": {"lastBinnedOn" : datetime.utcnow()}})
+            return self.getCube(binnedCubeName)
+
         binnedCubeRows = []
         cubeRows = self.getCubeRowsForCube(sourceCubeName)
+        compiledBinnings = compileBinnings(binnings, self.dateParser)
         distincts = {}
-        for cubeRow in cubeRows:
-            #print cubeRow
-            binnedCubeRow = self.__performBinning__(binnings, cubeRow, distincts)
-            binnedCubeRows.append(binnedCubeRow)
+        if isinstance(cubeRows, ColumnarCube):
+            binnedCubeRows = self.__binColumnarCube__(binnings, cubeRows, compiledBinnings)
+            distincts = binnedCubeRows.getDistincts()
+        else:
+            for cubeRow in cubeRows:
+                binnedCubeRow = self.__performBinning__(binnings, cubeRow, distincts, compiledBinnings)
+                binnedCubeRows.append(binnedCubeRow)
 
         stats = self.getStats(binnedCubeRows)
         inMemory = False
@@ -707,36 +1864,96 @@ class CubeService:
         return self.getCube(binnedCubeName)
 
     #
-    # Re-bin cube using custom binnings
+    # Re-bin cube using custom binnings. workers is as for binCubeCustom.
     #
-    def rebinCubeCustom(self, binnings, sourceCube, binnedCubeName):
+    def rebinCubeCustom(self, binnings, sourceCube, binnedCubeName, workers=None):
         if sourceCube == None:
             return None
 
         sourceCubeName = sourceCube['name']
-        binnedCubeRows = []
-        cubeRows = self.getCubeRowsForCube(sourceCubeName)
+        if workers != None and workers > 1:
+            if sourceCubeName in self.inMemoryCubes:
+                raise ValueError("Parallel binning (workers) is not supported for in-memory cubes")
+            self.__checkWorkerClientOptions__()
+
+        # The new cube rows are written to a staging collection and swapped in once complete
+        def writeBinnedCubeRows(stagingName):
+            if workers != None and workers > 1:
+                return self.__binCubeParallel__(binnings, sourceCubeName, stagingName, workers)
+            binnedCubeRows = []
+            cubeRows = self.getCubeRowsForCube(sourceCubeName)
+            compiledBinnings = compileBinnings(binnings, self.dateParser)
+            distincts = {}
+            for cubeRow in cubeRows:
+                binnedCubeRow = self.__performBinning__(binnings, cubeRow, distincts, compiledBinnings)
+                binnedCubeRows.append(binnedCubeRow)
+            stats = self.getStats(binnedCubeRows)
+            if len(binnedCubeRows) > 0:
+                self.db[stagingName].insert_many(binnedCubeRows)
+            return distincts, stats
+        indexes = self.getCube(binnedCubeName).get('indexes') or []
+        distincts, stats = self.__replaceCubeRows__(binnedCubeName, indexes, writeBinnedCubeRows)
+
+        # Update the binned cube
+        now = datetime.utcnow()
+        self.__updateCubeProperty__(binnedCubeName, { "$set": {"binningsUpdatedOn" : now, "lastBinnedOn" : now, "binnings" : binnings,
+                                                               "stats" : stats, "distincts" : distincts}})
+
+        return self.getCube(binnedCubeName)
+
+    #
+    # Bin the rows of a persisted source cube into the binned cube row collection using a pool of worker
+    # processes, each binning and inserting one range of row ids. Returns the merged distincts and stats.
+    #
+    def __binCubeParallel__(self, binnings, sourceCubeName, binnedCubeName, workers, batchSize=1000):
         distincts = {}
-        for cubeRow in cubeRows:
-            #print cubeRow
-            binnedCubeRow = self.__performBinning__(binnings, cubeRow, distincts)
-            binnedCubeRows.append(binnedCubeRow)
-        stats = self.getStats(binnedCubeRows)
+        statsAccumulator = StatsAccumulator()
+        first = self.db[sourceCubeName].find_one(sort=[("id", pymongo.ASCENDING)])
+        last = self.db[sourceCubeName].find_one(sort=[("id", pymongo.DESCENDING)])
+        if first != None:
+            start, end = first['id'], last['id'] + 1
+            bounds = sorted(set([start + (end - start) * i / workers for i in range(workers)] + [end]))
+            tasks = []
+            for rangeStart, rangeEnd in zip(bounds, bounds[1:]):
+                tasks.append((self.dbName, self.clientOptions, sourceCubeName, binnedCubeName, binnings, rangeStart, rangeEnd, batchSize))
+
+            pool = Pool(len(tasks))
+            try:
+                results = pool.map(__binCubeRange__, tasks)
+            finally:
+                pool.close()
+                pool.join()
 
-        # Drop old cube row collection
-        self.db[binnedCubeName].drop()
+            for rangeDistincts, rangeStatsAccumulator in results:
+                self.__mergeDistincts__(distincts, rangeDistincts)
+                statsAccumulator.merge(rangeStatsAccumulator)
+        stats = statsAccumulator.getStats()
+        return distincts, stats
 
-        # Recreate the new cube row collection
-        self.db[binnedCubeName].insert_many(binnedCubeRows)
+    #
+    # Bin cube rows newly added to a source cube and append them to its existing binned cube.
+    # Returns the new binned cube rows.
+    #
+    def appendToBinnedCube(self, binnedCube, sourceCube, sourceCubeRows):
+        if binnedCube == None or sourceCube == None:
+            return []
 
-        # Update the binned cube
-        self.__updateCubeProperty__(binnedCubeName, { "$set": {"binningsUpdatedOn" : datetime.utcnow()}})
-        self.__updateCubeProperty__(binnedCubeName, { "$set": {"lastBinnedOn" : datetime.utcnow()}})
-        self.__updateCubeProperty__(binnedCubeName, { "$set": {"binnings" : binnings}})
-        self.__updateCubeProperty__(binnedCubeName, { "$set": {"stats" : stats}})
-        self.__updateCubeProperty__(binnedCubeName, { "$set": {"distincts" : distincts}})
+        binnedCubeName = binnedCube['name']
+        distincts = binnedCube['distincts']
+        compiledBinnings = compileBinnings(binnedCube['binnings'], self.dateParser)
+        binnedCubeRows = []
+        for cubeRow in sourceCubeRows:
+            binnedCubeRows.append(self.__performBinning__(binnedCube['binnings'], cubeRow, distincts, compiledBinnings))
+        if len(binnedCubeRows) > 0:
+            self.db[binnedCubeName].insert_many(binnedCubeRows)
 
-        return self.getCube(binnedCubeName)
+        # Binning leaves the measures untouched, so the binned cube has the same stats as its source cube
+        stats = self.getCubeStats(sourceCube)
+        binnedCube['distincts'] = distincts
+        binnedCube['stats'] = stats
+        self.__updateCubeProperty__(binnedCubeName, { "$set": {"distincts" : distincts, "stats" : stats,
+                                                               "lastBinnedOn" : datetime.utcnow()}})
+        return binnedCubeRows
 
     #
     # Get agg name
@@ -859,7 +2076,7 @@ class CubeService:
         return False
 
     def __getExpressionValue__(self, dict, expression):
-        expressionValue = simple_eval(expression, names=dict)
+        expressionValue = compileExpression(expression).evaluate(dict)
         return expressionValue
 
     def __flatten__(self, cubeRow):
@@ -873,21 +2090,242 @@ class CubeService:
         return dict
 
     #
-    # Aggregate cube using custom aggregation definitions
+    # Aggregate cube using custom aggregation definitions. Persisted cube rows are read batchSize at a time, and
+    # the accumulators of each batch merged into those of the batches before.
     #
-    def aggregateCubeCustom(self, cube, aggs):
+    def aggregateCubeCustom(self, cube, aggs, batchSize=10000):
         if cube == None:
             return []
 
         cubeName = cube['name']
         cubeRows = self.getCubeRowsForCube(cubeName)
-        results = {}
         nameToAggMap = {}
+        for agg in aggs:
+            nameToAggMap[agg['name']] = agg
+
+        if isinstance(cubeRows, ColumnarCube):
+            results = self.__accumulateAggs__(cubeRows, aggs)
+        else:
+            results = {}
+            while True:
+                batch = list(islice(cubeRows, batchSize))
+                if len(batch) == 0:
+                    break
+                columnarCube = ColumnarCube()
+                columnarCube.appendRows(batch)
+                for aggName, batchResult in self.__accumulateAggs__(columnarCube, aggs).items():
+                    result = results.setdefault(aggName, {})
+                    for dimKey, outputFields in batchResult.items():
+                        if dimKey in result:
+                            self.__mergeAggAccums__(result[dimKey], outputFields)
+                        else:
+                            result[dimKey] = outputFields
+
+        # Now process results
+        resultCubes = []
+
+        for aggName in results:
+            result = results[aggName]
+            agg = nameToAggMap[aggName]
+
+            #print aggName
+
+            aggCubeRows = []
+            distincts = {}
+            aggCubeRowId = 0
+
+            for dimKey in result:
+                aggCubeRowId += 1
+                aggCubeRows.append(self.__getAggCubeRow__(agg, dimKey, result[dimKey], aggCubeRowId, distincts))
+
+            # Create the aggregated cube    
+            aggCubeName = cubeName + "_" + aggName
+            existingAggCube = self.getCube(aggCubeName)
+            stats = self.getStats(aggCubeRows)
+
+            inMemory = False
+            if cubeName in self.inMemoryCubes:
+                inMemory = True
+
+            # Does agg cube already exist? If so replace its rows and definition, otherwise create it
+            self.__replaceAggCube__(aggCubeName, existingAggCube, aggCubeRows, distincts, stats, agg, inMemory)
+            resultCubes.append(self.getCube(aggCubeName))
+    
+        return resultCubes        
+
+    #
+    # Fold newly binned cube rows into an existing agg cube. Only the groups the new rows fall into are
+    # touched: their accumulators are merged with the partial aggregates of the new rows. Agg cubes created
+    # without accumulators are re-aggregated from the binned cube instead.
+    #
+    def appendToAggCube(self, binnedCube, aggCube, binnedCubeRows):
+        if binnedCube == None or aggCube == None:
+            return None
+
+        aggCubeName = aggCube['name']
+        agg = aggCube['agg']
+        columnarCube = ColumnarCube()
+        columnarCube.appendRows(binnedCubeRows)
+        results = self.__accumulateAggs__(columnarCube, [agg])
+        result = results.get(agg['name'], {})
+        if len(result) == 0:
+            return aggCube
+
+        existingAggCubeRows = {}
+        for aggCubeRow in self.db[aggCubeName].find({ "dimensionKey": { "$in": result.keys() }}):
+            if 'accums' not in aggCubeRow:
+                return self.aggregateCubeCustom(binnedCube, [agg])[0]
+            existingAggCubeRows[aggCubeRow['dimensionKey']] = aggCubeRow
+
+        aggCubeRowId = 0
+        for aggCubeRow in self.db[aggCubeName].find({}, { "id": 1 }).sort("id", pymongo.DESCENDING).limit(1):
+            aggCubeRowId = aggCubeRow['id']
+
+        distincts = aggCube['distincts']
+        updates = []
+        newAggCubeRows = []
+        for dimKey, outputFields in result.items():
+            if dimKey in existingAggCubeRows:
+                existingAggCubeRow = existingAggCubeRows[dimKey]
+                accums = existingAggCubeRow['accums']
+                self.__mergeAggAccums__(accums, outputFields)
+                aggCubeRow = self.__getAggCubeRow__(agg, dimKey, accums, existingAggCubeRow['id'], {})
+                updates.append(pymongo.UpdateOne({ "_id": existingAggCubeRow['_id'] },
+                                                 { "$set": { "measures": aggCubeRow['measures'], "accums": accums }}))
+            else:
+                aggCubeRowId += 1
+                newAggCubeRows.append(self.__getAggCubeRow__(agg, dimKey, outputFields, aggCubeRowId, distincts))
+
+        if len(updates) > 0:
+            self.db[aggCubeName].bulk_write(updates)
+        if len(newAggCubeRows) > 0:
+            self.db[aggCubeName].insert_many(newAggCubeRows)
+
+        stats = self.getStats(self.getCubeRowsForCube(aggCubeName))
+        aggCube['distincts'] = distincts
+        aggCube['stats'] = stats
+        self.__updateCubeProperty__(aggCubeName, { "$set": {"distincts" : distincts, "stats" : stats}})
+        return aggCube
+
+    #
+    # Accumulate the aggregations column-wise, falling back to row by row accumulation if an expression cannot
+    # be vectorized
+    #
+    def __accumulateAggs__(self, columnarCube, aggs):
+        results = self.__accumulateAggsColumnar__(columnarCube, aggs)
+        if results == None:
+            results = self.__accumulateAggsByRow__(columnarCube, aggs)
+        return results
+
+    #
+    # Merge the accumulators of a group with other accumulators for the same group
+    #
+    def __mergeAggAccums__(self, outputFields, otherOutputFields):
+        for outputFieldName, otherAccum in otherOutputFields.items():
+            if outputFieldName not in outputFields:
+                outputFields[outputFieldName] = otherAccum
+                continue
+            accum = outputFields[outputFieldName]
+            for part, other in otherAccum.items():
+                if part not in accum:
+                    accum[part] = other
+                    continue
+                partAccum = accum[part]
+                partAccum['operator'] = other['operator']
+                partAccum['count'] = partAccum['count'] + other['count']
+                partAccum['sum'] = partAccum['sum'] + other['sum']
+                partAccum['avg'] = partAccum['sum'] / partAccum['count']
+                partAccum['min'] = min(partAccum['min'], other['min'])
+                partAccum['max'] = max(partAccum['max'], other['max'])
+
+    #
+    # Build an agg cube row from the accumulators of one group
+    #
+    def __getAggCubeRow__(self, agg, dimKey, outputFields, aggCubeRowId, distincts):
+        aggCubeRow = { 'dimensions': {}, 'dates': {}, 'measures': {}, "id": aggCubeRowId }
+
+        dims = dimKey.split('#')
+        for dim in dims:
+            if len(dim) > 0:
+                dimToks = dim.split(':')
+                dimName = dimToks[0]
+                dimName = dimName.encode('ascii', 'ignore')
+                dimValue = dimToks[1]
+                dimValue = dimValue.encode('ascii', 'ignore')
+                aggCubeRow['dimensions'][dimName] = dimValue
+
+        for outputFieldName in outputFields:
+            outputFieldName = outputFieldName.encode('ascii', 'ignore')
+            #print outputFieldName
+
+            numOutput = outputFields[outputFieldName]['numerator']
+            numOperator = numOutput['operator']
+            numMeasureValue = 0
+            if numOperator == 'sum':
+                numMeasureValue = numOutput['sum']
+            elif numOperator == 'avg':
+                numMeasureValue = numOutput['avg']
+            elif numOperator == 'min':
+                numMeasureValue = numOutput['min']
+            elif numOperator == 'max':
+                numMeasureValue = numOutput['max']
+            finalMeasureValue = numMeasureValue
+
+            if 'denominator' in outputFields[outputFieldName]:
+                denOutput = outputFields[outputFieldName]['denominator']
+                #print "   ", "denominator", denOutput['operator']
+                denOperator = denOutput['operator']
+                if denOperator == 'sum':
+                    denMeasureValue = denOutput['sum']
+                elif denOperator == 'avg':
+                    denMeasureValue = denOutput['avg']
+                elif denOperator == 'min':
+                    denMeasureValue = denOutput['min']
+                elif denOperator == 'max':
+                    denMeasureValue = denOutput['max']
+                if denMeasureValue > 0:
+                    finalMeasureValue = numMeasureValue / denMeasureValue
+
+            # Useful for debugging
+            #print "   ", "numerator", numOutput['operator']
+            #print "    Value", finalMeasureValue
+            #print "    Count", numOutput['count']
+
+            aggCubeRow['measures'][outputFieldName] = finalMeasureValue
+            aggCubeRow['measures']['Count'] = numOutput['count']
+
+            # Re-create dimensionkey - N.B. need to preserve the order of the agg dimensions
+            groupByDims = agg['dimensions']
+            dimensionKey = ''
+            for groupByDim in groupByDims:
+                dimensionKey += '#' + groupByDim + ':' + aggCubeRow['dimensions'][groupByDim]
+                self.__addToDistincts__(distincts, groupByDim, aggCubeRow['dimensions'][groupByDim])
+
+            aggCubeRow['dimensionKey'] = dimensionKey
+
+        # Keep the accumulators so that the agg cube row can be updated incrementally
+        aggCubeRow['accums'] = outputFields
+        return aggCubeRow
+
+    #
+    # Accumulate the aggregations one cube row at a time
+    #
+    def __accumulateAggsByRow__(self, cubeRows, aggs):
+        results = {}
+
+        # Parse each expression once, up front
+        compiledExpressions = {}
+        for agg in aggs:
+            for measure in agg['measures']:
+                formula = measure['formula']
+                compileExpression(formula['numerator']['expression'], compiledExpressions)
+                if formula['denominator']:
+                    compileExpression(formula['denominator']['expression'], compiledExpressions)
 
         for cubeRow in cubeRows:
+            flattenedRow = self.__flatten__(cubeRow)
             for agg in aggs:
                 aggName = agg['name']
-                nameToAggMap[aggName] = agg
                 if aggName not in results:
                     results[aggName] = {}
 
@@ -918,13 +2356,13 @@ class CubeService:
                     numerator = formula['numerator']
                     numAggOperator = numerator['aggOperator']
                     numExpression = numerator['expression']
-                    numExpressionValue = self.__getExpressionValue__(self.__flatten__(cubeRow), numExpression)
+                    numExpressionValue = compiledExpressions[numExpression].evaluate(flattenedRow)
 
                     denominator = formula['denominator']
                     if denominator:
                         denAggOperator = denominator['aggOperator']
                         denExpression = denominator['expression']
-                        denExpressionValue = self.__getExpressionValue__(self.__flatten__(cubeRow), denExpression)
+                        denExpressionValue = compiledExpressions[denExpression].evaluate(flattenedRow)
 
                     accums = result[aggDimKey]
                     if outputFieldName in accums:
@@ -968,102 +2406,197 @@ class CubeService:
                             accumDen['min'] = denExpressionValue
                             accumDen['max'] = denExpressionValue
 
-        # Now process results
-        resultCubes = []
-
-        for aggName in results:
-            result = results[aggName]
-            agg = nameToAggMap[aggName]
-
-            #print aggName
-
-            aggCubeRows = []
-            distincts = {}
-            aggCubeRowId = 0
-
-            for dimKey in result:
-                #print dimKey
+        return results
 
-                aggCubeRowId += 1
-                aggCubeRow = { 'dimensions': {}, 'dates': {}, 'measures': {}, "id": aggCubeRowId }
-                aggCubeRows.append(aggCubeRow)
-
-                dims = dimKey.split('#')
-                for dim in dims:
-                    if len(dim) > 0:
-                        dimToks = dim.split(':')
-                        dimName = dimToks[0]
-                        dimName = dimName.encode('ascii', 'ignore')
-                        dimValue = dimToks[1]
-                        dimValue = dimValue.encode('ascii', 'ignore')
-                        aggCubeRow['dimensions'][dimName] = dimValue
-
-                outputFields = result[dimKey]
-                for outputFieldName in outputFields:
-                    outputFieldName = outputFieldName.encode('ascii', 'ignore')
-                    #print outputFieldName
-
-                    numOutput = outputFields[outputFieldName]['numerator']
-                    numOperator = numOutput['operator']
-                    numMeasureValue = 0
-                    if numOperator == 'sum':
-                        numMeasureValue = numOutput['sum']
-                    elif numOperator == 'avg':
-                        numMeasureValue = numOutput['avg']
-                    elif numOperator == 'min':
-                        numMeasureValue = numOutput['min']
-                    elif numOperator == 'max':
-                        numMeasureValue = numOutput['max']
-                    finalMeasureValue = numMeasureValue
-
-                    if 'denominator' in outputFields[outputFieldName]:
-                        denOutput = outputFields[outputFieldName]['denominator']
-                        #print "   ", "denominator", denOutput['operator']
-                        denOperator = denOutput['operator']
-                        if denOperator == 'sum':
-                            denMeasureValue = denOutput['sum']
-                        elif denOperator == 'avg':
-                            denMeasureValue = denOutput['avg']
-                        elif denOperator == 'min':
-                            denMeasureValue = denOutput['min']
-                        elif denOperator == 'max':
-                            denMeasureValue = denOutput['max']
-                        if denMeasureValue > 0:
-                            finalMeasureValue = numMeasureValue / denMeasureValue
-
-                    # Useful for debugging
-                    #print "   ", "numerator", numOutput['operator']
-                    #print "    Value", finalMeasureValue
-                    #print "    Count", numOutput['count']
-
-                    aggCubeRow['measures'][outputFieldName] = finalMeasureValue
-                    aggCubeRow['measures']['Count'] = numOutput['count']
-
-                    # Re-create dimensionkey - N.B. need to preserve the order of the agg dimensions
-                    groupByDims = agg['dimensions']
-                    dimensionKey = ''
-                    for groupByDim in groupByDims:
-                        dimensionKey += '#' + groupByDim + ':' + aggCubeRow['dimensions'][groupByDim]
-                        self.__addToDistincts__(distincts, groupByDim, aggCubeRow['dimensions'][groupByDim])
-
-                    aggCubeRow['dimensionKey'] = dimensionKey
+    #
+    # Accumulate the aggregations with numpy: group-by dimensions are factorized into a group code per row and
+    # the accumulators are computed for all groups at once. Returns None if an expression does not evaluate to
+    # a number for every row.
+    #
+    # Aggregations are computed as a rollup: only aggs whose dimensions are not contained in another agg's
+    # dimensions are computed from the cube rows. Every other agg is derived by merging the count, sum, min and
+    # max accumulators of the smallest agg containing its dimensions.
+    #
+    def __accumulateAggsColumnar__(self, columnarCube, aggs):
+        results = {}
+        if len(columnarCube) == 0:
+            return results
+
+        plan = sorted(aggs, key=lambda agg: -len(agg['dimensions']))
+        parents = []
+        for i, agg in enumerate(plan):
+            parent = None
+            for j in range(i):
+                if set(agg['dimensions']) <= set(plan[j]['dimensions']):
+                    if parent == None or len(plan[j]['dimensions']) < len(plan[parent]['dimensions']):
+                        parent = j
+            parents.append(parent)
+
+        # The aggs computed from the cube rows accumulate the expressions of all the aggs derived from them
+        rootExpressions = {}
+        for i, agg in enumerate(plan):
+            root = i
+            while parents[root] != None:
+                root = parents[root]
+            expressions = rootExpressions.setdefault(root, [])
+            for expression in self.__getAggExpressions__(agg):
+                if expression not in expressions:
+                    expressions.append(expression)
+
+        dimensionCodes = {}
+        flattenedRows = []
+        levels = []
+        for i, agg in enumerate(plan):
+            if parents[i] == None:
+                for groupByDim in agg['dimensions']:
+                    if groupByDim not in dimensionCodes:
+                        dimensionCodes[groupByDim] = self.__getAggDimensionCodes__(columnarCube, groupByDim)
+                itemCounts = None
+                itemAccums = {}
+                for expression in rootExpressions[i]:
+                    values = self.__getExpressionValues__(columnarCube, expression, flattenedRows)
+                    if values is None:
+                        return None
+                    itemAccums[expression] = (values, values, values)
+                groupCodes, groupDimensionCodes, groupKeys = self.__getAggGroups__(dimensionCodes, agg['dimensions'], len(columnarCube))
+            else:
+                parentLevel = levels[parents[i]]
+                itemCounts = parentLevel['counts']
+                itemAccums = parentLevel['accums']
+                groupCodes, groupDimensionCodes, groupKeys = self.__getAggGroups__(parentLevel['dimensionCodes'], agg['dimensions'], len(parentLevel['keys']))
+
+            level = self.__rollupAccums__(groupCodes, len(groupKeys), itemCounts, itemAccums)
+            level['dimensionCodes'] = groupDimensionCodes
+            level['keys'] = groupKeys
+            levels.append(level)
+            results[agg['name']] = self.__getAggResult__(agg, level)
+
+        return results
+
+    def __getAggExpressions__(self, agg):
+        expressions = []
+        for measure in agg['measures']:
+            formula = measure['formula']
+            expressions.append(formula['numerator']['expression'])
+            if formula['denominator']:
+                expressions.append(formula['denominator']['expression'])
+        return expressions
+
+    #
+    # Merge item accumulators (one per cube row, or one per group of a finer agg) into the accumulators of
+    # the groups given by groupCodes. itemCounts is None when the items are cube rows.
+    #
+    def __rollupAccums__(self, groupCodes, groupCount, itemCounts, itemAccums):
+        itemsPerGroup = np.bincount(groupCodes, minlength=groupCount)
+        if itemCounts is None:
+            counts = itemsPerGroup
+        else:
+            counts = np.bincount(groupCodes, weights=itemCounts, minlength=groupCount).astype(np.int64)
+        order = np.argsort(groupCodes, kind='mergesort')
+        starts = np.concatenate(([0], np.cumsum(itemsPerGroup)[:-1]))
 
-            # Create the aggregated cube    
-            aggCubeName = cubeName + "_" + aggName
-            existingAggCube = self.getCube(aggCubeName)
-            stats = self.getStats(aggCubeRows)
+        accums = {}
+        for expression, (sums, mins, maxs) in itemAccums.items():
+            accums[expression] = (np.bincount(groupCodes, weights=sums, minlength=groupCount),
+                                  np.minimum.reduceat(mins[order], starts),
+                                  np.maximum.reduceat(maxs[order], starts))
+        return {'counts': counts, 'accums': accums}
 
-            # Does agg cube already exist? If so delete it and recreate the agg cube
-            if existingAggCube != None:
-                self.deleteCube(aggCubeName)
+    #
+    # Build the per group accumulator dicts of an agg, as produced by the row by row accumulation
+    #
+    def __getAggResult__(self, agg, level):
+        result = {}
+        counts = level['counts'].tolist()
+        accums = {}
+        for expression, (sums, mins, maxs) in level['accums'].items():
+            accums[expression] = (sums.tolist(), mins.tolist(), maxs.tolist())
+
+        for i, aggDimKey in enumerate(level['keys']):
+            outputFields = {}
+            result[aggDimKey] = outputFields
+            count = counts[i]
+            for measure in agg['measures']:
+                outputFieldName = measure['outputField']['name']
+                formula = measure['formula']
+                parts = [('numerator', formula['numerator'])]
+                if formula['denominator']:
+                    parts.append(('denominator', formula['denominator']))
+                if outputFieldName not in outputFields:
+                    outputFields[outputFieldName] = {}
+                for part, definition in parts:
+                    sums, mins, maxs = accums[definition['expression']]
+                    outputFields[outputFieldName][part] = {'operator': definition['aggOperator'], 'count': count, 'sum': sums[i],
+                                                           'avg': sums[i] / count, 'min': mins[i], 'max': maxs[i]}
+        return result
 
-            inMemory = False
-            if cubeName in self.inMemoryCubes:
-                inMemory = True
-            self.createCube('agg', aggCubeName, aggCubeRows, distincts, stats, None, agg, inMemory)
-            resultCubes.append(self.getCube(aggCubeName))
-    
-        return resultCubes        
+    #
+    # Factorize a group-by dimension of a columnar cube: returns a code per row and the label of each code
+    #
+    def __getAggDimensionCodes__(self, columnarCube, groupByDim):
+        if groupByDim in columnarCube.dimensions:
+            codes, values = columnarCube.getDimension(groupByDim)
+            return codes.astype(np.int64) + 1, [''] + list(values)
+        elif groupByDim in columnarCube.dates:
+            days = columnarCube.getDate(groupByDim).astype('datetime64[D]').view(np.int64)
+            uniqueDays, codes = np.unique(days, return_inverse=True)
+            notATime = np.datetime64('NaT').astype('datetime64[D]').view(np.int64)
+            labels = ['' if day == notATime else str(np.datetime64(day, 'D')) for day in uniqueDays.tolist()]
+            return codes, labels
+        return np.zeros(len(columnarCube), dtype=np.int64), ['']
+
+    #
+    # Combine the codes of the group-by dimensions into one group code per item. Also returns the dimension
+    # codes and the dimension key of each group.
+    #
+    def __getAggGroups__(self, dimensionCodes, groupByDims, size):
+        combined = np.zeros(size, dtype=np.int64)
+        for groupByDim in groupByDims:
+            codes, labels = dimensionCodes[groupByDim]
+            combined = np.unique(combined * len(labels) + codes, return_inverse=True)[1]
+
+        uniqueCombined, firstItems, groupCodes = np.unique(combined, return_index=True, return_inverse=True)
+        groupDimensionCodes = {}
+        for groupByDim in groupByDims:
+            codes, labels = dimensionCodes[groupByDim]
+            groupDimensionCodes[groupByDim] = (codes[firstItems], labels)
+
+        groupKeys = [''] * len(firstItems)
+        for groupByDim in groupByDims:
+            codes, labels = groupDimensionCodes[groupByDim]
+            for i, code in enumerate(codes.tolist()):
+                groupKeys[i] += '#' + groupByDim + ':' + labels[code]
+        return groupCodes, groupDimensionCodes, groupKeys
+
+    #
+    # Evaluate an expression for every row of a columnar cube. Arithmetic on measures without missing values is
+    # evaluated on the measure arrays, anything else is evaluated per row.
+    #
+    def __getExpressionValues__(self, columnarCube, expression, flattenedRows):
+        compiledExpression = compileExpression(expression)
+        if compiledExpression.vectorizable:
+            columns = {}
+            for name in compiledExpression.names:
+                if name not in columnarCube.measures or columnarCube.getMissingMeasure(name) is not None:
+                    break
+                columns[name] = columnarCube.getMeasure(name)
+            else:
+                # Where evaluating a row would raise, such as dividing by zero, leave it to the rows to raise
+                try:
+                    with np.errstate(divide='raise', over='raise', invalid='raise', under='ignore'):
+                        values = np.asarray(compiledExpression.evaluateColumns(columns), dtype=np.float64)
+                except FloatingPointError:
+                    return None
+                if values.ndim == 0:
+                    values = np.full(len(columnarCube), values, dtype=np.float64)
+                return values
+
+        if len(flattenedRows) == 0:
+            flattenedRows.extend(self.__flatten__(cubeRow) for cubeRow in columnarCube)
+        try:
+            return np.array([compiledExpression.evaluate(row) for row in flattenedRows], dtype=np.float64)
+        except (TypeError, ValueError):
+            return None
 
     #
     # Aggregate cube using custom aggregation definitions
@@ -1153,74 +2686,254 @@ class CubeService:
             existingAggCube = self.getCube(aggCubeName)
             stats = self.getStats(aggCubeRows)
 
-            # Does agg cube already exist? If so delete it and recreate the agg cube
-            if existingAggCube != None:
-                self.deleteCube(aggCubeName)
-
             inMemory = False
             if cubeName in self.inMemoryCubes:
                 inMemory = True
-            self.createCube('agg', aggCubeName, aggCubeRows, distincts, stats, None, agg, inMemory)
+
+            # Does agg cube already exist? If so replace its rows and definition, otherwise create it
+            self.__replaceAggCube__(aggCubeName, existingAggCube, aggCubeRows, distincts, stats, agg, inMemory)
             resultCubes.append(self.getCube(aggCubeName))
 
         return resultCubes
 
-    def addColumn(self, cube, newColumnName, type, expression=None, func=None):
-        if type != 'numeric' and type != 'string':
-            raise ValueError("type must be one of numeric, string")
-
-        if expression == None and func == None:
-            raise ValueError("You must supply an expression or function")
+    #
+    # Add a computed column to a cube. type is numeric (a measure) or string (a dimension). The column is
+    # defined by an expression referencing fields as $['name'], or by a function of the cube row.
+    #
+    def addColumn(self, cube, newColumnName, type, expression=None, func=None, batchSize=1000):
+        self.addColumns(cube, [{ "name": newColumnName, "type": type, "expression": expression, "func": func }], batchSize)
 
-        if (expression != None):
-            if type  == 'numeric':
-               expression = expression.replace('$', "cubeRow['measures']")
-            elif type == 'string':
-               expression = expression.replace('$', "cubeRow['dimensions']")
+    #
+    # Add several computed columns in a single pass over the cube. Each column is a dict with a name, a type and
+    # an expression or func, as for addColumn. A column may use the columns added before it.
+    #
+    # In an expression $['name'] is a measure for numeric columns and a dimension for string columns, falling back
+    # to the other kind if there is no such field. Expressions are evaluated on whole columns where possible - a
+    # batch of cube rows at a time for persisted cubes - and row by row otherwise.
+    #
+    def addColumns(self, cube, columns, batchSize=1000):
+        columnExpressions = self.__getColumnExpressions__(columns)
 
         if (cube == None):
             return
 
         cubeName = cube['name']
-        cubeRows = self.getCubeRowsForCube(cubeName)
-        tempMap = {}
+        cubeRows = self.__getStoredCubeRows__(cubeName)
+        measureNames = [column['name'] for column in columns if column['type'] == 'numeric']
+        hasDimensions = len(measureNames) < len(columns)
+
+        # The new columns may use the cube's virtual columns, which are computed alongside but not stored
+        virtualColumns = self.getCube(cubeName).get('virtualColumns') or []
+        virtualColumnExpressions = self.__getColumnExpressions__(virtualColumns)
+        virtualDimensionNames = set(column['name'] for column in virtualColumns if column['type'] == 'string')
+
+        # In-memory cubes are columnar, so each new column is set in one go
+        if isinstance(cubeRows, ColumnarCube):
+            inMemoryCube = self.inMemoryCubes[cubeName]
+            workCube = cubeRows
+            if len(virtualColumns) > 0:
+                workCube = cubeRows.copy()
+                self.__computeColumns__(workCube, workCube, virtualColumns, virtualColumnExpressions)
+            columnValues = self.__computeColumns__(workCube, workCube, columns, columnExpressions)
+            for column, values in zip(columns, columnValues):
+                if workCube is not cubeRows and column['type'] == 'numeric':
+                    cubeRows.setMeasure(column['name'], values)
+                elif workCube is not cubeRows:
+                    cubeRows.setDimension(column['name'], values)
+                if column['type'] == 'string':
+                    for value in values:
+                        self.__addToDistincts__(inMemoryCube['distincts'], column['name'], value)
+            if len(measureNames) > 0:
+                inMemoryCube['stats'] = self.getStats(cubeRows)
+                if cubeName in self.inMemoryStatsStates:
+                    self.__saveCubeStatsAccumulator__(cubeName, self.__getStatsAccumulator__(cubeRows))
+            return
 
-        for cubeRow in cubeRows:
-            try:
-                if expression != None:
-                    value = eval(expression)
-                else:
-                    value = func(cubeRow)
-                cubeId = cubeRow['id']
-                tempMap[cubeId] = value
-            except SyntaxError:
-                raise SyntaxError("Expression contains syntax error.")
+        # Persisted cubes are updated in a single pass, a batch of rows at a time. The rows are read in _id order,
+        # which the updates cannot change, so no row is read twice however its dimensionKey moves.
+        cubeRows = self.db[cubeName].find({}).sort("_id", pymongo.ASCENDING)
+        statsAccumulator = StatsAccumulator()
+        while True:
+            batch = list(islice(cubeRows, batchSize))
+            if len(batch) == 0:
+                break
+            batchCube = ColumnarCube()
+            batchCube.appendRows(batch)
+            self.__computeColumns__(batchCube, batch, virtualColumns, virtualColumnExpressions)
+            columnValues = self.__computeColumns__(batchCube, batch, columns, columnExpressions)
+            rowUpdates = [{} for cubeRow in batch]
+            for column, values in zip(columns, columnValues):
+                name = column['name']
+                section = 'measures' if column['type'] == 'numeric' else 'dimensions'
+                for rowUpdate, value in zip(rowUpdates, values):
+                    rowUpdate[section + '.' + name] = value
+                if column['type'] == 'string':
+                    for value in values:
+                        self.__addToDistincts__(cube['distincts'], name, value)
+
+            updates = []
+            for cubeRow, rowUpdate in zip(batch, rowUpdates):
+                if hasDimensions:
+                    dimensions = dict((k, v) for k, v in cubeRow['dimensions'].items() if k not in virtualDimensionNames)
+                    rowUpdate['dimensionKey'] = self.__reconstructDimensionKey__(dimensions, cubeRow['dates'])
+                updates.append(pymongo.UpdateOne({ "_id": cubeRow['_id'] }, { "$set": rowUpdate }))
+            self.db[cubeName].bulk_write(updates, ordered=False)
+            for name in measureNames:
+                statsAccumulator.addValues(name, [cubeRow['measures'][name] for cubeRow in batch])
+
+        if len(measureNames) > 0:
+            # Only the stats of the new measures change
+            storedCube = self.getCube(cubeName)
+            stats = storedCube['stats'] or {}
+            stats.update(statsAccumulator.getStats())
+            cube['stats'] = stats
+            cubeStatsAccumulator = self.__getCubeStatsAccumulator__(storedCube)
+            if cubeStatsAccumulator != None:
+                cubeStatsAccumulator.replaceMeasures(measureNames, statsAccumulator)
+                self.__saveCubeStatsAccumulator__(cubeName, cubeStatsAccumulator)
+            self.__updateCubeProperty__(cubeName, { "$set": {"stats" : stats}})
+        if hasDimensions:
+            self.__updateCubeProperty__(cubeName, { "$set": {"distincts" : cube['distincts']}})
 
-        cubeRows = self.getCubeRowsForCube(cubeName)
+    #
+    # Add a virtual column to a cube. Only the definition - name, type and expression, as for addColumn - is
+    # stored on the cube. The column is computed whenever the cube rows are read, binned or aggregated, and
+    # may use stored columns and the virtual columns defined before it.
+    #
+    def addVirtualColumn(self, cube, newColumnName, type, expression):
+        if (cube == None):
+            return
+        column = { "name": newColumnName, "type": type, "expression": expression }
+        self.__getColumnExpressions__([column])
+        virtualColumns = [virtualColumn for virtualColumn in cube.get('virtualColumns') or [] if virtualColumn['name'] != newColumnName]
+        virtualColumns.append(column)
+        cube['virtualColumns'] = virtualColumns
+        self.__updateCubeProperty__(cube['name'], { "$set": {"virtualColumns" : virtualColumns}})
+
+    #
+    # Remove a virtual column from a cube
+    #
+    def removeVirtualColumn(self, cube, columnName):
+        if (cube == None):
+            return
+        virtualColumns = [virtualColumn for virtualColumn in cube.get('virtualColumns') or [] if virtualColumn['name'] != columnName]
+        cube['virtualColumns'] = virtualColumns
+        self.__updateCubeProperty__(cube['name'], { "$set": {"virtualColumns" : virtualColumns}})
+
+    #
+    # Turn a virtual column into a stored column, with its stats or distincts
+    #
+    def materializeColumn(self, cube, columnName, batchSize=1000):
+        if (cube == None):
+            return
+        columns = [virtualColumn for virtualColumn in cube.get('virtualColumns') or [] if virtualColumn['name'] == columnName]
+        if len(columns) == 0:
+            raise ValueError("Cube " + cube['name'] + " has no virtual column " + columnName)
+        self.addColumns(cube, columns, batchSize)
+        self.removeVirtualColumn(cube, columnName)
+
+    #
+    # Check the definitions of new columns and parse their expressions
+    #
+    def __getColumnExpressions__(self, columns):
+        columnExpressions = []
+        for column in columns:
+            if column['type'] != 'numeric' and column['type'] != 'string':
+                raise ValueError("type must be one of numeric, string")
+            if column.get('expression') == None and column.get('func') == None:
+                raise ValueError("You must supply an expression or function")
+            if column.get('expression') != None:
+                columnExpressions.append(ColumnExpression(column['expression']))
+            else:
+                columnExpressions.append(None)
+        return columnExpressions
+
+    #
+    # Compute columns for the rows of a columnar cube and set them in it. cubeRows are the same rows as dicts;
+    # unless they are the columnar cube itself, the values are set in them too. Returns the values of each column.
+    #
+    def __computeColumns__(self, columnarCube, cubeRows, columns, columnExpressions):
+        columnValues = []
+        for column, columnExpression in zip(columns, columnExpressions):
+            name = column['name']
+            values = self.__getColumnValues__(columnarCube, cubeRows, column, columnExpression)
+            if column['type'] == 'numeric':
+                section = 'measures'
+                columnarCube.setMeasure(name, values)
+            else:
+                section = 'dimensions'
+                columnarCube.setDimension(name, values)
+            if cubeRows is not columnarCube:
+                for cubeRow, value in zip(cubeRows, values):
+                    cubeRow[section][name] = value
+            columnValues.append(values)
+        return columnValues
+
+    #
+    # Values of a new column for the rows of a columnar cube. cubeRows are the same rows as dicts, used when
+    # the column has to be computed row by row: with a func, or an expression that cannot be evaluated on whole
+    # columns.
+    #
+    def __getColumnValues__(self, columnarCube, cubeRows, column, columnExpression):
+        if columnExpression != None:
+            columns = self.__getExpressionColumns__(columnarCube, columnExpression.fields, column['type'])
+            values = columnExpression.evaluateColumns(len(columnarCube), columns)
+            if values is not None:
+                if column['type'] == 'numeric':
+                    return values.astype(np.float64).tolist()
+                return values.astype(object).tolist()
+
+        values = []
         for cubeRow in cubeRows:
-            cubeId = cubeRow['id']
-            value = tempMap[cubeId]
-            if (type == 'numeric'):
-                cubeRow['measures'][newColumnName] = value
-                measureUpdateField = 'measures.' + newColumnName
-                self.__updateCubeRowProperty__(cubeName, cubeRow['_id'], { "$set": {measureUpdateField : value}})
-            elif (type == 'string'):
-                cubeRow['dimensions'][newColumnName] = value
-                dimensionUpdateField = 'dimensions.' + newColumnName
-                self.__updateCubeRowProperty__(cubeName, cubeRow['_id'], { "$set": {dimensionUpdateField : value}})
-                # Reconstruct dimension key
-                dimensionKey = self.__reconstructDimensionKey__(cubeRow['dimensions'], cubeRow['dates'])
-                self.__updateCubeRowProperty__(cubeName, cubeRow['_id'], { "$set": {"dimensionKey": dimensionKey}})
-                self.__addToDistincts__(cube['distincts'], newColumnName, value)
+            if columnExpression != None:
+                value = columnExpression.evaluate(self.__getExpressionFieldValues__(cubeRow, columnExpression.fields, column['type']))
+                # Numbers are stored as floats, as when evaluated on columns
+                if column['type'] == 'numeric' and isinstance(value, (int, long, float)):
+                    value = float(value)
+                values.append(value)
+            else:
+                values.append(column['func'](cubeRow))
+        return values
 
+    #
+    # Sections of a cube row that fields of a column expression are looked up in, in order
+    #
+    def __getExpressionSections__(self, type):
         if type == 'numeric':
-            # Recompute stats
-            cubeRows = self.getCubeRowsForCube(cubeName)
-            stats = self.getStats(cubeRows)
-            self.__updateCubeProperty__(cubeName, { "$set": {"stats" : stats}})
-        elif type == 'string':
-            self.__updateCubeProperty__(cubeName, { "$set": {"distincts" : cube['distincts']}})
-
+            return ['measures', 'dimensions']
+        return ['dimensions', 'measures']
+
+    #
+    # Columns of a columnar cube used by a column expression. Columns with missing values map to None, so that
+    # the expression is evaluated row by row.
+    #
+    def __getExpressionColumns__(self, columnarCube, fields, type):
+        columns = {}
+        for field in fields:
+            for section in self.__getExpressionSections__(type):
+                if section == 'measures' and field in columnarCube.measures:
+                    missing = columnarCube.getMissingMeasure(field)
+                    if missing is None or not missing.any():
+                        columns[field] = columnarCube.getMeasure(field)
+                    break
+                if section == 'dimensions' and field in columnarCube.dimensions:
+                    codes, values = columnarCube.getDimension(field)
+                    if len(codes) == 0 or codes.min() >= 0:
+                        columns[field] = (codes, values)
+                    break
+        return columns
+
+    #
+    # Values of the fields of a column expression in a cube row
+    #
+    def __getExpressionFieldValues__(self, cubeRow, fields, type):
+        fieldValues = {}
+        for field in fields:
+            for section in self.__getExpressionSections__(type):
+                if field in cubeRow[section]:
+                    fieldValues[field] = cubeRow[section][field]
+                    break
+        return fieldValues
 
     def __reconstructDimensionKey__(self, dimensions, dates):
         dimensionKey = ''
@@ -2,7 +2,6 @@ import csv
 import re
 import json
 import sys
-from pymongo import MongoClient
 from pprint import pprint
 from datetime import datetime, date
 from timestring import Date, TimestringInvalid
@@ -10,11 +9,17 @@ from cubeservice import CubeService
 
 class CubeSetService:
 
-    def __init__(self, dbName):
+    #
+    # cubeService is an optional CubeService to share, along with its MongoClient and in-memory cubes.
+    # Otherwise one is created with the given client, or with a client created from the host, maxPoolSize,
+    # timeout and w (write concern) options.
+    #
+    def __init__(self, dbName, client=None, cubeService=None, maxPoolSize=None, timeout=None, w=None, host=None):
         self.dbName = dbName
-        client = MongoClient()
-        self.db = client[dbName]
-        self.cubeService = CubeService(dbName)
+        if cubeService == None:
+            cubeService = CubeService(dbName, client, maxPoolSize, timeout, w, host=host)
+        self.cubeService = cubeService
+        self.db = cubeService.client[dbName]
 
     #
     # Update an arbitrary field in cubeset
@@ -77,21 +82,20 @@ class CubeSetService:
             return
 
         existingSourceCube = self.cubeService.getCube(cubeSet['sourceCube'])
+        maxId = self.cubeService.getMaxCubeRowId(existingSourceCube)
         self.cubeService.appendToCubeFromCsv(csvFilePath, existingSourceCube)
 
-        #re-bin
+        # Bin only the new rows and fold them into the agg cubes
         if 'binnedCube' in cubeSet:
             binnedCubeName = cubeSet['binnedCube']
             binnedCube = self.cubeService.getCube(binnedCubeName)
-            self.cubeService.rebinCubeCustom(binnedCube['binnings'], existingSourceCube, cubeSet['binnedCube'])
+            newCubeRows = self.cubeService.queryCubeRows(existingSourceCube, { "id": { "$gt": maxId }})
+            newBinnedCubeRows = self.cubeService.appendToBinnedCube(binnedCube, existingSourceCube, newCubeRows)
 
-            #re-aggregate
             if 'aggCubes' in cubeSet:
                 for aggCubeName in cubeSet['aggCubes']:
                    aggCube = self.cubeService.getCube(aggCubeName)
-                   aggs = []
-                   aggs.append(aggCube['agg'])
-                   self.cubeService.aggregateCubeCustom(binnedCube, aggs)
+                   self.cubeService.appendToAggCube(binnedCube, aggCube, newBinnedCubeRows)
 
     #
     # Remove rows from source
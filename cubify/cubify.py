@@ -3,14 +3,16 @@ from cubesetservice import CubeSetService
 
 class Cubify:
 
-    def __init__(self, dbName="cubify"):
-        self.cubeService = CubeService(dbName)
-        self.cubeSetService = CubeSetService(dbName)
+    def __init__(self, dbName="cubify", client=None, maxPoolSize=None, timeout=None, w=None, serverSideSummaries=False,
+                 host=None):
+        # Both services share one MongoClient (and connection pool) and the in-memory cubes
+        self.cubeService = CubeService(dbName, client, maxPoolSize, timeout, w, serverSideSummaries, host)
+        self.cubeSetService = CubeSetService(dbName, cubeService=self.cubeService)
 
     ### Cubes
 
-    def createCubeFromCsv(self, csvFilePath, cubeName, inMemory=False):
-        return self.cubeService.createCubeFromCsv(csvFilePath, cubeName, inMemory)
+    def createCubeFromCsv(self, csvFilePath, cubeName, inMemory=False, batchSize=None, sampleSize=100, workers=None, indexes=None):
+        return self.cubeService.createCubeFromCsv(csvFilePath, cubeName, inMemory, batchSize, sampleSize, workers, indexes)
 
     def createCubeFromCube(self, fromCube, filter, toCubeName):
         return self.cubeService.createCubeFromCube(fromCube, filter, toCubeName)
@@ -26,24 +28,51 @@ class Cubify:
 
     def getCubeRows(self, cube):
         return self.cubeService.getCubeRows(cube)
+
+    def getCubeStats(self, cube):
+        return self.cubeService.getCubeStats(cube)
+
+    def queryCube(self, cube, filters=None, dateRanges=None, groupBy=None, measures=None, orderBy=None, limit=None):
+        return self.cubeService.queryCube(cube, filters, dateRanges, groupBy, measures, orderBy, limit)
         
+    def listCubeIndexes(self, cube):
+        return self.cubeService.listCubeIndexes(cube)
+
+    def addCubeIndex(self, cube, field):
+        self.cubeService.addCubeIndex(cube, field)
+
+    def dropCubeIndex(self, cube, field):
+        self.cubeService.dropCubeIndex(cube, field)
+
     def exportCubeToCsv(self, cube, csvFilePath):
         return self.cubeService.exportCubeToCsv(cube, csvFilePath)
 
-    def addColumn(self, cube, newColumnName, type, expression=None, func=None):
-        self.cubeService.addColumn(cube, newColumnName, type, expression, func)
+    def addColumn(self, cube, newColumnName, type, expression=None, func=None, batchSize=1000):
+        self.cubeService.addColumn(cube, newColumnName, type, expression, func, batchSize)
+
+    def addColumns(self, cube, columns, batchSize=1000):
+        self.cubeService.addColumns(cube, columns, batchSize)
+
+    def addVirtualColumn(self, cube, newColumnName, type, expression):
+        self.cubeService.addVirtualColumn(cube, newColumnName, type, expression)
+
+    def removeVirtualColumn(self, cube, columnName):
+        self.cubeService.removeVirtualColumn(cube, columnName)
+
+    def materializeColumn(self, cube, columnName, batchSize=1000):
+        self.cubeService.materializeColumn(cube, columnName, batchSize)
 
-    def binCube(self, sourceCube, binnedCubeName, toBeBinned=None, hints={}):
-        return self.cubeService.binCube(sourceCube, binnedCubeName, toBeBinned, hints)
+    def binCube(self, sourceCube, binnedCubeName, toBeBinned=None, hints={}, workers=None):
+        return self.cubeService.binCube(sourceCube, binnedCubeName, toBeBinned, hints, workers)
 
-    def rebinCube(self, sourceCube, binnedCubeName):
-        return self.rebinCube(sourceCube, binnedCubeName)
+    def rebinCube(self, sourceCube, binnedCubeName, workers=None):
+        return self.cubeService.rebinCube(sourceCube, binnedCubeName, workers)
 
-    def binCubeCustom(self, binnings, sourceCube, binnedCubeName):
-        return self.cubeService.binCubeCustom(binnings, sourceCube, binnedCubeName)
+    def binCubeCustom(self, binnings, sourceCube, binnedCubeName, workers=None):
+        return self.cubeService.binCubeCustom(binnings, sourceCube, binnedCubeName, workers)
 
-    def rebinCubeCustom(self, binnings, sourceCube, binnedCubeName):
-        return self.cubeService.rebinCubeCustom(binnings, sourceCube, binnedCubeName)
+    def rebinCubeCustom(self, binnings, sourceCube, binnedCubeName, workers=None):
+        return self.cubeService.rebinCubeCustom(binnings, sourceCube, binnedCubeName, workers)
 
     def aggregateCube(self, cube, groupByDimensions, measures=None):
         return self.cubeService.aggregateCube(cube, groupByDimensions, measures)
@@ -0,0 +1,311 @@
+import re
+import ast
+import __future__
+import numpy as np
+from simpleeval import InvalidExpression, NameNotDefined, FeatureNotAvailable, safe_power, safe_mult
+
+#
+# Node types an expression may contain. This is the arithmetic, comparison and boolean subset of what
+# simple_eval accepts - no attribute access, subscripts, lambdas or comprehensions.
+#
+ALLOWED_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.IfExp, ast.Call,
+                 ast.Num, ast.Str, ast.Name, ast.Load, ast.Tuple, ast.List,
+                 ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow,
+                 ast.BitXor, ast.BitOr, ast.BitAnd, ast.LShift, ast.RShift,
+                 ast.USub, ast.UAdd, ast.Not, ast.Invert, ast.And, ast.Or,
+                 ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.In, ast.NotIn, ast.Is, ast.IsNot)
+
+#
+# Node types an expression may contain to be evaluated on whole numpy columns at once
+#
+VECTORIZABLE_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Num, ast.Name, ast.Load,
+                      ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow, ast.USub, ast.UAdd)
+
+FUNCTIONS = {'int': int, 'float': float, 'str': unicode}
+
+NAMES = {'True': True, 'False': False, 'None': None}
+
+#
+# Powers and repeats are limited as simple_eval limits them, so that an expression such as 9**9**9 or 'x' * 10**9
+# fails fast instead of running the server out of time or memory. Numpy columns are left to numpy, whose
+# fixed size numbers cannot blow up like Python's long integers and strings.
+#
+def __safePower__(a, b):
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        return a ** b
+    return safe_power(a, b)
+
+def __safeMult__(a, b):
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        return a * b
+    return safe_mult(a, b)
+
+SAFE_OPERATORS = {'_safePower': __safePower__, '_safeMult': __safeMult__}
+
+def __callNode__(name, args):
+    return ast.Call(func=ast.Name(id=name, ctx=ast.Load()), args=args, keywords=[], starargs=None, kwargs=None)
+
+#
+# Rewrites ** and * into calls to the safe operators
+#
+class SafeOperatorTransformer(ast.NodeTransformer):
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Pow):
+            return __callNode__('_safePower', [node.left, node.right])
+        if isinstance(node.op, ast.Mult):
+            return __callNode__('_safeMult', [node.left, node.right])
+        return node
+
+#
+# An expression parsed, checked and compiled once, which can then be evaluated cheaply for every cube row or
+# for whole columns. Division is true division, as with simple_eval.
+#
+class CompiledExpression:
+
+    def __init__(self, expression):
+        self.expression = expression
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+        except SyntaxError:
+            raise InvalidExpression("Expression contains syntax error: " + expression)
+
+        self.names = set()
+        self.vectorizable = True
+        for node in ast.walk(tree):
+            if not isinstance(node, ALLOWED_NODES):
+                raise FeatureNotAvailable("Sorry, " + type(node).__name__ + " is not available in expression " + expression)
+            if isinstance(node, ast.Call):
+                if not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS or \
+                   node.keywords or node.starargs or node.kwargs:
+                    raise FeatureNotAvailable("Sorry, only int, float and str calls are available in expression " + expression)
+            elif isinstance(node, ast.Name) and node.id not in FUNCTIONS and node.id not in NAMES:
+                self.names.add(node.id)
+            if not isinstance(node, VECTORIZABLE_NODES):
+                self.vectorizable = False
+
+        tree = ast.fix_missing_locations(SafeOperatorTransformer().visit(tree))
+        self.code = compile(tree, '<expression>', 'eval', __future__.division.compiler_flag, True)
+        self.globals = {'__builtins__': {}}
+        self.globals.update(FUNCTIONS)
+        self.globals.update(NAMES)
+        self.globals.update(SAFE_OPERATORS)
+
+    #
+    # Evaluate the expression for one row, given as a dict of field name to value
+    #
+    def evaluate(self, names):
+        try:
+            return eval(self.code, self.globals, names)
+        except NameError:
+            for name in self.names:
+                if name not in names:
+                    raise NameNotDefined(name, self.expression)
+            raise
+
+    #
+    # Evaluate the expression on numpy columns, given as a dict of field name to array. Only valid if the
+    # expression is vectorizable.
+    #
+    def evaluateColumns(self, columns):
+        return self.evaluate(columns)
+
+#
+# Compile an expression, reusing the compiled form from the cache if there is one
+#
+def compileExpression(expression, cache=None):
+    if cache == None:
+        return CompiledExpression(expression)
+    if expression not in cache:
+        cache[expression] = CompiledExpression(expression)
+    return cache[expression]
+
+#
+# Node types a column expression may contain to be evaluated on whole numpy columns. Conditional expressions,
+# boolean operators and comparison chains are rewritten into numpy calls first.
+#
+COLUMN_VECTORIZABLE_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.IfExp,
+                             ast.Num, ast.Str, ast.Name, ast.Load,
+                             ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow,
+                             ast.USub, ast.UAdd, ast.Not, ast.And, ast.Or,
+                             ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE)
+
+COLUMN_FUNCTIONS = {'where': np.where, 'logical_and': np.logical_and, 'logical_or': np.logical_or,
+                    'logical_not': np.logical_not}
+
+#
+# A field reference in a column expression: $['name'] or $["name"]
+#
+FIELD_PATTERN = re.compile(r'''\$\[\s*(?:'([^']*)'|"([^"]*)")\s*\]''')
+
+#
+# Does a node always evaluate to a boolean? Only then do and, or and not mean the same element-wise as they do
+# for one row: 'x or default' evaluates to x, not to True.
+#
+def __isBooleanNode__(node):
+    if isinstance(node, (ast.Compare, ast.BoolOp)):
+        return True
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        return True
+    return isinstance(node, ast.Name) and node.id in ['True', 'False']
+
+#
+# Is a node arithmetic on numbers and fields? Adds the names of the fields it uses to names. np.where would turn
+# the branches of a conditional into one type, so only numeric branches are evaluated on columns.
+#
+def __isNumericNode__(node, names):
+    if isinstance(node, ast.Num):
+        return True
+    if isinstance(node, ast.Name):
+        names.add(node.id)
+        return True
+    if isinstance(node, ast.BinOp):
+        return __isNumericNode__(node.left, names) and __isNumericNode__(node.right, names)
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+        return __isNumericNode__(node.operand, names)
+    if isinstance(node, ast.IfExp):
+        return __isNumericNode__(node.body, names) and __isNumericNode__(node.orelse, names)
+    return False
+
+#
+# Rewrites the parts of an expression that Python evaluates as a single truth value into element-wise numpy calls
+#
+class ColumnTransformer(ast.NodeTransformer):
+
+    def visit_IfExp(self, node):
+        self.generic_visit(node)
+        return __callNode__('where', [node.test, node.body, node.orelse])
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        name = 'logical_and' if isinstance(node.op, ast.And) else 'logical_or'
+        result = node.values[-1]
+        for value in reversed(node.values[:-1]):
+            result = __callNode__(name, [value, result])
+        return result
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return __callNode__('logical_not', [node.operand])
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        if len(node.ops) == 1:
+            return node
+        # a < b < c becomes logical_and(a < b, b < c)
+        lefts = [node.left] + node.comparators[:-1]
+        pairs = [ast.Compare(left=left, ops=[op], comparators=[right]) for left, op, right in zip(lefts, node.ops, node.comparators)]
+        result = pairs[-1]
+        for pair in reversed(pairs[:-1]):
+            result = __callNode__('logical_and', [pair, result])
+        return result
+
+#
+# An expression defining a new column, with fields referenced as $['name'].
+#
+# The expression is checked like a CompiledExpression and can be evaluated for one row at a time. It can also be
+# evaluated on whole columns: expressions over dimensions only are evaluated once per distinct combination of
+# dimension values and mapped back through the dictionary codes, other expressions are evaluated with numpy.
+# Either way the values are those evaluating each row would give; expressions numpy would evaluate differently
+# are left to be evaluated row by row.
+#
+class ColumnExpression:
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.fields = []
+        self.fieldNames = {}
+
+        def replaceField(match):
+            field = match.group(1) if match.group(1) != None else match.group(2)
+            if field not in self.fieldNames:
+                self.fieldNames[field] = '_field' + str(len(self.fields))
+                self.fields.append(field)
+            return self.fieldNames[field]
+
+        self.compiledExpression = CompiledExpression(FIELD_PATTERN.sub(replaceField, expression))
+        for name in self.compiledExpression.names:
+            if name not in self.fieldNames.values():
+                raise NameNotDefined(name, expression)
+
+        self.vectorCode = None
+        tree = ast.parse(self.compiledExpression.expression.strip(), mode='eval')
+        # Fields used in the branches of conditionals, which have to be measures
+        branchNames = set()
+        vectorizable = True
+        for node in ast.walk(tree):
+            if not isinstance(node, COLUMN_VECTORIZABLE_NODES):
+                vectorizable = False
+            elif isinstance(node, ast.BoolOp) and not all(__isBooleanNode__(value) for value in node.values):
+                vectorizable = False
+            elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not) and not __isBooleanNode__(node.operand):
+                vectorizable = False
+            elif isinstance(node, ast.IfExp) and not (__isNumericNode__(node.body, branchNames) and __isNumericNode__(node.orelse, branchNames)):
+                vectorizable = False
+        self.branchFields = [field for field in self.fields if self.fieldNames[field] in branchNames]
+        if vectorizable:
+            tree = ast.fix_missing_locations(SafeOperatorTransformer().visit(ColumnTransformer().visit(tree)))
+            self.vectorCode = compile(tree, '<expression>', 'eval', __future__.division.compiler_flag, True)
+            self.vectorGlobals = dict(self.compiledExpression.globals)
+            self.vectorGlobals.update(COLUMN_FUNCTIONS)
+
+    #
+    # Evaluate the expression for one row, given as a dict of field name to value
+    #
+    def evaluate(self, fieldValues):
+        names = {}
+        for field in self.fields:
+            if field not in fieldValues:
+                raise NameNotDefined(field, self.expression)
+            names[self.fieldNames[field]] = fieldValues[field]
+        return self.compiledExpression.evaluate(names)
+
+    #
+    # Evaluate the expression for size rows at once. columns maps each field to a float64 array (measures) or
+    # to a pair of a code array and the values the codes index into (dimensions). Returns an array with one
+    # value per row, or None if the expression has to be evaluated row by row: when a field is missing from
+    # columns (or maps to None), or the expression uses something numpy cannot evaluate element-wise.
+    #
+    def evaluateColumns(self, size, columns):
+        for field in self.fields:
+            if columns.get(field) is None:
+                return None
+
+        if all(isinstance(columns[field], tuple) for field in self.fields):
+            results = np.empty(size, dtype=object)
+            if len(self.fields) == 0:
+                results.fill(self.evaluate({}))
+                return results
+            if size == 0:
+                return results
+            codes = np.column_stack([columns[field][0] for field in self.fields])
+            uniqueCodes, inverse = np.unique(codes, axis=0, return_inverse=True)
+            uniqueResults = np.empty(len(uniqueCodes), dtype=object)
+            for i, rowCodes in enumerate(uniqueCodes.tolist()):
+                uniqueResults[i] = self.evaluate(dict((field, columns[field][1][code]) for field, code in zip(self.fields, rowCodes)))
+            return uniqueResults[inverse]
+
+        if self.vectorCode == None:
+            return None
+        if any(isinstance(columns[field], tuple) for field in self.branchFields):
+            return None
+        names = {}
+        for field in self.fields:
+            column = columns[field]
+            if isinstance(column, tuple):
+                codes, values = column
+                column = np.array(list(values), dtype=object)[codes]
+            names[self.fieldNames[field]] = column
+        # Where evaluating a row would raise, such as dividing by zero, leave it to the rows to raise
+        try:
+            with np.errstate(divide='raise', over='raise', invalid='raise', under='ignore'):
+                result = eval(self.vectorCode, self.vectorGlobals, names)
+        except FloatingPointError:
+            return None
+        result = np.asarray(result)
+        if result.ndim == 0:
+            result = np.full(size, result.item(), dtype=object)
+        return result
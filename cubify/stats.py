@@ -0,0 +1,316 @@
+import math
+import numpy as np
+from bson.binary import Binary
+
+#
+# A bounded memory quantile sketch, in the style of KLL.
+#
+# Values are kept in levels of compactors: a value at level i stands for 2^i of the values added. When a level
+# holds more values than its capacity it is sorted and every other value is promoted to the next level. The top
+# level holds up to capacity values and each level below it 2/3 as many, so the sketch never holds much more
+# than 3 * capacity values. Until the first compaction every value is kept and quantiles are exact.
+#
+class QuantileSketch:
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.levels = []
+        self.count = 0
+        # Alternates between compactions, so that promoting odd or even positions does not bias the result
+        self.offset = 0
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == 0:
+            return
+        self.count += len(values)
+        self.__addToLevel__(0, values)
+
+    def merge(self, other):
+        self.count += other.count
+        for level, values in enumerate(other.levels):
+            self.__addToLevel__(level, values)
+
+    def __addToLevel__(self, level, values):
+        while len(self.levels) <= level:
+            self.levels.append(np.zeros(0, dtype=np.float64))
+        self.levels[level] = np.concatenate((self.levels[level], values))
+        self.__compact__()
+
+    def __getLevelCapacity__(self, level):
+        return max(2, int(self.capacity * (2.0 / 3) ** (len(self.levels) - 1 - level)))
+
+    def __compact__(self):
+        level = 0
+        while level < len(self.levels):
+            if len(self.levels[level]) <= self.__getLevelCapacity__(level):
+                level += 1
+                continue
+            values = np.sort(self.levels[level])
+            # An odd value out stays behind, so that no weight is lost
+            if len(values) % 2 == 1:
+                self.levels[level] = values[-1:]
+                values = values[:-1]
+            else:
+                self.levels[level] = np.zeros(0, dtype=np.float64)
+            promoted = values[self.offset::2]
+            self.offset = 1 - self.offset
+            if len(self.levels) == level + 1:
+                # A new top level shrinks the capacities of the levels below it, so start over
+                self.levels.append(promoted)
+                level = 0
+            else:
+                self.levels[level + 1] = np.concatenate((self.levels[level + 1], promoted))
+                level += 1
+
+    #
+    # State of the sketch as a dict that can be stored in MongoDB, and back
+    #
+    def getState(self):
+        return {"capacity": self.capacity, "count": self.count, "offset": self.offset,
+                "levels": [Binary(values.tobytes()) for values in self.levels]}
+
+    def setState(self, state):
+        self.capacity = state['capacity']
+        self.count = state['count']
+        self.offset = state['offset']
+        self.levels = [np.frombuffer(bytes(values), dtype=np.float64).copy() for values in state['levels']]
+
+    #
+    # Is every value added still held?
+    #
+    def isExact(self):
+        return all(len(values) == 0 for values in self.levels[1:])
+
+    #
+    # Value at quantile q (0 to 1). Interpolates between the two middle values like numpy's median when the
+    # sketch is exact.
+    #
+    def getQuantile(self, q):
+        if self.count == 0:
+            return float('nan')
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(levelValues), 2 ** level, dtype=np.int64)
+                                  for level, levelValues in enumerate(self.levels)])
+        order = np.argsort(values, kind='mergesort')
+        values = values[order]
+        cumulativeWeights = np.cumsum(weights[order])
+        total = cumulativeWeights[-1]
+        rank = q * (total - 1)
+        lower = values[np.searchsorted(cumulativeWeights, math.floor(rank), side='right')]
+        upper = values[np.searchsorted(cumulativeWeights, math.ceil(rank), side='right')]
+        return lower + (upper - lower) * (rank - math.floor(rank))
+
+    def getMedian(self):
+        return self.getQuantile(0.5)
+
+#
+# Streaming statistics of one measure: count, total, min and max are exact, the mean and variance are kept
+# as mergeable moments (Welford, with Chan et al.'s pairwise update to merge batches) and the median comes
+# from a quantile sketch.
+#
+# Values can be removed again. The count, total, mean and variance stay exact, but the sketch cannot forget
+# values: the measure is marked stale, and has no median until it is rebuilt from the remaining values or the
+# median is set from elsewhere. Removing a value equal to the min or max marks the bounds stale, to be set
+# again with setBounds.
+#
+class MeasureStats:
+
+    def __init__(self, sketchCapacity=4096):
+        self.count = 0
+        self.total = 0.0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+        self.sketch = QuantileSketch(sketchCapacity)
+        self.stale = False
+        self.boundsStale = False
+        # The exact median, when known from elsewhere: from values held in memory, or while the sketch is stale
+        self.median = None
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == 0:
+            return
+        mean = np.mean(values)
+        self.__mergeMoments__(len(values), np.sum(values), mean, np.sum((values - mean) ** 2),
+                              np.amin(values), np.amax(values))
+        self.sketch.add(values)
+        self.median = None
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        self.__mergeMoments__(other.count, other.total, other.mean, other.m2, other.min, other.max)
+        self.sketch.merge(other.sketch)
+        self.stale = self.stale or other.stale
+        self.boundsStale = self.boundsStale or other.boundsStale
+        self.median = None
+
+    def remove(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == 0:
+            return
+        count = len(values)
+        newCount = self.count - count
+        if newCount <= 0:
+            self.__init__(self.sketch.capacity)
+            return
+        # Chan et al.'s update, run backwards
+        mean = np.mean(values)
+        newMean = (self.count * self.mean - count * mean) / newCount
+        delta = mean - newMean
+        self.m2 = max(0.0, self.m2 - np.sum((values - mean) ** 2) - delta * delta * newCount * count / self.count)
+        self.mean = newMean
+        self.count = newCount
+        self.total = self.total - np.sum(values)
+        self.stale = True
+        self.median = None
+        if np.amin(values) <= self.min or np.amax(values) >= self.max:
+            self.boundsStale = True
+
+    def setBounds(self, minimum, maximum):
+        self.min = minimum
+        self.max = maximum
+        self.boundsStale = False
+
+    def __mergeMoments__(self, count, total, mean, m2, minimum, maximum):
+        newCount = self.count + count
+        delta = mean - self.mean
+        self.m2 = self.m2 + m2 + delta * delta * self.count * count / newCount
+        self.mean = self.mean + delta * count / newCount
+        self.count = newCount
+        self.total = self.total + total
+        self.min = min(self.min, minimum)
+        self.max = max(self.max, maximum)
+
+    def getState(self):
+        return {"count": self.count, "total": float(self.total), "mean": float(self.mean), "m2": float(self.m2),
+                "min": float(self.min), "max": float(self.max), "sketch": self.sketch.getState(), "stale": self.stale,
+                "boundsStale": self.boundsStale, "median": self.median}
+
+    def setState(self, state):
+        self.count = state['count']
+        self.total = state['total']
+        self.mean = state['mean']
+        self.m2 = state['m2']
+        self.min = state['min']
+        self.max = state['max']
+        self.sketch.setState(state['sketch'])
+        self.stale = state.get('stale', False)
+        self.boundsStale = state.get('boundsStale', False)
+        self.median = state.get('median')
+
+    def getStats(self):
+        median = self.median
+        if median == None and not self.stale:
+            median = float(self.sketch.getMedian())
+        return {"total": float(self.total),
+                "mean": float(self.mean),
+                "median": median,
+                "std": math.sqrt(self.m2 / self.count),
+                "min": float(self.min),
+                "max": float(self.max)}
+
+#
+# Streaming statistics of all the measures of a cube. Cube rows, or whole measure columns, are added in any
+# number of batches, and accumulators built separately - by parallel workers, or for appended rows - can be
+# merged. Memory use does not grow with the number of rows beyond the bounded median sketches.
+#
+# The state of an accumulator can be stored on a cube, so that stats can be brought up to date when rows are
+# appended without reading the existing rows again.
+#
+class StatsAccumulator:
+
+    def __init__(self, sketchCapacity=4096):
+        self.sketchCapacity = sketchCapacity
+        self.measures = {}
+
+    def getState(self):
+        return {"sketchCapacity": self.sketchCapacity,
+                "measures": dict((name, measureStats.getState()) for name, measureStats in self.measures.items())}
+
+    def setState(self, state):
+        self.sketchCapacity = state['sketchCapacity']
+        self.measures = {}
+        for name, measureState in state['measures'].items():
+            self.__getMeasureStats__(name).setState(measureState)
+
+    def __getMeasureStats__(self, name):
+        if name not in self.measures:
+            self.measures[name] = MeasureStats(self.sketchCapacity)
+        return self.measures[name]
+
+    #
+    # Add the values of one measure
+    #
+    def addValues(self, name, values):
+        if len(values) > 0:
+            self.__getMeasureStats__(name).add(values)
+
+    #
+    # Add the measures of a batch of cube rows
+    #
+    def addCubeRows(self, cubeRows):
+        for k, values in self.__getMeasureValues__(cubeRows).items():
+            self.addValues(k, values)
+
+    #
+    # Remove the measures of a batch of cube rows
+    #
+    def removeCubeRows(self, cubeRows):
+        for k, values in self.__getMeasureValues__(cubeRows).items():
+            if k in self.measures:
+                self.measures[k].remove(values)
+
+    def __getMeasureValues__(self, cubeRows):
+        measureValues = {}
+        for cubeRow in cubeRows:
+            for k, v in cubeRow['measures'].items():
+                if k not in measureValues:
+                    measureValues[k] = []
+                measureValues[k].append(v)
+        return measureValues
+
+    def merge(self, other):
+        for name, measureStats in other.measures.items():
+            self.__getMeasureStats__(name).merge(measureStats)
+
+    #
+    # Names of the measures whose median needs rebuilding after values were removed
+    #
+    def getStaleMeasureNames(self):
+        return [name for name, measureStats in self.measures.items()
+                if measureStats.stale and measureStats.median == None and measureStats.count > 0]
+
+    #
+    # Names of the measures whose min or max was removed
+    #
+    def getStaleBoundsMeasureNames(self):
+        return [name for name, measureStats in self.measures.items() if measureStats.boundsStale and measureStats.count > 0]
+
+    def setBounds(self, name, minimum, maximum):
+        self.measures[name].setBounds(minimum, maximum)
+
+    def setMedian(self, name, median):
+        self.measures[name].median = median
+
+    #
+    # Replace the stats of some measures with those of another accumulator, such as one rebuilt from scratch
+    #
+    def replaceMeasures(self, names, other):
+        for name in names:
+            self.measures.pop(name, None)
+            if name in other.measures:
+                self.measures[name] = other.measures[name]
+
+    #
+    # The stats dict stored on cubes: total, mean, median, std, min and max of each measure
+    #
+    def getStats(self):
+        stats = {}
+        for name, measureStats in self.measures.items():
+            if measureStats.count > 0:
+                stats[name] = measureStats.getStats()
+        return stats
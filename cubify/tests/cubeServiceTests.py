@@ -5,7 +5,18 @@ import uuid
 import math
 import json
 import csv
+from datetime import datetime
+from timestring import Date
 from cubify import CubeService
+from cubify import cubeservice
+from cubify.columnarcube import ColumnarCube
+from cubify.expressions import compileExpression, ColumnExpression
+from cubify.stats import StatsAccumulator, QuantileSketch
+from cubify.binning import CompiledRangeBinning, CompiledEnumBinning, CompiledDateBinning
+from datetime import timedelta
+from simpleeval import FeatureNotAvailable, NameNotDefined, NumberTooHigh, IterableTooLong
+import numpy as np
+import pymongo
 
 def funcx(cubeRow):
     if (cubeRow['dimensions']['State'] == 'CA'):
@@ -48,6 +59,43 @@ class cubeServiceTests(unittest.TestCase):
 
         os.remove(cubeName + '.csv')
 
+    def testCreateCubeRowsFromCsvTypeInference(self):
+        cubeName = 'test-' + str(uuid.uuid4())
+        with open(cubeName + '.csv', 'w') as csvfile:
+            csvfile.write('Code,Qty,Date\n100,1,2014-10-10\nA7,2,\n300,,2014-10-12\n')
+
+        cs = CubeService('testdb')
+        result = cs.createCubeRowsFromCsv(cubeName + '.csv')
+        cubeRows = result['cubeRows']
+        self.assertTrue(len(cubeRows) == 3)
+        self.assertTrue(cubeRows[0]['dimensions']['Code'] == '100')
+        self.assertTrue(cubeRows[1]['dimensions']['Code'] == 'A7')
+        self.assertTrue(cubeRows[2]['measures']['Qty'] == 0.0)
+        self.assertTrue(str(cubeRows[1]['dates']['Date'])[:10] == '1970-01-01')
+        self.assertTrue(result['distincts']['Code'] == {'100': 1, 'A7': 1, '300': 1})
+
+        # With a single row window, Code looks numeric
+        result = cs.createCubeRowsFromCsv(cubeName + '.csv', sampleSize=1)
+        cubeRows = result['cubeRows']
+        self.assertTrue(cubeRows[0]['measures']['Code'] == 100.0)
+        self.assertTrue(cubeRows[1]['measures']['Code'] == 0.0)
+
+        os.remove(cubeName + '.csv')
+
+    def testDateParser(self):
+        cs = CubeService('testdb')
+        for dateFormat in [None, '%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%Y/%m/%d']:
+            parseDate = cs.__getDateParser__(dateFormat)
+            for value in ['2014-10-10', '2014/01/31', '2014-10-10 10:10:10', '2014-10-10T23:59:59', '2014-1-5', '1970-01-01']:
+                d = Date(value)
+                self.assertEquals(parseDate(value), datetime(d.year, d.month, d.day))
+                # Second lookup is served from the cache
+                self.assertEquals(parseDate(value), datetime(d.year, d.month, d.day))
+            self.assertRaises(ValueError, parseDate, '2014-02-30')
+
+        parseDate = cs.__getDateParser__('%y-%m-%d')
+        self.assertRaises(ValueError, parseDate, '14-10-10')
+
     def testCreateCubeFromCsv(self):
         cubeName = 'test-' + str(uuid.uuid4())
         try:
@@ -58,6 +106,113 @@ class cubeServiceTests(unittest.TestCase):
         cs.createCubeFromCsv(cubeName + '.csv', cubeName)
         os.remove(cubeName + '.csv')
 
+    def testCreateCubeFromCsvStreaming(self):
+        cubeName = 'test-' + str(uuid.uuid4())
+        try:
+            shutil.copyfile('cubify/tests/testdata.csv', cubeName + '.csv')
+        except Exception:
+            shutil.copyfile('./testdata.csv', cubeName + '.csv')
+        cs = CubeService('testdb')
+        cube = cs.createCubeFromCsv(cubeName + '.csv', cubeName)
+        streamedCube = cs.createCubeFromCsv(cubeName + '.csv', cubeName + '_s', batchSize=4)
+
+        self.assertTrue(cs.getCubeRowsForCube(cubeName + '_s').count() == 14)
+        self.assertTrue(streamedCube['distincts'] == cube['distincts'])
+        for measure in cube['stats']:
+            for stat in cube['stats'][measure]:
+                self.assertAlmostEquals(streamedCube['stats'][measure][stat], cube['stats'][measure][stat])
+
+        rows = [cubeRow['dimensionKey'] for cubeRow in cs.getCubeRowsForCube(cubeName)]
+        streamedRows = [cubeRow['dimensionKey'] for cubeRow in cs.getCubeRowsForCube(cubeName + '_s')]
+        self.assertTrue(rows == streamedRows)
+
+        os.remove(cubeName + '.csv')
+
+    def testCreateCubeFromCsvParallel(self):
+        cubeName = 'test-' + str(uuid.uuid4())
+        testDataFileName = 'cubify/tests/testdata.csv'
+        if (os.path.isfile(testDataFileName) == False):
+            testDataFileName = './testdata.csv'
+        with open(testDataFileName) as testDataFile:
+            lines = testDataFile.readlines()
+        with open(cubeName + '.csv', 'w') as csvfile:
+            csvfile.write(lines[0])
+            for i in range(10):
+                csvfile.writelines(lines[1:])
+
+        cs = CubeService('testdb')
+        cube = cs.createCubeFromCsv(cubeName + '.csv', cubeName)
+        parallelCube = cs.createCubeFromCsv(cubeName + '.csv', cubeName + '_p', batchSize=8, workers=3)
+
+        self.assertTrue(parallelCube['distincts'] == cube['distincts'])
+        for measure in cube['stats']:
+            for stat in cube['stats'][measure]:
+                self.assertAlmostEquals(parallelCube['stats'][measure][stat], cube['stats'][measure][stat])
+
+        rows = dict((cubeRow['id'], cubeRow['dimensionKey']) for cubeRow in cs.getCubeRowsForCube(cubeName))
+        parallelRows = dict((cubeRow['id'], cubeRow['dimensionKey']) for cubeRow in cs.getCubeRowsForCube(cubeName + '_p'))
+        self.assertTrue(len(parallelRows) == 140)
+        self.assertTrue(parallelRows == rows)
+
+        # Workers connect to the server of the service that started them, so an injected client needs host
+        self.assertRaises(ValueError, CubeService('testdb', cs.client).createCubeFromCsv, cubeName + '.csv', cubeName + '_q', workers=3)
+        self.assertTrue(cs.getCube(cubeName + '_q') == None)
+        hostService = CubeService('testdb', cs.client, host='mongodb://localhost:27017')
+        self.assertTrue(hostService.createCubeFromCsv(cubeName + '.csv', cubeName + '_q', workers=3)['distincts'] == cube['distincts'])
+        workerService = cubeservice.__createWorkerCubeService__('testdb', hostService.clientOptions)
+        self.assertTrue(workerService.clientOptions == ('mongodb://localhost:27017', 1, None, None))
+
+        os.remove(cubeName + '.csv')
+
+    def testInMemoryColumnarCube(self):
+        cubeName = 'test-' + str(uuid.uuid4())
+        try:
+            shutil.copyfile('cubify/tests/testdata.csv', cubeName + '.csv')
+        except Exception:
+            shutil.copyfile('./testdata.csv', cubeName + '.csv')
+        cs = CubeService('testdb')
+        cube = cs.createCubeFromCsv(cubeName + '.csv', cubeName)
+        inMemoryCube = cs.createCubeFromCsv(cubeName + '.csv', cubeName + '_m', inMemory=True)
+
+        cubeRows = cs.getCubeRowsForCube(cubeName + '_m')
+        self.assertTrue(isinstance(cubeRows, ColumnarCube))
+        self.assertTrue(len(cubeRows) == 14)
+        self.assertTrue(inMemoryCube['distincts'] == cube['distincts'])
+        for measure in cube['stats']:
+            for stat in cube['stats'][measure]:
+                self.assertAlmostEquals(inMemoryCube['stats'][measure][stat], cube['stats'][measure][stat])
+
+        rows = dict((cubeRow['id'], (cubeRow['dimensionKey'], cubeRow['dimensions'], cubeRow['measures'], cubeRow['dates']))
+                    for cubeRow in cs.getCubeRowsForCube(cubeName))
+        inMemoryRows = dict((cubeRow['id'], (cubeRow['dimensionKey'], cubeRow['dimensions'], cubeRow['measures'], cubeRow['dates']))
+                            for cubeRow in cubeRows)
+        self.assertTrue(rows == inMemoryRows)
+
+        cs.addColumn(inMemoryCube, 'Revenue', 'numeric', "$['Qty'] * $['Price']")
+        self.assertTrue('Revenue' in cs.getCube(cubeName + '_m')['stats'])
+        for cubeRow in cs.getCubeRowsForCube(cubeName + '_m'):
+            self.assertTrue(cubeRow['measures']['Revenue'] == cubeRow['measures']['Price'] * cubeRow['measures']['Qty'])
+
+        binningFileName = 'cubify/tests/test_binnings.json'
+        if (os.path.isfile(binningFileName) == False):
+            binningFileName = './test_binnings.json'
+        with open(binningFileName) as binnings_file:
+            binnings = json.load(binnings_file)
+        binnedCube = cs.binCubeCustom(binnings, inMemoryCube, cubeName + '_mb')
+        self.assertTrue(isinstance(cs.getCubeRowsForCube(cubeName + '_mb'), ColumnarCube))
+
+        aggFileName = 'cubify/tests/test_agg.json'
+        if os.path.isfile(aggFileName) == False:
+            aggFileName = './test_agg.json'
+        with open(aggFileName) as agg_file:
+            aggs = json.load(agg_file)
+        cs.aggregateCubeCustom(binnedCube, aggs)
+        aggCubeRows = cs.getCubeRowsForCube(cubeName + '_mb_agg1')
+        self.assertTrue(isinstance(aggCubeRows, ColumnarCube))
+        self.assertTrue(len(aggCubeRows) == 4)
+
+        os.remove(cubeName + '.csv')
+
     def testCreateCubeFromCube(self):
         cubeName = 'test-' + str(uuid.uuid4())
         toCubeName = 'test2-' + str(uuid.uuid4())
@@ -81,6 +236,25 @@ class cubeServiceTests(unittest.TestCase):
 
         os.remove(cubeName + '.csv')
 
+    def testCubeIndexes(self):
+        cubeName = 'test-' + str(uuid.uuid4())
+        try:
+            shutil.copyfile('cubify/tests/testdata.csv', cubeName + '.csv')
+        except Exception:
+            shutil.copyfile('./testdata.csv', cubeName + '.csv')
+        cs = CubeService('testdb')
+        cube = cs.createCubeFromCsv(cubeName + '.csv', cubeName, indexes=['State', 'Date'])
+        self.assertTrue(cube['indexes'] == ['State', 'Date'])
+        self.assertTrue(cs.listCubeIndexes(cube) == ['Date', 'State', 'dimensionKey', 'id'])
+
+        cs.addCubeIndex(cube, 'Qty')
+        cs.dropCubeIndex(cube, 'State')
+        self.assertTrue(cs.listCubeIndexes(cube) == ['Date', 'Qty', 'dimensionKey', 'id'])
+        self.assertTrue(cs.getCube(cubeName)['indexes'] == ['Date', 'Qty'])
+        self.assertRaises(ValueError, cs.addCubeIndex, cube, 'NoSuchField')
+
+        os.remove(cubeName + '.csv')
+
     def testDeleteCube(self):
         cubeName = 'test-' + str(uuid.uuid4())
         try:
@@ -90,6 +264,18 @@ class cubeServiceTests(unittest.TestCase):
         cs = CubeService('testdb')
         cs.createCubeFromCsv(cubeName + '.csv', cubeName)
         cs.deleteCube(cubeName)
+
+        # In-memory cubes are created and deleted without the database
+        db = cs.db
+        class NoDb:
+            def __getitem__(self, name):
+                raise AssertionError('The database was used')
+        cs.db = NoDb()
+        cs.createCubeFromCsv(cubeName + '.csv', cubeName + '_m', inMemory=True)
+        self.assertTrue(cubeName + '_m' in cs.inMemoryStatsStates)
+        cs.deleteCube(cubeName + '_m')
+        self.assertTrue(cubeName + '_m' not in cs.inMemoryStatsStates and cubeName + '_m' not in cs.inMemoryCubes)
+        cs.db = db
         os.remove(cubeName + '.csv')
 
     def testGetStats(self):
@@ -121,6 +307,280 @@ class cubeServiceTests(unittest.TestCase):
 
         os.remove(cubeName + '.csv')
 
+    def testStatsAccumulator(self):
+        values = np.random.RandomState(7).normal(50.0, 10.0, 20000)
+
+        # Accumulators built over separate batches merge into the stats of all the values
+        statsAccumulator = StatsAccumulator()
+        for start in range(0, 10000, 1000):
+            statsAccumulator.addValues('Qty', values[start:start + 1000])
+        otherAccumulator = StatsAccumulator()
+        otherAccumulator.addValues('Qty', values[10000:])
+        statsAccumulator.merge(otherAccumulator)
+        stats = statsAccumulator.getStats()['Qty']
+        self.assertAlmostEqual(stats['total'], np.sum(values), 6)
+        self.assertAlmostEqual(stats['mean'], np.mean(values), 9)
+        self.assertAlmostEqual(stats['std'], np.std(values), 9)
+        self.assertTrue(stats['min'] == np.amin(values) and stats['max'] == np.amax(values))
+        self.assertTrue(abs(stats['median'] - np.median(values)) < 0.5)
+
+        # The median sketch is exact until it first compacts, and bounded in size after that
+        sketch = QuantileSketch(1000)
+        sketch.add(values[:1000])
+        self.assertTrue(sketch.isExact() and sketch.getMedian() == np.median(values[:1000]))
+        sketch.add(values[1000:])
+        self.assertFalse(sketch.isExact())
+        self.assertTrue(all(len(levelValues) <= 1000 for levelValues in sketch.levels))
+        self.assertTrue(abs(sketch.getMedian() - np.median(values)) < 0.5)
+
+    def testExactMedians(self):
+        cubeName = 'test-' + str(uuid.uuid4())
+        testDataFileName = 'cubify/tests/testdata.csv'
+        if (os.path.isfile(testDataFileName) == False):
+            testDataFileName = './testdata.csv'
+        with open(testDataFileName) as testDataFile:
+            lines = testDataFile.readlines()
+        random = np.random.RandomState(11)
+        with open(cubeName + '.csv', 'w') as csvfile:
+            csvfile.write(lines[0])
+            for i in range(400):
+                for line in lines[1:]:
+                    values = line.rstrip('\r\n').split(',')
+                    values[-1] = str(random.randint(1, 100000) / 100.0)
+                    csvfile.write(','.join(values) + '\n')
+
+        # With more rows than the median sketches hold, medians of rows in memory are still exact
+        cs = CubeService('testdb')
+        for inMemory in [False, True]:
+            name = cubeName + ('_m' if inMemory else '')
+            cube = cs.createCubeFromCsv(cubeName + '.csv', name, inMemory=inMemory)
+            cubeRows = list(cs.getCubeRowsForCube(name))
+            self.assertTrue(len(cubeRows) > 4096)
+            for measure in cube['stats']:
+                values = [cubeRow['measures'][measure] for cubeRow in cubeRows]
+                self.assertTrue(cube['stats'][measure]['median'] == np.median(values))
+                self.assertTrue(cs.getStats(cubeRows)[measure]['median'] == np.median(values))
+
+        # Including after appending to an in-memory cube
+        cube = cs.appendToCubeFromCsv(cubeName + '.csv', cs.getCube(cubeName + '_m'))
+        cubeRows = list(cs.getCubeRowsForCube(cubeName + '_m'))
+        for measure in cube['stats']:
+            self.assertTrue(cube['stats'][measure]['median'] == np.median([cubeRow['measures'][measure] for cubeRow in cubeRows]))
+
+        os.remove(cubeName + '.csv')
+
+    def testServerSideSummaries(self):
+        cubeName = 'test-' + str(uuid.uuid4())
+        try:
+            shutil.copyfile('cubify/tests/testdata.csv', cubeName + '.csv')
+        except Exception:
+            shutil.copyfile('./testdata.csv', cubeName + '.csv')
+        cs = CubeService('testdb', serverSideSummaries=True)
+        cube = cs.createCubeFromCsv(cubeName + '.csv', cubeName)
+
+        calls = []
+        getStatsFromDb = cs.getStatsFromDb
+        getDistinctsFromDb = cs.getDistinctsFromDb
+        def countedGetStatsFromDb(cube, measureNames=None):
+            calls.append('stats')
+            return getStatsFromDb(cube, measureNames)
+        def countedGetDistinctsFromDb(cube):
+            calls.append('distincts')
+            return getDistinctsFromDb(cube)
+        cs.getStatsFromDb = countedGetStatsFromDb
+        cs.getDistinctsFromDb = countedGetDistinctsFromDb
+
+        # Without a stats state, stats computed inside MongoDB match those computed from the cube rows
+        cs.__deleteCubeStatsState__(cubeName)
+        cube = cs.appendToCubeFromCsv(cubeName + '.csv', cube)
+        self.assertTrue('stats' in calls)
+        self.assertTrue(getDistinctsFromDb(cube) == cube['distincts'])
+        self.assertTrue('2014-10-10' in cube['distincts']['Date'])
+        stats = cs.getStats(list(cs.getCubeRowsForCube(cubeName)))
+        for measure in stats:
+            for stat in stats[measure]:
+                self.assertAlmostEqual(cube['stats'][measure][stat], stats[measure][stat])
+
+        # Deleting from a cube without a stats state summarizes it again inside MongoDB
+        del calls[:]
+        cs.deleteCubeRows(cubeName, { "dimensions.State": "CA" })
+        self.assertTrue('stats' in calls and 'distincts' in calls)
+        cube = cs.getCube(cubeName)
+        cubeRows = list(cs.getCubeRowsForCube(cubeName))
+        stats = cs.getStats(cubeRows)
+        for measure in stats:
+            for stat in stats[measure]:
+                self.assertAlmostEqual(cube['stats'][measure][stat], stats[measure][stat])
+        self.assertTrue('CA' not in cube['distincts']['State'])
+
+        # With a stats state, stale medians are found inside MongoDB
+        os.remove(cubeName + '.csv')
+        cubeName = 'test-' + str(uuid.uuid4())
+        try:
+            shutil.copyfile('cubify/tests/testdata.csv', cubeName + '.csv')
+        except Exception:
+            shutil.copyfile('./testdata.csv', cubeName + '.csv')
+        cube = cs.createCubeFromCsv(cubeName + '.csv', cubeName)
+        def failOnScan(cubeName):
+            raise AssertionError('Cube rows were read')
+        cs.__getStoredCubeRows__ = failOnScan
+        del calls[:]
+        cs.deleteCubeRows(cubeName, { "dimensions.State": "CA" })
+        del cs.__getStoredCubeRows__
+        self.assertTrue(calls == ['stats'])
+        cube = cs.getCube(cubeName)
+        cubeRows = list(cs.getCubeRowsForCube(cubeName))
+        stats = cs.getStats(cubeRows)
+        cubeStats = cs.getCubeStats(cube)
+        self.assertTrue(cubeStats == cube['stats'])
+        for measure in stats:
+            for stat in stats[measure]:
+                self.assertAlmostEqual(cubeStats[measure][stat], stats[measure][stat])
+        self.assertTrue('CA' not in cube['distincts']['State'])
+        self.assertTrue(sum(cube['distincts']['State'].values()) == len(cubeRows))
+        self.assertTrue(sum(cube['distincts']['Date'].values()) == len(cubeRows))
+
+        os.remove(cubeName + '.csv')
+
+    def testIncrementalAppend(self):
+        cubeName = 'test-' + str(uuid.uuid4())
+        try:
+            shutil.copyfile('cubify/tests/testdata.csv', cubeName + '.csv')
+        except Exception:
+            shutil.copyfile('./testdata.csv', cubeName + '.csv')
+        cs = CubeService('testdb')
+        cube = cs.createCubeFromCsv(cubeName + '.csv', cubeName)
+        numCubeRows = len(list(cs.getCubeRowsForCube(cubeName)))
+        self.assertTrue(cube['maxId'] == numCubeRows)
+        # The stats state is kept apart from the cube document
+        self.assertTrue('statsState' not in cube and cs.db['cubeStatsState'].find_one({ "name": cubeName }) != None)
+
+        # Appending does not read the existing cube rows
+        def failOnScan(cubeName):
+            raise AssertionError('Existing cube rows were read')
+        cs.__getStoredCubeRows__ = failOnScan
+        cube = cs.appendToCubeFromCsv(cubeName + '.csv', cube)
+        del cs.__getStoredCubeRows__
+
+        cubeRows = list(cs.getCubeRowsForCube(cubeName))
+        self.assertTrue(len(cubeRows) == 2 * numCubeRows)
+        stats = cs.getStats(cubeRows)
+        cube = cs.getCube(cubeName)
+        for measure in stats:
+            for stat in stats[measure]:
+                self.assertAlmostEqual(cube['stats'][measure][stat], stats[measure][stat])
+        self.assertTrue(cube['maxId'] == 2 * numCubeRows)
+
+        # Ids carry on from the counter after rows are deleted
+        cs.deleteCubeRows(cubeName, { "id": { "$gt": numCubeRows }})
+        cube = cs.appendToCubeFromCsv(cubeName + '.csv', cs.getCube(cubeName))
+        ids = [cubeRow['id'] for cubeRow in cs.getCubeRowsForCube(cubeName)]
+        self.assertTrue(len(ids) == len(set(ids)) == 2 * numCubeRows)
+        self.assertTrue(max(ids) == 3 * numCubeRows)
+
+        os.remove(cubeName + '.csv')
+
+    def testIncrementalDelete(self):
+        cubeName = 'test-' + str(uuid.uuid4())
+        try:
+            shutil.copyfile('cubify/tests/testdata.csv', cubeName + '.csv')
+        except Exception:
+            shutil.copyfile('./testdata.csv', cubeName + '.csv')
+        cs = CubeService('testdb')
+        cube = cs.createCubeFromCsv(cubeName + '.csv', cubeName)
+        dateCounts = dict(cube['distincts']['Date'])
+
+        # Only the deleted rows are read
+        def failOnScan(cubeName):
+            raise AssertionError('All cube rows were read')
+        cs.__getStoredCubeRows__ = failOnScan
+        cs.deleteCubeRows(cubeName, { "dimensions.State": "CA" })
+        del cs.__getStoredCubeRows__
+
+        cube = cs.getCube(cubeName)
+        cubeRows = list(cs.getCubeRowsForCube(cubeName))
+        self.assertTrue('CA' not in cube['distincts']['State'])
+        self.assertTrue(sum(cube['distincts']['State'].values()) == len(cubeRows))
+        self.assertTrue(sum(cube['distincts']['Date'].values()) == len(cubeRows))
+        self.assertTrue(set(cube['distincts']['Date']) <= set(dateCounts))
+
+        # The stats are exact straight away, medians included
+        stats = cs.getStats(cubeRows)
+        for measure in stats:
+            self.assertTrue(cube['stats'][measure]['median'] != None)
+            for stat in stats[measure]:
+                self.assertAlmostEqual(cube['stats'][measure][stat], stats[measure][stat])
+        self.assertTrue(cs.getCubeStats(cube) == cube['stats'])
+        statsState = cs.db['cubeStatsState'].find_one({ "name": cubeName })['state']
+        self.assertTrue(len(statsState['measures']) > 0)
+        self.assertFalse(any(measureState['stale'] or measureState['boundsStale'] for measureState in statsState['measures'].values()))
+
+        # Stale bounds survive the stats state being saved and loaded
+        statsAccumulator = StatsAccumulator()
+        statsAccumulator.addValues('Qty', np.array([1.0, 2.0, 3.0]))
+        statsAccumulator.removeCubeRows([{ 'measures': { 'Qty': 3.0 }}])
+        reloadedAccumulator = StatsAccumulator()
+        reloadedAccumulator.setState(statsAccumulator.getState())
+        self.assertTrue(reloadedAccumulator.getStaleBoundsMeasureNames() == ['Qty'])
+
+        os.remove(cubeName + '.csv')
+
+    def testQueryCube(self):
+        cubeName = 'test-' + str(uuid.uuid4())
+        try:
+            shutil.copyfile('cubify/tests/testdata.csv', cubeName + '.csv')
+        except Exception:
+            shutil.copyfile('./testdata.csv', cubeName + '.csv')
+        cs = CubeService('testdb')
+        cube = cs.createCubeFromCsv(cubeName + '.csv', cubeName)
+        inMemoryCube = cs.createCubeFromCsv(cubeName + '.csv', cubeName + '_m', inMemory=True)
+        cubeRows = list(cs.getCubeRowsForCube(cubeName))
+
+        # Expected groups, worked out from the cube rows
+        expected = {}
+        for cubeRow in cubeRows:
+            if cubeRow['dimensions']['State'] not in ['CA', 'NY'] or cubeRow['dates']['Date'] < datetime(2014, 10, 11):
+                continue
+            key = (cubeRow['dimensions']['State'], cubeRow['dimensions']['ProductId'])
+            group = expected.setdefault(key, { 'TotalQty': 0.0, 'Rows': 0, 'MaxPrice': None })
+            group['TotalQty'] += cubeRow['measures']['Qty']
+            group['Rows'] += 1
+            group['MaxPrice'] = max(group['MaxPrice'], cubeRow['measures']['Price'])
+        expectedKeys = sorted(expected, key=lambda key: (-expected[key]['TotalQty'], key))[:3]
+
+        measures = [{ 'name': 'TotalQty', 'measure': 'Qty', 'aggOperator': 'sum' },
+                    { 'name': 'Rows', 'aggOperator': 'count' },
+                    { 'name': 'MaxPrice', 'measure': 'Price', 'aggOperator': 'max' }]
+        for queriedCube in [cube, inMemoryCube]:
+            results = cs.queryCube(queriedCube, filters={ 'State': ['CA', 'NY'] }, dateRanges={ 'Date': { 'min': '2014-10-11' }},
+                                   groupBy=['State', 'ProductId'], measures=measures,
+                                   orderBy=[('TotalQty', pymongo.DESCENDING), 'State', 'ProductId'], limit=3)
+            self.assertTrue([(result['dimensions']['State'], result['dimensions']['ProductId']) for result in results] == expectedKeys)
+            for result in results:
+                group = expected[(result['dimensions']['State'], result['dimensions']['ProductId'])]
+                self.assertTrue(result['measures'] == group)
+
+            # Cube rows, without grouping
+            results = cs.queryCube(queriedCube, filters={ 'ProductId': 'P1' }, orderBy=[('Price', pymongo.DESCENDING), 'id'], limit=2)
+            p1Rows = sorted([cubeRow for cubeRow in cubeRows if cubeRow['dimensions']['ProductId'] == 'P1'],
+                            key=lambda cubeRow: (-cubeRow['measures']['Price'], cubeRow['id']))
+            self.assertTrue([result['id'] for result in results] == [cubeRow['id'] for cubeRow in p1Rows[:2]])
+
+            # Dates are grouped by day
+            results = cs.queryCube(queriedCube, groupBy=['Date'], measures=[{ 'name': 'Rows', 'aggOperator': 'count' }])
+            self.assertTrue(dict((result['dimensions']['Date'], result['measures']['Rows']) for result in results) ==
+                            dict((str(date)[:10], count) for date, count in
+                                 [(cubeRow['dates']['Date'], sum(1 for other in cubeRows if other['dates']['Date'] == cubeRow['dates']['Date']))
+                                  for cubeRow in cubeRows]))
+
+        # An empty cube has nothing to return
+        cs.deleteCubeRows(cubeName, {})
+        cube = cs.getCube(cubeName)
+        self.assertTrue(cs.queryCube(cube, orderBy=['Qty']) == [])
+        self.assertTrue(cs.queryCube(cube, groupBy=['State'], measures=measures, orderBy=['TotalQty']) == [])
+
+        os.remove(cubeName + '.csv')
+
     def testBinning(self):
         cubeName = 'test-' + str(uuid.uuid4())
         try:
@@ -159,6 +619,152 @@ class cubeServiceTests(unittest.TestCase):
 
         os.remove(cubeName + '.csv')
 
+    def testCompiledRangeBinning(self):
+        # Overlapping bins, gaps and a single point bin: the first matching bin wins, as with a linear scan
+        binning = { "type": "range", "sourceField": "Qty", "outputField": { "name": "QtyBin" }, "fallbackLabel": "Other",
+                    "bins": [ { "label": "Low", "min": 0, "max": 5 },
+                              { "label": "Mid", "min": 3, "max": 10 },
+                              { "label": "Twelve", "min": 12, "max": 12 },
+                              { "label": "Low", "min": 20, "max": 30.5 } ] }
+        compiledBinning = CompiledRangeBinning(binning)
+        cs = CubeService('testdb')
+        values = [-1, 0, 2.5, 3, 5, 5.5, 10, 11, 12, 12.1, 20, 30.5, 31, float('nan')]
+        labels = [cs.__getNumericBinLabel__(value, binning) for value in values]
+        self.assertTrue([compiledBinning.getLabel(value) for value in values] == labels)
+        codes = compiledBinning.getCodes(np.array(values)).tolist()
+        self.assertTrue([compiledBinning.labels[code] for code in codes] == labels)
+        self.assertTrue(sorted(compiledBinning.labels) == ['Low', 'Mid', 'Other', 'Twelve'])
+
+    def testCompiledEnumBinning(self):
+        # GA is listed twice: the first bin wins, as with a linear scan
+        binning = { "type": "enum", "sourceField": "State", "outputField": { "name": "Region" }, "fallbackLabel": "Other",
+                    "bins": [ { "label": "West", "value": "CA" },
+                              { "label": "South", "value": "GA" },
+                              { "label": "East", "value": "GA" },
+                              { "label": "West", "value": "OR" } ] }
+        compiledBinning = CompiledEnumBinning(binning)
+        cs = CubeService('testdb')
+        values = ['CA', 'GA', 'OR', 'NY', u'CA']
+        labels = [cs.__getStringBinLabel__(value, binning) for value in values]
+        self.assertTrue([compiledBinning.getLabel(value) for value in values] == labels)
+        codes = compiledBinning.getCodes(np.array([0, 1, 2, 3, -1]), ['CA', 'GA', 'OR', 'NY']).tolist()
+        self.assertTrue([compiledBinning.labels[code] for code in codes] == ['West', 'South', 'West', 'Other', 'Other'])
+
+    def testCompiledDateBinning(self):
+        dates = [datetime(1969, 12, 28) + timedelta(days=i * 13) for i in range(0, 1000)]
+        dates += [datetime(2014, 12, 29), datetime(2015, 12, 31), datetime(2016, 1, 3), datetime(2016, 1, 4)]
+        column = np.array(dates, dtype='datetime64[s]')
+
+        for period in ['weekly', 'monthly', 'yearly']:
+            compiledBinning = CompiledDateBinning({ "type": "date", "period": period })
+            labels = []
+            for d in dates:
+                if period == 'weekly':
+                    year, week, weekday = d.isocalendar()
+                    labels.append(str(year) + ('0' if week < 10 else '') + str(week))
+                elif period == 'monthly':
+                    labels.append(str(d.year) + ('0' if d.month < 10 else '') + str(d.month))
+                else:
+                    labels.append(str(d.year))
+            self.assertTrue([compiledBinning.getLabel(d) for d in dates] == labels)
+            self.assertTrue([compiledBinning.labels[code] for code in compiledBinning.getCodes(column).tolist()] == labels)
+
+        # Custom bins compare dates chronologically
+        compiledBinning = CompiledDateBinning({ "type": "date", "fallbackLabel": "Other",
+                                                "bins": [ { "label": "Spring", "min": "2014-03-15", "max": "2014-06-10" },
+                                                          { "label": "Later", "min": "2014-06-01", "max": "2014-12-31" } ] })
+        self.assertTrue(compiledBinning.getLabel(datetime(2014, 4, 1)) == 'Spring')
+        self.assertTrue(compiledBinning.getLabel('2014-06-05') == 'Spring')
+        self.assertTrue(compiledBinning.getLabel(datetime(2014, 6, 11, 10, 30)) == 'Later')
+        self.assertTrue(compiledBinning.getLabel(datetime(2014, 3, 14)) == 'Other')
+        codes = compiledBinning.getCodes(np.array(['2014-04-01', '2014-06-11', 'NaT'], dtype='datetime64[s]')).tolist()
+        self.assertTrue(codes[2] == -1)
+        self.assertTrue([compiledBinning.labels[code] for code in codes[:2]] == ['Spring', 'Later'])
+
+    def testBinningColumnar(self):
+        cubeName = 'test-' + str(uuid.uuid4())
+        try:
+            shutil.copyfile('cubify/tests/testdata.csv', cubeName + '.csv')
+        except Exception:
+            shutil.copyfile('./testdata.csv', cubeName + '.csv')
+        cs = CubeService('testdb')
+        cube = cs.createCubeFromCsv(cubeName + '.csv', cubeName)
+        inMemoryCube = cs.createCubeFromCsv(cubeName + '.csv', cubeName + '_m', inMemory=True)
+        binningFileName = 'cubify/tests/test_binnings.json'
+        if (os.path.isfile(binningFileName) == False):
+            binningFileName = './test_binnings.json'
+        with open(binningFileName) as binnings_file:
+            binnings = json.load(binnings_file)
+
+        # Binning the columns of an in-memory cube gives the same rows as binning a persisted cube row by row
+        binnedCube = cs.binCubeCustom(binnings, cube, cubeName + '_b')
+        inMemoryBinnedCube = cs.binCubeCustom(binnings, inMemoryCube, cubeName + '_mb')
+        self.assertTrue(isinstance(cs.getCubeRowsForCube(cubeName + '_mb'), ColumnarCube))
+        self.assertTrue(inMemoryBinnedCube['distincts'] == binnedCube['distincts'])
+        rows = dict((cubeRow['id'], (cubeRow['dimensionKey'], cubeRow['dimensions']))
+                    for cubeRow in cs.getCubeRowsForCube(cubeName + '_b'))
+        inMemoryRows = dict((cubeRow['id'], (cubeRow['dimensionKey'], cubeRow['dimensions']))
+                            for cubeRow in cs.getCubeRowsForCube(cubeName + '_mb'))
+        self.assertTrue(rows == inMemoryRows)
+
+        # The source cube is left untouched, and the binned cube shares its columns
+        sourceCubeRows = cs.getCubeRowsForCube(cubeName + '_m')
+        binnedCubeRows = cs.getCubeRowsForCube(cubeName + '_mb')
+        self.assertTrue('QtyBin' not in sourceCubeRows[0]['dimensions'])
+        self.assertTrue(binnedCubeRows.getMeasure('Qty') is sourceCubeRows.getMeasure('Qty'))
+        self.assertTrue(binnedCubeRows.getDate('Date') is sourceCubeRows.getDate('Date'))
+
+        # Binned rows share the measures and dates of their source row, and only copy the dimensions
+        cubeRow = sourceCubeRows[0]
+        binnedCubeRow = cs.__performBinning__(binnings, cubeRow, {})
+        self.assertTrue(binnedCubeRow['measures'] is cubeRow['measures'])
+        self.assertTrue(binnedCubeRow['dates'] is cubeRow['dates'])
+        self.assertTrue('QtyBin' in binnedCubeRow['dimensions'] and 'QtyBin' not in cubeRow['dimensions'])
+
+        os.remove(cubeName + '.csv')
+
+    def testBinningParallel(self):
+        cubeName = 'test-' + str(uuid.uuid4())
+        try:
+            shutil.copyfile('cubify/tests/testdata.csv', cubeName + '.csv')
+        except Exception:
+            shutil.copyfile('./testdata.csv', cubeName + '.csv')
+        cs = CubeService('testdb')
+        cube = cs.createCubeFromCsv(cubeName + '.csv', cubeName)
+        binningFileName = 'cubify/tests/test_binnings.json'
+        if (os.path.isfile(binningFileName) == False):
+            binningFileName = './test_binnings.json'
+        with open(binningFileName) as binnings_file:
+            binnings = json.load(binnings_file)
+
+        # Binning with several workers gives the same rows, distincts and stats as binning serially
+        binnedCube = cs.binCubeCustom(binnings, cube, cubeName + '_b')
+        parallelBinnedCube = cs.binCubeCustom(binnings, cube, cubeName + '_pb', workers=3)
+        self.assertTrue(parallelBinnedCube['distincts'] == binnedCube['distincts'])
+        for measure, stats in binnedCube['stats'].items():
+            for stat, value in stats.items():
+                self.assertAlmostEqual(parallelBinnedCube['stats'][measure][stat], value)
+        rows = dict((cubeRow['id'], cubeRow['dimensionKey']) for cubeRow in cs.getCubeRowsForCube(cubeName + '_b'))
+        parallelRows = dict((cubeRow['id'], cubeRow['dimensionKey']) for cubeRow in cs.getCubeRowsForCube(cubeName + '_pb'))
+        self.assertTrue(rows == parallelRows)
+
+        binnedCube = cs.rebinCubeCustom(binnings, cube, cubeName + '_pb', workers=2)
+        self.assertTrue(cs.getCubeRowsForCube(cubeName + '_pb').count() == len(rows))
+        self.assertTrue(binnedCube['distincts'] == parallelBinnedCube['distincts'])
+
+        inMemoryCube = cs.createCubeFromCsv(cubeName + '.csv', cubeName + '_m', inMemory=True)
+        self.assertRaises(ValueError, cs.binCubeCustom, binnings, inMemoryCube, cubeName + '_mb', 2)
+
+        # Workers bin on the server of the service that started them, so an injected client needs host
+        clientService = CubeService('testdb', cs.client)
+        self.assertRaises(ValueError, clientService.binCubeCustom, binnings, cube, cubeName + '_qb', 2)
+        self.assertRaises(ValueError, clientService.rebinCubeCustom, binnings, cube, cubeName + '_pb', 2)
+        self.assertTrue(cs.getCube(cubeName + '_qb') == None)
+        hostService = CubeService('testdb', cs.client, host='mongodb://localhost:27017')
+        self.assertTrue(hostService.binCubeCustom(binnings, cube, cubeName + '_qb', 2)['distincts'] == binnedCube['distincts'])
+
+        os.remove(cubeName + '.csv')
+
     def testBinningDateMonthly(self):
         cubeName = 'test-' + str(uuid.uuid4())
         try:
@@ -258,7 +864,18 @@ class cubeServiceTests(unittest.TestCase):
                 bins.append({ "label": "3+", "min" : 4, "max": 99999999})
                 binning['bins'] = bins
 
+        # A failed re-binning leaves the binned cube and no staging collection behind
+        def failToIndex(cubeName, indexes):
+            raise RuntimeError('Indexing failed')
+        cs.__createCubeIndexes__ = failToIndex
+        self.assertRaises(RuntimeError, cs.rebinCubeCustom, binnings, cube, cubeName + "_b")
+        del cs.__createCubeIndexes__
+        self.assertTrue(len([name for name in cs.db.collection_names() if name.startswith(cubeName + '_b_staging')]) == 0)
+        self.assertTrue(cs.db[cubeName + '_b'].count() == cs.db[cubeName].count())
+
         binnedCube = cs.rebinCubeCustom(binnings, cube, cubeName + "_b")
+        self.assertTrue(binnedCube['binnings'] == binnings)
+        self.assertTrue(len([name for name in cs.db.collection_names() if name.startswith(cubeName + '_b_staging')]) == 0)
         binnedCubeRows = cs.getCubeRows(binnedCube)
         dimkeys = []
         for binnedCubeRow in binnedCubeRows:
@@ -833,6 +1450,222 @@ class cubeServiceTests(unittest.TestCase):
 
         os.remove(cubeName + '.csv')
 
+    def testCustomAggregationColumnar(self):
+        cubeName = 'test-' + str(uuid.uuid4())
+        try:
+            shutil.copyfile('cubify/tests/testdata.csv', cubeName + '.csv')
+        except Exception:
+            shutil.copyfile('./testdata.csv', cubeName + '.csv')
+        cs = CubeService('testdb')
+        cube = cs.createCubeFromCsv(cubeName + '.csv', cubeName)
+        binningFileName = 'cubify/tests/test_binnings.json'
+        if (os.path.isfile(binningFileName) == False):
+            binningFileName = './test_binnings.json'
+        with open(binningFileName) as binnings_file:
+            binnings = json.load(binnings_file)
+        binnedCube = cs.binCubeCustom(binnings, cube, cubeName + '_b')
+
+        aggFileName = 'cubify/tests/test_agg.json'
+        if os.path.isfile(aggFileName) == False:
+            aggFileName = './test_agg.json'
+        with open(aggFileName) as agg_file:
+            aggs = json.load(agg_file)
+        aggs.append({ "name": "agg4", "dimensions": ["Date", "State"],
+                      "measures": [ { "outputField": { "name": "MaxQtyPerMinPrice" },
+                                      "formula": { "numerator": { "aggOperator": "max", "expression": "Qty + 1" },
+                                                   "denominator": { "aggOperator": "min", "expression": "Price" } } } ] })
+
+        # The vectorized accumulators must match the row by row ones exactly
+        columnarCube = ColumnarCube()
+        columnarCube.appendRows(cs.getCubeRowsForCube(cubeName + '_b'))
+        self.assertTrue(cs.__accumulateAggsColumnar__(columnarCube, aggs) == cs.__accumulateAggsByRow__(columnarCube, aggs))
+
+        cs.aggregateCubeCustom(binnedCube, aggs)
+        aggCubeRows = cs.getCubeRowsForCube(cubeName + '_b_agg4')
+        self.assertTrue(aggCubeRows.count() == 10)
+        for aggCubeRow in aggCubeRows:
+            self.assertTrue(len(aggCubeRow['dimensions']) == 2)
+
+        # Aggregating in batches gives the same agg cubes
+        aggCubeMeasures = {}
+        for agg in aggs:
+            for aggCubeRow in cs.getCubeRowsForCube(cubeName + '_b_' + agg['name']):
+                aggCubeMeasures[(agg['name'], aggCubeRow['dimensionKey'])] = aggCubeRow['measures']
+        cs.aggregateCubeCustom(binnedCube, aggs, batchSize=3)
+        batchedAggCubeMeasures = {}
+        for agg in aggs:
+            for aggCubeRow in cs.getCubeRowsForCube(cubeName + '_b_' + agg['name']):
+                batchedAggCubeMeasures[(agg['name'], aggCubeRow['dimensionKey'])] = aggCubeRow['measures']
+        self.assertTrue(set(batchedAggCubeMeasures) == set(aggCubeMeasures))
+        for key, measures in aggCubeMeasures.items():
+            for measure in measures:
+                self.assertAlmostEqual(batchedAggCubeMeasures[key][measure], measures[measure])
+
+        # Re-aggregating swaps the new agg cube rows in from a staging collection
+        cs.addCubeIndex(cs.getCube(cubeName + '_b_agg4'), 'State')
+        cs.aggregateCubeCustom(binnedCube, aggs)
+        self.assertTrue(cs.getCubeRowsForCube(cubeName + '_b_agg4').count() == 10)
+        self.assertTrue('State' in cs.listCubeIndexes(cs.getCube(cubeName + '_b_agg4')))
+        self.assertTrue(len([name for name in cs.db.collection_names() if name.startswith(cubeName + '_b_agg4_staging')]) == 0)
+        self.assertTrue(cs.db['cube'].find({ "name": cubeName + '_b_agg4' }).count() == 1)
+
+        # Dividing by zero raises as it does row by row, rather than storing inf or nan
+        badAggs = [{ "name": "agg5", "dimensions": ["State"],
+                     "measures": [ { "outputField": { "name": "Bad" },
+                                     "formula": { "numerator": { "aggOperator": "sum", "expression": "Qty / (Price - Price)" },
+                                                  "denominator": {} } } ] }]
+        self.assertTrue(cs.__accumulateAggsColumnar__(columnarCube, badAggs) == None)
+        self.assertRaises(ZeroDivisionError, cs.aggregateCubeCustom, binnedCube, badAggs)
+        self.assertTrue(cs.getCube(cubeName + '_b_agg5') == None)
+
+        os.remove(cubeName + '.csv')
+
+    def testCompiledExpression(self):
+        expression = compileExpression("Qty * Price / 2")
+        self.assertTrue(expression.names == set(['Qty', 'Price']))
+        self.assertTrue(expression.vectorizable)
+        self.assertTrue(expression.evaluate({'Qty': 3, 'Price': 5}) == 7.5)
+        values = expression.evaluateColumns({'Qty': np.array([3.0, 1.0]), 'Price': np.array([5.0, 4.0])})
+        self.assertTrue(values.tolist() == [7.5, 2.0])
+
+        expression = compileExpression("1 if State == 'CA' else 0")
+        self.assertFalse(expression.vectorizable)
+        self.assertTrue(expression.evaluate({'State': 'CA'}) == 1)
+        self.assertRaises(NameNotDefined, expression.evaluate, {})
+
+        self.assertRaises(FeatureNotAvailable, compileExpression, "State.__class__")
+        self.assertRaises(FeatureNotAvailable, compileExpression, "open('x')")
+
+        # Huge powers and repeats fail fast, as with simple_eval
+        self.assertRaises(NumberTooHigh, compileExpression('Qty**Qty**Qty').evaluate, {'Qty': 9})
+        self.assertRaises(IterableTooLong, compileExpression("State * 10**6").evaluate, {'State': 'CA'})
+        self.assertTrue(compileExpression('Qty**2 * 2').evaluate({'Qty': 3}) == 18)
+
+    def testColumnExpression(self):
+        expression = ColumnExpression("$['Qty'] * $[\"Price\"] if $['Qty'] > 1 and $['Qty'] < 4 else 0")
+        self.assertTrue(expression.fields == ['Qty', 'Price'])
+        self.assertTrue(expression.evaluate({'Qty': 3, 'Price': 5}) == 15)
+        values = expression.evaluateColumns(3, {'Qty': np.array([3.0, 1.0, 2.0]), 'Price': np.array([5.0, 4.0, 1.5])})
+        self.assertTrue(values.tolist() == [15.0, 0.0, 3.0])
+
+        # Dimension only expressions are evaluated once per distinct value
+        expression = ColumnExpression("'Category1' if $['ProductId'] == 'P1' else 'Cat' + str(2)")
+        values = expression.evaluateColumns(3, {'ProductId': (np.array([1, 0, 1]), ['P2', 'P1'])})
+        self.assertTrue(values.tolist() == ['Category1', 'Cat2', 'Category1'])
+
+        # Columns with missing values, or calls mixed with measures, have to be evaluated row by row
+        self.assertTrue(expression.evaluateColumns(3, {'ProductId': None}) == None)
+        self.assertTrue(ColumnExpression("str($['Qty'])").evaluateColumns(1, {'Qty': np.array([3.0])}) == None)
+        self.assertRaises(NameNotDefined, expression.evaluate, {})
+        self.assertRaises(NameNotDefined, ColumnExpression, "$['Qty'] * Price")
+        self.assertRaises(FeatureNotAvailable, ColumnExpression, "$['State'].__class__")
+
+        # Evaluating on columns gives what evaluating each row gives, or leaves it to the rows
+        columns = {'Qty': np.array([3.0, 1.0, 2.0]), 'Price': np.array([5.0, 0.0, 1.5]), 'ProductId': (np.array([1, 0, 1]), ['P2', 'P1'])}
+        rows = [{'Qty': 3.0, 'Price': 5.0, 'ProductId': 'P1'}, {'Qty': 1.0, 'Price': 0.0, 'ProductId': 'P2'},
+                {'Qty': 2.0, 'Price': 1.5, 'ProductId': 'P1'}]
+        for text in ["$['Qty'] > 1 and $['Price']", "$['Price'] or -1", "not $['Price']", "$['Qty'] > 1 and not $['Price'] < 2",
+                     "$['Qty'] if $['Qty'] > 1 else 'low'", "$['Qty'] * 2 if $['Price'] > 1 else -$['Qty']",
+                     "$['ProductId'] if $['Qty'] > 1 else 'none'", "1 < $['Qty'] < 3 or $['ProductId'] == 'P2'"]:
+            expression = ColumnExpression(text)
+            values = expression.evaluateColumns(3, columns)
+            if values is not None:
+                self.assertTrue(values.tolist() == [expression.evaluate(row) for row in rows])
+        self.assertTrue(ColumnExpression("$['Qty'] > 1 and $['Price']").evaluateColumns(3, columns) == None)
+        self.assertTrue(ColumnExpression("$['Qty'] * 2 if $['Price'] > 1 else -$['Qty']").evaluateColumns(3, columns) is not None)
+
+        # Errors are raised as for a row, not stored as inf or nan
+        for text, error in [("$['Qty'] / $['Price']", ZeroDivisionError), ("(-$['Qty']) ** 0.5", ValueError)]:
+            expression = ColumnExpression(text)
+            self.assertTrue(expression.evaluateColumns(3, columns) == None)
+            self.assertRaises(error, lambda: [expression.evaluate(row) for row in rows])
+
+    def testAddColumns(self):
+        cubeName = 'test-' + str(uuid.uuid4())
+        try:
+            shutil.copyfile('cubify/tests/testdata.csv', cubeName + '.csv')
+        except Exception:
+            shutil.copyfile('./testdata.csv', cubeName + '.csv')
+        cs = CubeService('testdb')
+        columns = [{ "name": "Revenue", "type": "numeric", "expression": "$['Qty'] * $['Price']" },
+                   { "name": "Size", "type": "string", "expression": "'LARGE' if $['Revenue'] > 20 else 'SMALL'" },
+                   { "name": "Label", "type": "string", "expression": "$['ProductId'] + '-' + $['Size']" },
+                   { "name": "Discount", "type": "numeric", "func": funcx }]
+
+        # A single pass adds every column, with later columns using earlier ones, for persisted and in-memory cubes
+        for inMemory in [False, True]:
+            name = cubeName + ('_m' if inMemory else '')
+            cube = cs.createCubeFromCsv(cubeName + '.csv', name, inMemory)
+            cs.addColumns(cube, columns, batchSize=4)
+            cube = cs.getCube(name)
+            self.assertTrue('Revenue' in cube['stats'] and 'Discount' in cube['stats'])
+            self.assertTrue(set(cube['distincts']['Size'].keys()) == set(['LARGE', 'SMALL']))
+            for cubeRow in cs.getCubeRowsForCube(name):
+                revenue = cubeRow['measures']['Qty'] * cubeRow['measures']['Price']
+                size = 'LARGE' if revenue > 20 else 'SMALL'
+                self.assertTrue(cubeRow['measures']['Revenue'] == revenue)
+                self.assertTrue(cubeRow['dimensions']['Size'] == size)
+                self.assertTrue(cubeRow['dimensions']['Label'] == cubeRow['dimensions']['ProductId'] + '-' + size)
+                self.assertTrue(cubeRow['measures']['Discount'] == funcx(cubeRow))
+                self.assertTrue('#Label:' + cubeRow['dimensions']['Label'] in cubeRow['dimensionKey'])
+
+        os.remove(cubeName + '.csv')
+
+    def testVirtualColumns(self):
+        cubeName = 'test-' + str(uuid.uuid4())
+        try:
+            shutil.copyfile('cubify/tests/testdata.csv', cubeName + '.csv')
+        except Exception:
+            shutil.copyfile('./testdata.csv', cubeName + '.csv')
+        cs = CubeService('testdb')
+        aggs = [{ "name": "agg1", "dimensions": ["Size"],
+                  "measures": [ { "outputField": { "name": "TotalRevenue" },
+                                  "formula": { "numerator": { "aggOperator": "sum", "expression": "Revenue" }, "denominator": {} } } ] }]
+
+        for inMemory in [False, True]:
+            name = cubeName + ('_m' if inMemory else '')
+            cube = cs.createCubeFromCsv(cubeName + '.csv', name, inMemory)
+            cs.addVirtualColumn(cube, 'Revenue', 'numeric', "$['Qty'] * $['Price']")
+            cs.addVirtualColumn(cube, 'Size', 'string', "'LARGE' if $['Revenue'] > 20 else 'SMALL'")
+
+            # Virtual columns are computed on read and never stored
+            cube = cs.getCube(name)
+            self.assertTrue([column['name'] for column in cube['virtualColumns']] == ['Revenue', 'Size'])
+            self.assertTrue('Revenue' not in cube['stats'] and 'Size' not in cube['distincts'])
+            cubeRows = list(cs.getCubeRowsForCube(name))
+            for cubeRow in cubeRows:
+                self.assertTrue(cubeRow['measures']['Revenue'] == cubeRow['measures']['Qty'] * cubeRow['measures']['Price'])
+                self.assertTrue(cubeRow['dimensions']['Size'] == ('LARGE' if cubeRow['measures']['Revenue'] > 20 else 'SMALL'))
+            for cubeRow in cs.__getStoredCubeRows__(name):
+                self.assertTrue('Revenue' not in cubeRow['measures'] and 'Size' not in cubeRow['dimensions'])
+            self.assertTrue(all('#Size:' + cubeRow['dimensions']['Size'] in cubeRow['dimensionKey'] for cubeRow in cubeRows))
+            if not inMemory:
+                # However the cursor is read
+                cursor = cs.queryCubeRows(cube, {})
+                self.assertTrue('Revenue' in cursor.next()['measures'] and 'Revenue' in next(cursor)['measures'])
+                self.assertTrue(all('Size' in cubeRow['dimensions'] for cubeRow in cursor.clone()))
+                self.assertTrue('Size' in cs.queryCubeRows(cube, {}).limit(1)[0]['dimensions'])
+
+            # They can be aggregated like stored columns
+            cs.aggregateCubeCustom(cube, aggs)
+            aggCubeRows = list(cs.getCubeRowsForCube(name + '_agg1'))
+            self.assertTrue(len(aggCubeRows) == 2)
+            self.assertAlmostEqual(sum(aggCubeRow['measures']['TotalRevenue'] for aggCubeRow in aggCubeRows),
+                                   sum(cubeRow['measures']['Revenue'] for cubeRow in cubeRows))
+
+            # Materializing a column stores it, with its stats
+            cs.materializeColumn(cube, 'Revenue')
+            cube = cs.getCube(name)
+            self.assertTrue([column['name'] for column in cube['virtualColumns']] == ['Size'])
+            self.assertTrue('Revenue' in cube['stats'])
+            for cubeRow in cs.__getStoredCubeRows__(name):
+                self.assertTrue(cubeRow['measures']['Revenue'] == cubeRow['measures']['Qty'] * cubeRow['measures']['Price'])
+                self.assertTrue('Size' not in cubeRow['dimensions'])
+            self.assertTrue(len([cubeRow for cubeRow in cs.getCubeRowsForCube(name) if 'Size' in cubeRow['dimensions']]) == len(cubeRows))
+            self.assertRaises(ValueError, cs.materializeColumn, cube, 'Revenue')
+
+        os.remove(cubeName + '.csv')
+
     def testExportCubeToCsv(self):
 
         cubeName = 'test-' + str(uuid.uuid4())
@@ -878,6 +1711,31 @@ class cubeServiceTests(unittest.TestCase):
 
         os.remove(cubeName + '.csv')
 
+    def testAddColumnBatched(self):
+        cubeName = 'test-' + str(uuid.uuid4())
+        try:
+            shutil.copyfile('cubify/tests/testdata.csv', cubeName + '.csv')
+        except Exception:
+            shutil.copyfile('./testdata.csv', cubeName + '.csv')
+        cs = CubeService('testdb')
+        cube = cs.createCubeFromCsv(cubeName + '.csv', cubeName)
+
+        # Batches smaller than the cube still update every row, and the stats match a full recomputation
+        cs.addColumn(cube, 'Revenue', 'numeric', "$['Qty'] * $['Price']", batchSize=5)
+        cs.addColumn(cube, 'ProductCategory', 'string', "'Category1' if $['ProductId'] == 'P1' else 'Category2'", batchSize=5)
+        cube = cs.getCube(cubeName)
+        cubeRows = list(cs.getCubeRowsForCube(cubeName))
+        stats = cs.getStats(cubeRows)
+        for stat, value in stats['Revenue'].items():
+            self.assertAlmostEqual(cube['stats']['Revenue'][stat], value)
+        self.assertTrue(cube['stats']['Qty'] == stats['Qty'])
+        self.assertTrue(sum(cube['distincts']['ProductCategory'].values()) == len(cubeRows))
+        for cubeRow in cubeRows:
+            self.assertTrue(cubeRow['dimensionKey'] == cs.__reconstructDimensionKey__(cubeRow['dimensions'], cubeRow['dates']))
+            self.assertTrue('ProductCategory:' in cubeRow['dimensionKey'])
+
+        os.remove(cubeName + '.csv')
+
     def func(cubeRow):
         if (cubeRow['dimensions']['customerState'] == 'CA'):
             return 3
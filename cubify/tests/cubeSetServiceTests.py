@@ -5,7 +5,7 @@ import uuid
 import math
 import json
 import csv
-from cubify import CubeSetService
+from cubify import CubeService, CubeSetService, Cubify
 
 class cubeSetServiceTests(unittest.TestCase):
 
@@ -46,6 +46,28 @@ class cubeSetServiceTests(unittest.TestCase):
 
         os.remove(csvFilePath)
 
+    def testSharedClient(self):
+        cubeService = CubeService('testdb', maxPoolSize=5, timeout=1000, w=1)
+        cs = CubeSetService('testdb', cubeService=cubeService)
+        self.assertTrue(cs.cubeService is cubeService)
+        self.assertTrue(cs.db.client is cubeService.client)
+
+        cs = CubeSetService('testdb', client=cubeService.client)
+        self.assertTrue(cs.cubeService.client is cubeService.client)
+
+        # In-memory cubes created through the facade are visible to both services
+        cubeName = 'test-' + str(uuid.uuid4())
+        try:
+            shutil.copyfile('cubify/tests/testdata.csv', cubeName + '.csv')
+        except Exception:
+            shutil.copyfile('./testdata.csv', cubeName + '.csv')
+        cubify = Cubify('testdb')
+        self.assertTrue(cubify.cubeSetService.cubeService is cubify.cubeService)
+        cubify.createCubeFromCsv(cubeName + '.csv', cubeName, inMemory=True)
+        self.assertTrue(cubify.cubeSetService.cubeService.getCube(cubeName) != None)
+
+        os.remove(cubeName + '.csv')
+
     def testCreateCubeSetWithAutoBinning(self):
         cubeSetName = 'test-' + str(uuid.uuid4())
         csvFilePath =  cubeSetName + '.csv'
@@ -344,6 +366,40 @@ class cubeSetServiceTests(unittest.TestCase):
 
         os.remove(cubeSetName + '.csv')
 
+    def testPerformAggregationRollup(self):
+
+        cubeSetName = 'test-' + str(uuid.uuid4())
+        csvFilePath =  cubeSetName + '.csv'
+        try:
+            shutil.copyfile('cubify/tests/testdata.csv', cubeSetName + '.csv')
+        except Exception:
+            shutil.copyfile('./testdata.csv', cubeSetName + '.csv')
+
+        cs = CubeSetService('testdb')
+        cubeSet = cs.createCubeSet("testOwner", cubeSetName, csvFilePath, None, None)
+        aggCubes = cs.performAggregation(cubeSet, ['State', 'ProductId', 'CustomerId'])
+        self.assertTrue (len(aggCubes) == 3)
+
+        # Coarser levels are rolled up from finer ones; they must match aggregating the binned cube directly
+        aggNames = ['State-ProductId-CustomerId', 'State-ProductId', 'State']
+        rolledUp = {}
+        for aggName in aggNames:
+            rolledUp[aggName] = dict((aggCubeRow['dimensionKey'], aggCubeRow['measures'])
+                                     for aggCubeRow in cs.getAggregatedCubeRows(cubeSet, aggName))
+
+        binnedCube = cs.cubeService.getCube(cubeSet['binnedCube'])
+        for aggName in aggNames:
+            cs.cubeService.aggregateCube(binnedCube, aggName.split('-'))
+            aggCubeRows = cs.getAggregatedCubeRows(cubeSet, aggName)
+            self.assertTrue (aggCubeRows.count(False) == len(rolledUp[aggName]))
+            for aggCubeRow in aggCubeRows:
+                measures = rolledUp[aggName][aggCubeRow['dimensionKey']]
+                self.assertTrue (measures['Count'] == aggCubeRow['measures']['Count'])
+                for measure in aggCubeRow['measures']:
+                    self.assertAlmostEqual(measures[measure], aggCubeRow['measures'][measure])
+
+        os.remove(cubeSetName + '.csv')
+
     def testPerformAggregationCustom(self):
 
         cubeSetName = 'test-' + str(uuid.uuid4())
@@ -484,6 +540,57 @@ class cubeSetServiceTests(unittest.TestCase):
         os.remove(cubeSetName + '.csv')
 
 
+    def testAddRowsToSourceCubeIncrementalAggs(self):
+
+        cubeSetName = 'test-' + str(uuid.uuid4())
+        csvFilePath =  cubeSetName + '.csv'
+        try:
+            shutil.copyfile('cubify/tests/testdata.csv', cubeSetName + '.csv')
+        except Exception:
+            shutil.copyfile('./testdata.csv', cubeSetName + '.csv')
+        binningFileName = 'cubify/tests/test_binnings.json'
+        if (os.path.isfile(binningFileName) == False):
+            binningFileName = './test_binnings.json'
+        with open(binningFileName) as binnings_file:
+            binnings = json.load(binnings_file)
+        aggFileName = 'cubify/tests/test_agg.json'
+        if os.path.isfile(aggFileName) == False:
+            aggFileName = './test_agg.json'
+        with open(aggFileName) as agg_file:
+            aggs = json.load(agg_file)
+        aggs.append({ "name": "agg4", "dimensions": ["Year", "ProductId"],
+                      "measures": [ { "outputField": { "name": "MaxQty" },
+                                      "formula": { "numerator": { "aggOperator": "max", "expression": "Qty" }, "denominator": {} } } ] })
+
+        cs = CubeSetService('testdb')
+        cubeSet = cs.createCubeSet("testOwner", cubeSetName, csvFilePath, binnings, aggs)
+
+        incFileName = 'cubify/tests/testdataIncremental.csv'
+        if (os.path.isfile(incFileName) == False):
+            incFileName = './testdataIncremental.csv'
+        cs.addRowsToSourceCube(cubeSet, incFileName)
+        self.assertTrue(cs.getBinnedCubeRows(cubeSet).count() == 21)
+
+        # The incrementally maintained agg cubes must match a full re-aggregation of the binned cube
+        incremental = {}
+        for agg in aggs:
+            aggCube = cs.cubeService.getCube(cubeSet['binnedCube'] + '_' + agg['name'])
+            incremental[agg['name']] = (aggCube['distincts'], dict((aggCubeRow['dimensionKey'], aggCubeRow['measures'])
+                                        for aggCubeRow in cs.getAggregatedCubeRows(cubeSet, agg['name'])))
+        self.assertTrue(len(incremental['agg4'][1]) == 6)
+
+        binnedCube = cs.cubeService.getCube(cubeSet['binnedCube'])
+        for aggCube in cs.cubeService.aggregateCubeCustom(binnedCube, aggs):
+            distincts, rows = incremental[aggCube['agg']['name']]
+            self.assertTrue(distincts == aggCube['distincts'])
+            aggCubeRows = cs.cubeService.getCubeRows(aggCube)
+            self.assertTrue(aggCubeRows.count() == len(rows))
+            for aggCubeRow in aggCubeRows:
+                for measure in aggCubeRow['measures']:
+                    self.assertAlmostEqual(rows[aggCubeRow['dimensionKey']][measure], aggCubeRow['measures'][measure])
+
+        os.remove(cubeSetName + '.csv')
+
     def testRemoveRowsFromSourceCube(self):
         cubeSetName = 'test-' + str(uuid.uuid4())
         csvFilePath =  cubeSetName + '.csv'